@@ -37,8 +37,9 @@ import functools
 import message_filters
 import os
 import rospy
-from camera_calibration.camera_calibrator import OpenCVCalibrationNode
+from camera_calibration.camera_calibrator import OpenCVCalibrationNode, DropPolicy
 from camera_calibration.calibrator import ChessboardInfo, Patterns
+from camera_calibration.sample_store import ImageStorage
 from message_filters import ApproximateTimeSynchronizer
 
 
@@ -68,6 +69,10 @@ def main():
     group.add_option("--no-service-check",
                      action="store_false", dest="service_check", default=True,
                      help="disable check for set_camera_info services at startup")
+    group.add_option("--compressed",
+                     action="store_true", default=False,
+                     help="subscribe to the compressed (JPEG or PNG) version of the images, decoded at reduced "
+                          "resolution for detection and at full resolution only when the target is found")
     parser.add_option_group(group)
     group = OptionGroup(parser, "Calibration Optimizer Options")
     group.add_option("--fix-principal-point",
@@ -88,6 +93,82 @@ def main():
                      help="Do not use samples where the calibration pattern is moving faster \
                      than this speed in px/frame. Set to eg. 0.5 for rolling shutter cameras.")
     parser.add_option_group(group)
+    group = OptionGroup(parser, "Performance Options")
+    group.add_option("--roi-tracking",
+                     action="store_true", default=False,
+                     help="look for the calibration pattern around its previous position before searching the whole image")
+    group.add_option("--flow-tracking",
+                     action="store_true", default=False,
+                     help="follow the chessboard between frames with optical flow instead of detecting it in every frame")
+    group.add_option("--redetect-interval",
+                     type="int", default=10, metavar="N",
+                     help="with --flow-tracking, run the full detection at least every N frames (default %default)")
+    group.add_option("--lazy-refinement",
+                     action="store_true", default=False,
+                     help="refine the detected corners at full resolution only for the frames kept as samples, "
+                          "as is always done for compressed and raw Bayer images")
+    group.add_option("--pyramid-detection",
+                     action="store_true", default=False,
+                     help="on cameras of at least twice VGA resolution, search the pattern in an image pyramid, at "
+                          "the scale where it last appeared, so that distant patterns are found too")
+    group.add_option("--min-sharpness",
+                     type="float", default=0.0,
+                     help="skip the detection in frames whose downsampled image has a variance of the Laplacian below "
+                          "this, which are too blurred to give samples. Set to eg. 50. (default %default: disabled)")
+    group.add_option("--max-frame-difference",
+                     type="float", default=-1.0,
+                     help="skip the detection in frames whose downsampled image differs from the previous one by more "
+                          "than this many gray levels on average, the camera or the pattern moving too fast. "
+                          "(default %default: disabled)")
+    group.add_option("--max-frame-age",
+                     type="float", default=None, metavar="SECONDS",
+                     help="drop the frames captured longer than this before their detection starts (default: no limit)")
+    group.add_option("--latency-budget",
+                     type="float", default=None, metavar="SECONDS",
+                     help="when frames take longer than this from their capture to the end of their detection, "
+                          "process fewer of them until they do not (default: no budget)")
+    group.add_option("--queue-size",
+                     type="int", default=1, metavar="N",
+                     help="number of frames waiting in front of each processing stage (default %default)")
+    group.add_option("--drop-policy",
+                     type="choice", choices=["latest", "fifo"], default="latest",
+                     help="when a queue is full, 'latest' drops the oldest frame and 'fifo' waits for room (default %default)")
+    group.add_option("--convert-workers",
+                     type="int", default=1, metavar="N",
+                     help="number of threads converting images to monochrome (default %default)")
+    group.add_option("--detect-workers",
+                     type="int", default=1, metavar="N",
+                     help="number of threads detecting the calibration pattern, always 1 with --roi-tracking, "
+                          "--flow-tracking, --pyramid-detection, --min-sharpness, --max-frame-difference, "
+                          "--max-chessboard-speed or --latency-budget (default %default)")
+    group.add_option("--render-workers",
+                     type="int", default=1, metavar="N",
+                     help="number of threads rendering the display (default %default)")
+    group.add_option("--image-storage",
+                     type="choice", choices=["memory", "png", "mmap", "none"], default="memory",
+                     help="how sample images are kept past --memory-budget: 'memory' as they are, 'png' compressed, "
+                          "'mmap' in a scratch file, 'none' keeps only the detected corners (default %default)")
+    group.add_option("--memory-budget",
+                     type="float", default=None, metavar="MB",
+                     help="megabytes of raw sample images kept in memory before --image-storage applies (default: none)")
+    group.add_option("--live-interval",
+                     type="int", default=0, metavar="N",
+                     help="re-solve the calibration in the background every N new samples, publishing the "
+                          "interim solution on live_calibration (default %default: disabled)")
+    group.add_option("--fixed-point-maps",
+                     action="store_true", default=False,
+                     help="rectify the display with fixed-point maps, which take less memory and remap faster")
+    group.add_option("--save-format",
+                     type="choice", choices=["tar", "zip"], default="tar",
+                     help="archive written by SAVE: 'zip' stores the images uncompressed with an index, for "
+                          "tools to read any one of them without going through the others (default %default)")
+    group.add_option("--save-compression",
+                     type="choice", choices=["none", "gz", "bz2", "xz"], default="none",
+                     help="compression of the tar archive written by SAVE, on top of the PNG images (default %default)")
+    group.add_option("--save-compression-level",
+                     type="int", default=None, metavar="LEVEL",
+                     help="compression level of --save-compression (default: the codec's)")
+    parser.add_option_group(group)
     options, args = parser.parse_args()
 
     if len(options.size) != len(options.square):
@@ -144,9 +225,41 @@ def main():
     else:
         checkerboard_flags = cv2.CALIB_CB_FAST_CHECK
 
+    if options.drop_policy == 'fifo':
+        drop_policy = DropPolicy.Fifo
+    else:
+        drop_policy = DropPolicy.Latest
+    stage_workers = {'convert': options.convert_workers,
+                     'detect': options.detect_workers,
+                     'render': options.render_workers}
+    image_storage = {'memory': ImageStorage.Memory,
+                     'png': ImageStorage.Png,
+                     'mmap': ImageStorage.Mmap,
+                     'none': ImageStorage.Discard}[options.image_storage]
+    save_compression = options.save_compression
+    if save_compression == 'none':
+        save_compression = ''
+    memory_budget = None
+    if options.memory_budget is not None:
+        memory_budget = int(options.memory_budget * 1024 * 1024)
+
     rospy.init_node('cameracalibrator')
     node = OpenCVCalibrationNode(boards, options.service_check, sync, calib_flags, pattern, options.camera_name,
-                                 checkerboard_flags=checkerboard_flags, max_chessboard_speed=options.max_chessboard_speed)
+                                 checkerboard_flags=checkerboard_flags, max_chessboard_speed=options.max_chessboard_speed,
+                                 roi_tracking=options.roi_tracking, flow_tracking=options.flow_tracking,
+                                 redetect_interval=options.redetect_interval, queue_size=options.queue_size,
+                                 drop_policy=drop_policy, stage_workers=stage_workers,
+                                 image_storage=image_storage, memory_budget=memory_budget,
+                                 live_interval=options.live_interval, fixed_point_maps=options.fixed_point_maps,
+                                 compressed=options.compressed, save_format=options.save_format,
+                                 save_compression=save_compression,
+                                 save_compression_level=options.save_compression_level,
+                                 lazy_refinement=options.lazy_refinement,
+                                 pyramid_detection=options.pyramid_detection,
+                                 min_sharpness=options.min_sharpness,
+                                 max_frame_difference=options.max_frame_difference,
+                                 max_frame_age=options.max_frame_age,
+                                 latency_budget=options.latency_budget)
     rospy.spin()
 
 if __name__ == "__main__":
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+#
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2009, Willow Garage, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#  * Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+#  * Neither the name of the Willow Garage nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+import os
+import sys
+
+import cv2
+
+from camera_calibration.batch_calibration import find_archives, run_batch
+from camera_calibration.calibrator import ChessboardInfo
+
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    parser = OptionParser("%prog ARCHIVE|DIRECTORY|PATTERN... -o OUTPUT [ opts ]",
+                          description="Calibrate from many archives, e.g. one per robot. DIRECTORY stands for the "
+                                      "archives it holds, PATTERN is a glob pattern such as 'shift/*.tar.gz'.")
+    parser.add_option("-o", "--output", type="string", default=None,
+                      help="directory receiving the calibration files and result.json of each archive, and summary.json")
+    parser.add_option("--mono", default=False, action="store_true", dest="mono",
+                      help="Monocular calibration only. Calibrates left images.")
+    parser.add_option("-s", "--size", default=[], action="append", dest="size",
+                      help="specify chessboard size as NxM [default: 8x6]")
+    parser.add_option("-q", "--square", default=[], action="append", dest="square",
+                      help="specify chessboard square size in meters [default: 0.108]")
+    parser.add_option("--fix-principal-point", action="store_true", default=False,
+                     help="fix the principal point at the image center")
+    parser.add_option("--fix-aspect-ratio", action="store_true", default=False,
+                     help="enforce focal lengths (fx, fy) are equal")
+    parser.add_option("--zero-tangent-dist", action="store_true", default=False,
+                     help="set tangential distortion coefficients (p1, p2) to zero")
+    parser.add_option("-k", "--k-coefficients", type="int", default=2, metavar="NUM_COEFFS",
+                     help="number of radial distortion coefficients to use (up to 6, default %default)")
+    parser.add_option("-j", "--jobs", type="int", default=0, metavar="N",
+                     help="number of worker processes shared by all the archives, 0 for one per CPU (default %default)")
+    parser.add_option("--no-corner-cache", action="store_false", dest="corner_cache", default=True,
+                     help="detect the calibration target in every image, instead of reusing the corners found by the "
+                          "previous runs on the same images")
+
+    options, args = parser.parse_args()
+
+    if len(options.size) != len(options.square):
+        parser.error("Number of size and square inputs must be the same!")
+
+    if not options.square:
+        options.square.append("0.108")
+        options.size.append("8x6")
+
+    boards = []
+    for (sz, sq) in zip(options.size, options.square):
+        size = tuple([int(c) for c in sz.split('x')])
+        boards.append(ChessboardInfo(size[0], size[1], float(sq)))
+
+    if not args:
+        parser.error("Must give archives")
+    if not options.output:
+        parser.error("Must give an output directory")
+    archives = find_archives(args)
+    if not archives:
+        parser.error("No archive found in %s" % " ".join(args))
+
+    num_ks = options.k_coefficients
+
+    calib_flags = 0
+    if options.fix_principal_point:
+        calib_flags |= cv2.CALIB_FIX_PRINCIPAL_POINT
+    if options.fix_aspect_ratio:
+        calib_flags |= cv2.CALIB_FIX_ASPECT_RATIO
+    if options.zero_tangent_dist:
+        calib_flags |= cv2.CALIB_ZERO_TANGENT_DIST
+    if (num_ks > 3):
+        calib_flags |= cv2.CALIB_RATIONAL_MODEL
+    if (num_ks < 6):
+        calib_flags |= cv2.CALIB_FIX_K6
+    if (num_ks < 5):
+        calib_flags |= cv2.CALIB_FIX_K5
+    if (num_ks < 4):
+        calib_flags |= cv2.CALIB_FIX_K4
+    if (num_ks < 3):
+        calib_flags |= cv2.CALIB_FIX_K3
+    if (num_ks < 2):
+        calib_flags |= cv2.CALIB_FIX_K2
+    if (num_ks < 1):
+        calib_flags |= cv2.CALIB_FIX_K1
+
+    summary = run_batch(archives, options.output, boards, options.mono, calib_flags, options.jobs, options.corner_cache)
+    print("%d archives calibrated, %d failed in %.1f s, summary in %s" %
+          (summary['succeeded'], summary['failed'], summary['seconds'], os.path.join(options.output, 'summary.json')))
+    sys.exit(1 if summary['failed'] else 0)
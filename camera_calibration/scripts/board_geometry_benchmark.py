@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+#
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2009, Willow Garage, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#  * Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+#  * Neither the name of the Willow Garage nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Time the board geometry helpers of the calibrator against the per-corner loops they replaced, on
+synthetic detections of boards from 9x7 to 25x20, and check both give the same results. Only the
+border check and the refinement radius run on every detection, they make up the per frame time.
+"""
+
+import math
+import sys
+import timeit
+
+import numpy
+
+from camera_calibration.calibrator import (ChessboardInfo, MonoCalibrator, Patterns, _get_refine_radius,
+                                           _within_border)
+
+BOARD_SIZES = [(9, 7), (12, 9), (16, 12), (20, 16), (25, 20)]
+
+
+def make_corners(board, width = 1280, height = 960):
+    """ Corners of board seen in perspective across most of a width x height image, as detected """
+    (u, v) = numpy.meshgrid(numpy.linspace(0.1, 0.9, board.n_cols), numpy.linspace(0.15, 0.85, board.n_rows))
+    # Keystone the grid and bend its rows slightly, as lens distortion would
+    x = (u - 0.5) * (1.0 - 0.2 * v) + 0.5 + 0.01 * numpy.sin(math.pi * v)
+    y = v + 0.02 * numpy.sin(math.pi * u)
+    corners = numpy.dstack((x * width, y * height)).reshape(-1, 1, 2)
+    return corners.astype(numpy.float32)
+
+# The per-corner loops, as they were
+
+def legacy_pdist(p1, p2):
+    return math.sqrt(math.pow(p1[0] - p2[0], 2) + math.pow(p1[1] - p2[1], 2))
+
+def legacy_within_border(corners, w, h, BORDER = 8):
+    return all([(BORDER < corners[i, 0, 0] < (w - BORDER)) and (BORDER < corners[i, 0, 1] < (h - BORDER)) for i in range(corners.shape[0])])
+
+def legacy_refine_radius(corners, board):
+    min_distance = float("inf")
+    for row in range(board.n_rows):
+        for col in range(board.n_cols - 1):
+            index = row*board.n_rows + col
+            min_distance = min(min_distance, legacy_pdist(corners[index, 0], corners[index + 1, 0]))
+    for row in range(board.n_rows - 1):
+        for col in range(board.n_cols):
+            index = row*board.n_rows + col
+            min_distance = min(min_distance, legacy_pdist(corners[index, 0], corners[index + board.n_cols, 0]))
+    return int(math.ceil(min_distance * 0.5))
+
+def legacy_linear_error(corners, b):
+    def pt2line(x0, y0, x1, y1, x2, y2):
+        return abs((x2 - x1) * (y1 - y0) - (x1 - x0) * (y2 - y1)) / math.sqrt((x2 - x1) ** 2 + (y2 - y1) ** 2)
+
+    cc = b.n_cols
+    cr = b.n_rows
+    errors = []
+    for r in range(cr):
+        (x1, y1) = corners[(cc * r) + 0, 0]
+        (x2, y2) = corners[(cc * r) + cc - 1, 0]
+        for i in range(1, cc - 1):
+            (x0, y0) = corners[(cc * r) + i, 0]
+            errors.append(pt2line(x0, y0, x1, y1, x2, y2))
+    if errors:
+        return math.sqrt(sum([e**2 for e in errors]) / len(errors))
+    else:
+        return None
+
+def legacy_mk_object_points(pattern, boards, use_board_size = False):
+    opts = []
+    for i, b in enumerate(boards):
+        num_pts = b.n_cols * b.n_rows
+        opts_loc = numpy.zeros((num_pts, 1, 3), numpy.float32)
+        for j in range(num_pts):
+            opts_loc[j, 0, 0] = (j / b.n_cols)
+            if pattern == Patterns.ACircles:
+                opts_loc[j, 0, 1] = 2*(j % b.n_cols) + (opts_loc[j, 0, 0] % 2)
+            else:
+                opts_loc[j, 0, 1] = (j % b.n_cols)
+            opts_loc[j, 0, 2] = 0
+            if use_board_size:
+                opts_loc[j, 0, :] = opts_loc[j, 0, :] * b.dim
+        opts.append(opts_loc)
+    return opts
+
+def check(board, corners):
+    """ Raise if a helper and its legacy loop disagree on corners """
+    assert _within_border(corners, 1280, 960) == legacy_within_border(corners, 1280, 960)
+    assert not _within_border(corners, 1280, 960, 200) and not legacy_within_border(corners, 1280, 960, 200)
+    assert _get_refine_radius(corners, board) == legacy_refine_radius(corners, board)
+    # The loop divided and summed float32 scalars, the kernel does it in double
+    (new, old) = (MonoCalibrator.linear_error(corners, board), legacy_linear_error(corners, board))
+    assert abs(new - old) <= 1e-6 * old, (new, old)
+    for pattern in [Patterns.Chessboard, Patterns.ACircles]:
+        calibrator = MonoCalibrator([board], pattern = pattern)
+        for use_board_size in [False, True]:
+            assert numpy.array_equal(calibrator.mk_object_points([board], use_board_size)[0],
+                                     legacy_mk_object_points(pattern, [board], use_board_size)[0])
+
+def usec(function, repeat = 5):
+    """ Best time of a call to function, in microseconds """
+    timer = timeit.Timer(function)
+    (number, _) = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number * 1e6
+
+def main():
+    print("%-7s %-16s %10s %10s %8s" % ("board", "helper", "loop (us)", "numpy (us)", "speedup"))
+    for (n_cols, n_rows) in BOARD_SIZES:
+        board = ChessboardInfo(n_cols, n_rows, 0.025)
+        corners = make_corners(board)
+        check(board, corners)
+        calibrator = MonoCalibrator([board])
+        # (name, loop, kernel, whether _get_corners runs it on every detection)
+        cases = [
+            ("border check", lambda: legacy_within_border(corners, 1280, 960),
+                             lambda: _within_border(corners, 1280, 960), True),
+            ("refine radius", lambda: legacy_refine_radius(corners, board),
+                              lambda: _get_refine_radius(corners, board), True),
+            ("linear error", lambda: legacy_linear_error(corners, board),
+                             lambda: MonoCalibrator.linear_error(corners, board), False),
+            ("object points", lambda: legacy_mk_object_points(Patterns.Chessboard, [board]),
+                              lambda: calibrator.mk_object_points([board]), False),
+        ]
+        (total_old, total_new) = (0.0, 0.0)
+        for (name, old, new, per_frame) in cases:
+            (t_old, t_new) = (usec(old), usec(new))
+            if per_frame:
+                (total_old, total_new) = (total_old + t_old, total_new + t_new)
+            print("%-7s %-16s %10.1f %10.1f %7.1fx" % ("%dx%d" % (n_cols, n_rows), name, t_old, t_new, t_old / t_new))
+        print("%-7s %-16s %10.1f %10.1f %7.1fx" % ("%dx%d" % (n_cols, n_rows), "per frame", total_old, total_new,
+                                                   total_old / total_new))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
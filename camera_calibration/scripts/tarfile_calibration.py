@@ -38,9 +38,10 @@ import numpy
 
 import cv2
 import cv_bridge
-import tarfile
 
-from camera_calibration.calibrator import MonoCalibrator, StereoCalibrator, CalibrationException, ChessboardInfo
+from camera_calibration.archive_reader import ArchiveReader
+from camera_calibration.calibrator import MonoCalibrator, StereoCalibrator, CalibrationException, ChessboardInfo, \
+    image_from_archive
 
 import rospy
 import sensor_msgs.srv
@@ -54,13 +55,13 @@ def display(win_name, img):
         rospy.signal_shutdown('Quit')
 
 
-def cal_from_tarfile(boards, tarname, mono = False, upload = False, calib_flags = 0, visualize = False, alpha=1.0):
+def cal_from_tarfile(boards, tarname, mono = False, upload = False, calib_flags = 0, visualize = False, alpha=1.0, jobs=1, corner_cache=True):
     if mono:
-        calibrator = MonoCalibrator(boards, calib_flags)
+        calibrator = MonoCalibrator(boards, calib_flags, jobs=jobs)
     else:
-        calibrator = StereoCalibrator(boards, calib_flags)
+        calibrator = StereoCalibrator(boards, calib_flags, jobs=jobs)
 
-    calibrator.do_tarfile_calibration(tarname)
+    calibrator.do_tarfile_calibration(tarname, corner_cache)
 
     print(calibrator.ost())
 
@@ -86,67 +87,61 @@ def cal_from_tarfile(boards, tarname, mono = False, upload = False, calib_flags
         #Show rectified images
         calibrator.set_alpha(alpha)
 
-        archive = tarfile.open(tarname, 'r')
-        if mono:
-            for f in archive.getnames():
-                if f.startswith('left') and (f.endswith('.pgm') or f.endswith('png')):
-                    filedata = archive.extractfile(f).read()
-                    file_bytes = numpy.asarray(bytearray(filedata), dtype=numpy.uint8)
-                    im=cv2.imdecode(file_bytes,cv2.IMREAD_COLOR)
-
-                    bridge = cv_bridge.CvBridge()
-                    try:
-                        msg=bridge.cv2_to_imgmsg(im, "bgr8")
-                    except cv_bridge.CvBridgeError as e:
-                        print(e)
-
-                    #handle msg returns the recitifed image with corner detection once camera is calibrated.
-                    drawable=calibrator.handle_msg(msg)
-                    vis=numpy.asarray( drawable.scrib[:,:])
-                    #Display. Name of window:f
-                    display(f, vis)
-        else:
-            limages = [ f for f in archive.getnames() if (f.startswith('left') and (f.endswith('pgm') or f.endswith('png'))) ]
-            limages.sort()
-            rimages = [ f for f in archive.getnames() if (f.startswith('right') and (f.endswith('pgm') or f.endswith('png'))) ]
-            rimages.sort()
-
-            if not len(limages) == len(rimages):
-                raise RuntimeError("Left, right images don't match. %d left images, %d right" % (len(limages), len(rimages)))
+        with ArchiveReader(tarname) as archive:
+            if mono:
+                for f in archive.names():
+                    if f.startswith('left') and (f.endswith('.pgm') or f.endswith('png')):
+                        im=image_from_archive(archive, f)
+
+                        bridge = cv_bridge.CvBridge()
+                        try:
+                            msg=bridge.cv2_to_imgmsg(im, "bgr8")
+                        except cv_bridge.CvBridgeError as e:
+                            print(e)
+
+                        #handle msg returns the recitifed image with corner detection once camera is calibrated.
+                        drawable=calibrator.handle_msg(msg)
+                        vis=numpy.asarray( drawable.scrib[:,:])
+                        #Display. Name of window:f
+                        display(f, vis)
+            else:
+                limages = [ f for f in archive.names() if (f.startswith('left') and (f.endswith('pgm') or f.endswith('png'))) ]
+                limages.sort()
+                rimages = [ f for f in archive.names() if (f.startswith('right') and (f.endswith('pgm') or f.endswith('png'))) ]
+                rimages.sort()
+
+                if not len(limages) == len(rimages):
+                    raise RuntimeError("Left, right images don't match. %d left images, %d right" % (len(limages), len(rimages)))
             
-            for i in range(len(limages)):
-                l=limages[i]
-                r=rimages[i]
-
-                if l.startswith('left') and (l.endswith('.pgm') or l.endswith('png')) and r.startswith('right') and (r.endswith('.pgm') or r.endswith('png')):
-                    # LEFT IMAGE
-                    filedata = archive.extractfile(l).read()
-                    file_bytes = numpy.asarray(bytearray(filedata), dtype=numpy.uint8)
-                    im_left=cv2.imdecode(file_bytes,cv2.IMREAD_COLOR)
+                for i in range(len(limages)):
+                    l=limages[i]
+                    r=rimages[i]
+
+                    if l.startswith('left') and (l.endswith('.pgm') or l.endswith('png')) and r.startswith('right') and (r.endswith('.pgm') or r.endswith('png')):
+                        # LEFT IMAGE
+                        im_left=image_from_archive(archive, l)
        
-                    bridge = cv_bridge.CvBridge()
-                    try:
-                        msg_left=bridge.cv2_to_imgmsg(im_left, "bgr8")
-                    except cv_bridge.CvBridgeError as e:
-                        print(e)
-
-                    #RIGHT IMAGE
-                    filedata = archive.extractfile(r).read()
-                    file_bytes = numpy.asarray(bytearray(filedata), dtype=numpy.uint8)
-                    im_right=cv2.imdecode(file_bytes,cv2.IMREAD_COLOR)
-                    try:
-                        msg_right=bridge.cv2_to_imgmsg(im_right, "bgr8")
-                    except cv_bridge.CvBridgeError as e:
-                        print(e)
-
-                    drawable=calibrator.handle_msg([ msg_left,msg_right] )
-
-                    h, w = numpy.asarray(drawable.lscrib[:,:]).shape[:2]
-                    vis = numpy.zeros((h, w*2, 3), numpy.uint8)
-                    vis[:h, :w ,:] = numpy.asarray(drawable.lscrib[:,:])
-                    vis[:h, w:w*2, :] = numpy.asarray(drawable.rscrib[:,:])
+                        bridge = cv_bridge.CvBridge()
+                        try:
+                            msg_left=bridge.cv2_to_imgmsg(im_left, "bgr8")
+                        except cv_bridge.CvBridgeError as e:
+                            print(e)
+
+                        #RIGHT IMAGE
+                        im_right=image_from_archive(archive, r)
+                        try:
+                            msg_right=bridge.cv2_to_imgmsg(im_right, "bgr8")
+                        except cv_bridge.CvBridgeError as e:
+                            print(e)
+
+                        drawable=calibrator.handle_msg([ msg_left,msg_right] )
+
+                        h, w = numpy.asarray(drawable.lscrib[:,:]).shape[:2]
+                        vis = numpy.zeros((h, w*2, 3), numpy.uint8)
+                        vis[:h, :w ,:] = numpy.asarray(drawable.lscrib[:,:])
+                        vis[:h, w:w*2, :] = numpy.asarray(drawable.rscrib[:,:])
                     
-                    display(l+" "+r,vis)    
+                        display(l+" "+r,vis)    
 
 
 if __name__ == '__main__':
@@ -172,6 +167,11 @@ if __name__ == '__main__':
                      help="visualize rectified images after calibration")
     parser.add_option("-a", "--alpha", type="float", default=1.0, metavar="ALPHA",
                      help="zoom for visualization of rectifies images. Ranges from 0 (zoomed in, all pixels in calibrated image are valid) to 1 (zoomed out, all pixels in  original image are in calibrated image). default %default)")
+    parser.add_option("-j", "--jobs", type="int", default=1, metavar="N",
+                     help="number of processes used to detect the calibration target, 0 for one per CPU (default %default)")
+    parser.add_option("--no-corner-cache", action="store_false", dest="corner_cache", default=True,
+                     help="detect the calibration target in every image, instead of reusing the corners found by the "
+                          "previous runs on the same images, and do not save them to TARFILE.corners.npz")
 
     options, args = parser.parse_args()
     
@@ -226,4 +226,5 @@ if __name__ == '__main__':
     if (num_ks < 1):
         calib_flags |= cv2.CALIB_FIX_K1
 
-    cal_from_tarfile(boards, tarname, options.mono, options.upload, calib_flags, options.visualize, options.alpha)
+    cal_from_tarfile(boards, tarname, options.mono, options.upload, calib_flags, options.visualize, options.alpha, options.jobs,
+                     options.corner_cache)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+#
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2009, Willow Garage, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#  * Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+#  * Neither the name of the Willow Garage nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+import mmap
+import numpy
+import struct
+import tarfile
+import zipfile
+
+
+def is_zip_archive(filename):
+    """
+    Return whether the file is a zip archive. zipfile.is_zipfile alone also accepts the tar
+    archives that hold an uncompressed zip file, e.g. a .npz file, near their end.
+    """
+    with open(filename, 'rb') as f:
+        magic = f.read(4)
+    return magic in (b'PK\x03\x04', b'PK\x05\x06') and zipfile.is_zipfile(filename)
+
+class ArchiveReader(object):
+    """
+    Random access to the files of a calibration archive, a zipfile or a tarfile.
+
+    Zip archives are indexed by their central directory, without reading the files. The files
+    stored uncompressed, like the images written by Calibrator.do_save, are read as arrays mapped
+    onto the archive, so reading one costs no more than seeking to it. Uncompressed tar archives are
+    indexed by a pass over their headers and mapped the same way. Compressed tar archives, e.g. the
+    legacy .tar.gz ones, are indexed by decompressing them, and read through tarfile.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._zip = None
+        self._tar = None
+        self._map = None
+        # name -> (offset, size) of the files mapped from the archive
+        self._mapped = {}
+        if is_zip_archive(filename):
+            self._zip = zipfile.ZipFile(filename, 'r')
+            self._names = self._zip.namelist()
+            with open(filename, 'rb') as f:
+                self._map = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+            for info in self._zip.infolist():
+                if info.compress_type == zipfile.ZIP_STORED:
+                    self._mapped[info.filename] = (self._zip_data_offset(info), info.file_size)
+            return
+        try:
+            self._tar = tarfile.open(filename, 'r:')
+        except tarfile.ReadError:
+            self._tar = tarfile.open(filename, 'r:*')
+            self._names = self._tar.getnames()
+            return
+        members = self._tar.getmembers()
+        self._names = [member.name for member in members]
+        if members:
+            with open(filename, 'rb') as f:
+                self._map = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+            for member in members:
+                if member.isfile():
+                    self._mapped[member.name] = (member.offset_data, member.size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def names(self):
+        """ Return the names of the files, in archive order """
+        return list(self._names)
+
+    def read(self, name):
+        """ Return the data of a file, as an array of bytes mapped onto the archive if possible """
+        if name in self._mapped:
+            (offset, size) = self._mapped[name]
+            return numpy.frombuffer(self._map, numpy.uint8, size, offset)
+        if self._zip is not None:
+            return self._zip.read(name)
+        f = self._tar.extractfile(name)
+        if f is None:
+            raise KeyError(name)
+        return f.read()
+
+    def close(self):
+        if self._zip is not None:
+            self._zip.close()
+        if self._tar is not None:
+            self._tar.close()
+        # The map is released once the last array read from it is gone
+        self._map = None
+
+    def _zip_data_offset(self, info):
+        # The data follows the local header, whose name and extra field may differ from the central directory's
+        header = self._map[info.header_offset:info.header_offset + 30]
+        (name_length, extra_length) = struct.unpack('<HH', header[26:30])
+        return info.header_offset + 30 + name_length + extra_length
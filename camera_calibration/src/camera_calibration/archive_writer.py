@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+#
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2009, Willow Garage, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#  * Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+#  * Neither the name of the Willow Garage nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+from io import BytesIO
+import collections
+import multiprocessing
+import multiprocessing.pool
+import tarfile
+import time
+import zipfile
+
+
+class ArchiveWriter(object):
+    """
+    Adds files to an open tarfile or zipfile object, their data being computed (e.g. encoded as PNG)
+    on a pool of worker threads. Files are written in the order they are added, as soon as their
+    data is ready, with at most two per worker waiting in memory. Zip files are stored uncompressed,
+    for ArchiveReader to map them.
+    """
+    def __init__(self, archive, workers = None):
+        self.archive = archive
+        self.workers = workers or multiprocessing.cpu_count()
+        self._pool = multiprocessing.pool.ThreadPool(self.workers)
+        # (name, AsyncResult, written) of the files being computed, in order
+        self._pending = collections.deque()
+
+    def add(self, name, data, written = None):
+        """
+        Add a file. data is its content, as bytes or text (encoded as UTF-8), or a function
+        computing it on the pool, which may return None to leave the file out. written(content) is
+        called once the file is in the archive.
+        """
+        if not callable(data):
+            self.flush()
+            self._write(name, data, written)
+            return
+        self._pending.append((name, self._pool.apply_async(data), written))
+        while len(self._pending) > 2 * self.workers or (self._pending and self._pending[0][1].ready()):
+            (name, result, written) = self._pending.popleft()
+            self._write(name, result.get(), written)
+
+    def flush(self):
+        """ Write the files being computed """
+        while self._pending:
+            (name, result, written) = self._pending.popleft()
+            self._write(name, result.get(), written)
+
+    def close(self):
+        """ Write the files being computed and stop the workers. The archive is left open. """
+        self.flush()
+        self._pool.close()
+        self._pool.join()
+
+    def abort(self):
+        """ Stop the workers, dropping the files being computed """
+        self._pending.clear()
+        self._pool.terminate()
+        self._pool.join()
+
+    def _write(self, name, data, written):
+        if data is None:
+            return
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        if isinstance(self.archive, zipfile.ZipFile):
+            zi = zipfile.ZipInfo(name, time.localtime()[:6])
+            zi.compress_type = zipfile.ZIP_STORED
+            zi.external_attr = 0o644 << 16
+            self.archive.writestr(zi, data)
+        else:
+            ti = tarfile.TarInfo(name)
+            ti.size = len(data)
+            ti.uname = 'calibrator'
+            ti.mtime = int(time.time())
+            self.archive.addfile(tarinfo=ti, fileobj=BytesIO(data))
+        if written is not None:
+            written(data)
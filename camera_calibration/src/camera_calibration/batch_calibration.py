@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+#
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2009, Willow Garage, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#  * Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+#  * Neither the name of the Willow Garage nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+import glob
+import json
+import math
+import multiprocessing
+import os
+import time
+import traceback
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from camera_calibration.calibrator import MonoCalibrator, StereoCalibrator
+
+# Extensions of the archives found in the directories given on the command line
+ARCHIVE_EXTENSIONS = ['.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz', '.zip']
+
+
+def is_archive_name(filename):
+    return any(filename.endswith(ext) for ext in ARCHIVE_EXTENSIONS)
+
+def find_archives(paths):
+    """
+    Return the archives given as files, directories holding them, or glob patterns, without duplicates.
+    Directories and patterns only bring in the files named like archives, leaving out e.g. corner caches.
+    """
+    archives = []
+    for path in paths:
+        if os.path.isdir(path):
+            found = sorted(os.path.join(path, f) for f in os.listdir(path) if is_archive_name(f))
+        elif os.path.exists(path):
+            found = [path]
+        else:
+            found = sorted(f for f in glob.glob(path) if is_archive_name(f))
+        archives.extend(f for f in found if f not in archives)
+    return archives
+
+def result_name(archive, taken):
+    """ Return a name for the results of archive that is not in taken, from the archive file name """
+    name = os.path.basename(archive)
+    for ext in ARCHIVE_EXTENSIONS:
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+            break
+    unique = name
+    i = 2
+    while unique in taken:
+        unique = "%s-%d" % (name, i)
+        i += 1
+    return unique
+
+def rms(errors):
+    """ RMS of per-view RMS errors, all views weighing the same """
+    return math.sqrt(sum(e ** 2 for e in errors) / len(errors))
+
+def calibrate_archive(archive, output_dir, boards, mono, calib_flags, jobs, corner_cache):
+    """
+    Calibrate from one archive, writing the calibration files and result.json to output_dir.
+    Returns the result, a JSON-serializable dict.
+    """
+    result = {'archive': archive, 'output': output_dir}
+    start = time.time()
+    if mono:
+        calibrator = MonoCalibrator(boards, calib_flags, jobs=jobs)
+    else:
+        calibrator = StereoCalibrator(boards, calib_flags, jobs=jobs)
+    calibrator.do_tarfile_calibration(archive, corner_cache)
+    result['calibration_seconds'] = time.time() - start
+
+    errors = calibrator.reprojection_errors(calibrator.good_corners)
+    if mono:
+        files = {'ost.yaml': calibrator.yaml()}
+        result['rms'] = rms(errors)
+        result['view_errors'] = errors
+    else:
+        files = {'left.yaml': calibrator.yaml("/left", calibrator.l),
+                 'right.yaml': calibrator.yaml("/right", calibrator.r)}
+        result['rms'] = rms(errors[0] + errors[1])
+        result['view_errors'] = {'left': errors[0], 'right': errors[1]}
+    files['ost.txt'] = calibrator.ost()
+    result['jobs'] = jobs
+    result['views'] = len(calibrator.good_corners)
+    result['image_size'] = list(calibrator.size)
+    result['detection_stats'] = dict(calibrator.get_detection_stats())
+
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    for (name, text) in files.items():
+        with open(os.path.join(output_dir, name), 'w') as f:
+            f.write(text)
+    result['seconds'] = time.time() - start
+    with open(os.path.join(output_dir, 'result.json'), 'w') as f:
+        json.dump(result, f, indent=2, sort_keys=True)
+    return result
+
+def _archive_process(results, name, archive, output_dir, boards, mono, calib_flags, jobs, corner_cache):
+    """ Body of the process calibrating one archive, which reports its result or failure to results """
+    start = time.time()
+    try:
+        result = calibrate_archive(archive, output_dir, boards, mono, calib_flags, jobs, corner_cache)
+        result['status'] = 'ok'
+    except Exception as e:
+        traceback.print_exc()
+        result = {'archive': archive, 'output': output_dir, 'jobs': jobs, 'status': 'failed',
+                  'error': '%s: %s' % (type(e).__name__, e), 'seconds': time.time() - start}
+    result['name'] = name
+    results.put(result)
+
+def run_batch(archives, output, boards, mono = False, calib_flags = 0, jobs = 1, corner_cache = True):
+    """
+    Calibrate from each of archives, on at most jobs worker processes in total. Archives are
+    started while workers are free, those started together sharing the free workers equally, so
+    up to jobs archives are calibrated at the same time. The results of an archive go to their own
+    directory in output, named after it (see result_name), and a failing archive does not stop the
+    others. Returns the summary of the run, also written to output/summary.json.
+    """
+    start = time.time()
+    jobs = jobs or multiprocessing.cpu_count()
+
+    taken = set()
+    waiting = []
+    for archive in archives:
+        name = result_name(archive, taken)
+        taken.add(name)
+        waiting.append((name, archive))
+    order = dict((name, i) for (i, (name, _)) in enumerate(waiting))
+
+    # Archives are calibrated in their own (non-daemonic) processes, which can have detection workers
+    results = multiprocessing.Queue()
+    # name -> (process, archive, output directory, workers, start time)
+    running = {}
+    done = []
+    while waiting or running:
+        free = jobs - sum(archive_jobs for (_, _, _, archive_jobs, _) in running.values())
+        starting = min(len(waiting), free)
+        for i in range(starting):
+            (name, archive) = waiting.pop(0)
+            output_dir = os.path.join(output, name)
+            archive_jobs = free // starting + (1 if i < free % starting else 0)
+            process = multiprocessing.Process(target=_archive_process,
+                                              args=(results, name, archive, output_dir, boards, mono, calib_flags,
+                                                    archive_jobs, corner_cache))
+            process.start()
+            running[name] = (process, archive, output_dir, archive_jobs, time.time())
+        try:
+            result = results.get(timeout=1.0)
+        except queue.Empty:
+            # A process dying without reporting, e.g. killed, fails its archive
+            for (name, (process, archive, output_dir, archive_jobs, started)) in list(running.items()):
+                if not process.is_alive() and results.empty():
+                    process.join()
+                    del running[name]
+                    done.append({'name': name, 'archive': archive, 'output': output_dir, 'jobs': archive_jobs,
+                                 'status': 'failed', 'error': 'worker exited with code %s' % process.exitcode,
+                                 'seconds': time.time() - started})
+            continue
+        running.pop(result['name'])[0].join()
+        done.append(result)
+        print("%s: %s%s" % (result['archive'], result['status'],
+                            ", RMS %.4f px" % result['rms'] if 'rms' in result else ": " + result.get('error', '')))
+
+    done.sort(key=lambda result: order[result['name']])
+    summary = {'archives': done,
+               'succeeded': len([r for r in done if r['status'] == 'ok']),
+               'failed': len([r for r in done if r['status'] != 'ok']),
+               'jobs': jobs,
+               'seconds': time.time() - start}
+    if not os.path.isdir(output):
+        os.makedirs(output)
+    with open(os.path.join(output, 'summary.json'), 'w') as f:
+        json.dump(summary, f, indent=2, sort_keys=True)
+    return summary
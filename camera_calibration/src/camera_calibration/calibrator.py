@@ -32,21 +32,29 @@
 # ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
-try:
-    from cStringIO import StringIO
-except ImportError:
-    from io import StringIO
-from io import BytesIO
+import collections
 import cv2
 import cv_bridge
+import functools
 import image_geometry
 import math
+import multiprocessing
+import multiprocessing.pool
 import numpy.linalg
+import os
 import pickle
 import random
 import sensor_msgs.msg
+import sys
 import tarfile
+import threading
 import time
+import zipfile
+from camera_calibration.archive_reader import ArchiveReader, is_zip_archive
+from camera_calibration.archive_writer import ArchiveWriter
+from camera_calibration.corner_cache import CornerCache
+from camera_calibration.lazy_image import BayerMono, CompressedMono, LazyMono, full_image
+from camera_calibration.sample_store import ImageStorage, SampleStore
 from distutils.version import LooseVersion
 
 
@@ -65,19 +73,19 @@ class ChessboardInfo(object):
         self.dim = dim
 
 # Make all private!!!!!
-def lmin(seq1, seq2):
-    """ Pairwise minimum of two sequences """
-    return [min(a, b) for (a, b) in zip(seq1, seq2)]
-
-def lmax(seq1, seq2):
-    """ Pairwise maximum of two sequences """
-    return [max(a, b) for (a, b) in zip(seq1, seq2)]
-
 def _pdist(p1, p2):
     """
-    Distance bwt two points. p1 = (x, y), p2 = (x, y)
+    Distance bwt two points. p1 = (x, y), p2 = (x, y), or bwt the matching points of two arrays
+    of shape (..., 2)
     """
-    return math.sqrt(math.pow(p1[0] - p2[0], 2) + math.pow(p1[1] - p2[1], 2))
+    # Differences in the points' own type, squares and sum in double, as math.pow does
+    d = numpy.subtract(p1, p2).astype(numpy.float64)
+    return numpy.sqrt(d[..., 0] ** 2 + d[..., 1] ** 2)
+
+def _within_border(corners, width, height, border = 8):
+    """ True if all the corners are more than border pixels away from the edges of the image """
+    return bool(numpy.all((border < corners[:, 0, 0]) & (corners[:, 0, 0] < width - border) &
+                          (border < corners[:, 0, 1]) & (corners[:, 0, 1] < height - border)))
 
 def _get_outside_corners(corners, board):
     """
@@ -132,6 +140,63 @@ def _get_area(corners, board):
     q = a + b
     return abs(p[0]*q[1] - p[1]*q[0]) / 2.
 
+def _get_grid_edges(corners, board):
+    """
+    Return the vectors between horizontally and vertically neighbouring corners of a chessboard
+    detection, as arrays of shape (n_rows, n_cols - 1, 2) and (n_rows - 1, n_cols, 2).
+    """
+    grid = corners.reshape(board.n_rows, board.n_cols, 2)
+    return (grid[:, 1:] - grid[:, :-1], grid[1:] - grid[:-1])
+
+def _get_spacing(corners, board):
+    """ Return the smallest distance between neighbouring corners of a chessboard detection """
+    (horizontal, vertical) = _get_grid_edges(corners, board)
+    return min(numpy.min(numpy.linalg.norm(horizontal, axis = 2)),
+               numpy.min(numpy.linalg.norm(vertical, axis = 2)))
+
+def _get_cell_orientation(horizontal, vertical):
+    """
+    Cross product of the top and left edges of every cell of the grid, its sign tells whether
+    the cell is seen from the front or mirrored.
+    """
+    top = horizontal[:-1]
+    left = vertical[:, :-1]
+    return top[:, :, 0] * left[:, :, 1] - top[:, :, 1] * left[:, :, 0]
+
+def _downsample_scale(width, height, pixels = 640 * 480):
+    """
+    Factor by which downsample_and_detect scales an image of the given size down to about pixels
+    pixels, ~VGA by default
+    """
+    return math.sqrt( (width*height) / float(pixels) )
+
+def _scale_corners(corners, from_shape, to_shape):
+    """
+    Return corners found in an image of shape from_shape moved to the same image resized to
+    to_shape, pixel centers staying aligned as with cv2.resize.
+    """
+    scaled = corners.copy()
+    for (axis, dimension) in [(0, 1), (1, 0)]:
+        factor = float(to_shape[dimension]) / from_shape[dimension]
+        scaled[:, :, axis] = (scaled[:, :, axis] + 0.5) * factor - 0.5
+    return scaled
+
+def _get_refine_radius(corners, board):
+    """
+    Radius of the cornerSubPix search window for a fresh chessboard detection
+    """
+    # Use a radius of half the minimum distance between corners. This should be large enough to snap to the
+    # correct corner, but not so large as to include a wrong corner in the search window.
+    # The rows start every n_rows corners here, not every n_cols: kept as is, it sets the radius
+    # every detection so far was refined with.
+    rows = numpy.arange(board.n_rows)[:, numpy.newaxis] * board.n_rows
+    horizontal = (rows + numpy.arange(board.n_cols - 1)).ravel()
+    vertical = (rows[:-1] + numpy.arange(board.n_cols)).ravel()
+    distances = numpy.concatenate((_pdist(corners[horizontal, 0], corners[horizontal + 1, 0]),
+                                   _pdist(corners[vertical, 0], corners[vertical + board.n_cols, 0])))
+    min_distance = distances.min() if distances.size else float("inf")
+    return int(math.ceil(min_distance * 0.5))
+
 def _get_corners(img, board, refine = True, checkerboard_flags=0):
     """
     Get corners for a particular chessboard for an image
@@ -151,7 +216,7 @@ def _get_corners(img, board, refine = True, checkerboard_flags=0):
     # NOTE: This may cause problems with very low-resolution cameras, where 8 pixels is a non-negligible fraction
     # of the image size. See http://answers.ros.org/question/3155/how-can-i-calibrate-low-resolution-cameras
     BORDER = 8
-    if not all([(BORDER < corners[i, 0, 0] < (w - BORDER)) and (BORDER < corners[i, 0, 1] < (h - BORDER)) for i in range(corners.shape[0])]):
+    if not _within_border(corners, w, h, BORDER):
         ok = False
 
     # Ensure that all corner-arrays are going from top to bottom.
@@ -170,18 +235,7 @@ def _get_corners(img, board, refine = True, checkerboard_flags=0):
                 corners=numpy.rot90(corners.reshape(board.n_rows,board.n_cols,2),3).reshape(board.n_cols*board.n_rows,1,2)
 
     if refine and ok:
-        # Use a radius of half the minimum distance between corners. This should be large enough to snap to the
-        # correct corner, but not so large as to include a wrong corner in the search window.
-        min_distance = float("inf")
-        for row in range(board.n_rows):
-            for col in range(board.n_cols - 1):
-                index = row*board.n_rows + col
-                min_distance = min(min_distance, _pdist(corners[index, 0], corners[index + 1, 0]))
-        for row in range(board.n_rows - 1):
-            for col in range(board.n_cols):
-                index = row*board.n_rows + col
-                min_distance = min(min_distance, _pdist(corners[index, 0], corners[index + board.n_cols, 0]))
-        radius = int(math.ceil(min_distance * 0.5))
+        radius = _get_refine_radius(corners, board)
         cv2.cornerSubPix(mono, corners, (radius,radius), (-1,-1),
                                       ( cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.1 ))
 
@@ -212,6 +266,147 @@ def _get_circles(img, board, pattern):
 
     return (ok, corners)
 
+# Small thread pool shared by all calibrators to process the two images of a stereo pair at the
+# same time. OpenCV releases the GIL, so the detections do run concurrently.
+_pair_pool = None
+_pair_pool_lock = threading.Lock()
+
+def _map_pair(function, left, right):
+    """
+    Return [function(left), function(right)], both computed concurrently: the left one on the
+    shared pool, the right one in the calling thread.
+    """
+    global _pair_pool
+    with _pair_pool_lock:
+        if _pair_pool is None:
+            _pair_pool = multiprocessing.pool.ThreadPool(2)
+    left_result = _pair_pool.apply_async(function, (left,))
+    right_result = function(right)
+    return [left_result.get(), right_result]
+
+class _MapCache(object):
+    """ Least recently used rectification maps, see Calibrator.rectification_maps """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._maps = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, compute):
+        """ Return the maps stored under key, computing them with compute() if missing """
+        with self._lock:
+            maps = self._maps.pop(key, None)
+            if maps is not None:
+                self._maps[key] = maps
+                return maps
+        maps = compute()
+        with self._lock:
+            self._maps[key] = maps
+            while len(self._maps) > max(1, self.maxsize):
+                self._maps.popitem(last = False)
+        return maps
+
+def _msg_array(msg, dtype, channels = 1):
+    """
+    View the data of a sensor_msgs/Image as an array of shape (height, width[, channels]) without
+    copying it, honouring msg.step and msg.is_bigendian. The view is read-only.
+    """
+    data = msg.data
+    if isinstance(data, (list, tuple)):
+        data = bytearray(data)
+    dtype = numpy.dtype(dtype).newbyteorder('>' if msg.is_bigendian else '<')
+    shape = (msg.height, msg.width, channels)
+    strides = (msg.step, dtype.itemsize * channels, dtype.itemsize)
+    arr = numpy.ndarray(shape, dtype, buffer = data, strides = strides)
+    arr.flags.writeable = False
+    if channels == 1:
+        arr = arr[:, :, 0]
+    return arr
+
+def _no_progress(fraction):
+    pass
+
+class LiveEstimate(object):
+    """
+    Interim intrinsics of a camera, solved in the background from the first samples of the
+    database, see Calibrator.update_live_estimate
+    """
+    def __init__(self, samples, rms, intrinsics, distortion, std_deviations):
+        self.samples = samples
+        # RMS reprojection error, in pixels
+        self.rms = rms
+        self.intrinsics = intrinsics
+        self.distortion = distortion
+        # Standard deviations of (fx, fy, cx, cy, distortion...), None if OpenCV cannot estimate them
+        self.std_deviations = std_deviations
+
+def _estimate_intrinsics(opts, ipts, size, flags, previous = None):
+    """
+    Solve the intrinsics with cv2.calibrateCamera, starting from the previous LiveEstimate if any.
+    Returns a LiveEstimate.
+    """
+    # OpenCV's default termination criteria: from a good guess, most of these iterations barely move
+    criteria = (cv2.TERM_CRITERIA_COUNT + cv2.TERM_CRITERIA_EPS, 30, sys.float_info.epsilon)
+    if previous is None:
+        intrinsics = numpy.zeros((3, 3), numpy.float64)
+        if flags & cv2.CALIB_RATIONAL_MODEL:
+            distortion = numpy.zeros((8, 1), numpy.float64) # rational polynomial
+        else:
+            distortion = numpy.zeros((5, 1), numpy.float64) # plumb bob
+        # If FIX_ASPECT_RATIO flag set, enforce focal lengths have 1/1 ratio
+        intrinsics[0,0] = 1.0
+        intrinsics[1,1] = 1.0
+    else:
+        intrinsics = previous.intrinsics.copy()
+        distortion = previous.distortion.copy()
+        flags |= cv2.CALIB_USE_INTRINSIC_GUESS
+        # Stop once the solution moves less than this, usually after a few iterations
+        criteria = (cv2.TERM_CRITERIA_COUNT + cv2.TERM_CRITERIA_EPS, 30, 1e-6)
+    if hasattr(cv2, 'calibrateCameraExtended'):
+        rv = cv2.calibrateCameraExtended(opts, ipts, size, intrinsics, distortion, flags = flags, criteria = criteria)
+        (rms, std_deviations) = (rv[0], rv[5].ravel())
+    else:
+        rv = cv2.calibrateCamera(opts, ipts, size, intrinsics, distortion, flags = flags, criteria = criteria)
+        (rms, std_deviations) = (rv[0], None)
+    return LiveEstimate(len(ipts), rms, intrinsics, distortion, std_deviations)
+
+# Detector owned by each worker process of Calibrator._parallel_detect. It is built once per
+# worker by _pool_init, so that only images and corners have to cross process boundaries.
+_pool_calibrator = None
+
+def _pool_init(boards, settings):
+    global _pool_calibrator
+    _pool_calibrator = Calibrator(boards, **settings)
+
+def _pool_board_index(board):
+    """ Boards are returned by index, the parent process maps them back to its own instances """
+    if board is None:
+        return None
+    return _pool_calibrator._boards.index(board)
+
+def _pool_get_corners(img):
+    (ok, corners, board) = _pool_calibrator.get_corners(img)
+    return (ok, corners, _pool_board_index(board))
+
+def _pool_downsample_and_detect(img):
+    (_, corners, _, board, _, _) = _pool_calibrator.downsample_and_detect(img)
+    return (corners, _pool_board_index(board))
+
+def _pool_detect_file(args):
+    (data, downsample) = args
+    (corners, board, size) = _detect_file(_pool_calibrator, data, downsample)
+    return (corners, _pool_board_index(board), size)
+
+class _Done(object):
+    """ Result already known, with the interface of the AsyncResult of a pool """
+    def __init__(self, value):
+        self.value = value
+
+    def ready(self):
+        return True
+
+    def get(self):
+        return self.value
+
 
 # TODO self.size needs to come from CameraInfo, full resolution
 class Calibrator(object):
@@ -219,7 +414,12 @@ class Calibrator(object):
     Base class for calibration system
     """
     def __init__(self, boards, flags=0, pattern=Patterns.Chessboard, name='', 
-    checkerboard_flags=cv2.CALIB_CB_FAST_CHECK, max_chessboard_speed = -1.0):
+    checkerboard_flags=cv2.CALIB_CB_FAST_CHECK, max_chessboard_speed = -1.0, jobs = 1,
+    roi_tracking = False, flow_tracking = False, redetect_interval = 10,
+    image_storage = ImageStorage.Memory, memory_budget = None, live_interval = 0,
+    fixed_point_maps = False, map_cache_size = 4, save_format = 'tar', save_compression = '',
+    save_compression_level = None, lazy_refinement = False, pyramid_detection = False,
+    min_sharpness = 0.0, max_frame_difference = -1.0):
         # Ordering the dimensions for the different detectors is actually a minefield...
         if pattern == Patterns.Chessboard:
             # Make sure n_cols > n_rows to agree with OpenCV CB detector output
@@ -240,8 +440,9 @@ class Calibrator(object):
 
         # self.db is list of (parameters, image) samples for use in calibration. parameters has form
         # (X, Y, size, skew) all normalized to [0,1], to keep track of what sort of samples we've taken
-        # and ensure enough variety.
-        self.db = []
+        # and ensure enough variety. Past the memory budget (in bytes), images are stored as requested
+        # by image_storage, see SampleStore.
+        self.db = SampleStore(image_storage, memory_budget)
         # For each db sample, we also record the detected corners.
         self.good_corners = []
         # Set to true when we have sufficiently varied samples to calibrate
@@ -250,10 +451,141 @@ class Calibrator(object):
         self.name = name
         self.last_frame_corners = None
         self.max_chessboard_speed = max_chessboard_speed
+        # Number of worker processes used to detect corners in a batch of images (offline calibration).
+        # 0 means one per CPU.
+        self.jobs = jobs or multiprocessing.cpu_count()
+        # When tracking, live detection first searches around the previous detection of the same stream
+        self.roi_tracking = roi_tracking
+        # When tracking, live detection propagates the previous corners with optical flow, and only
+        # runs the full detector every redetect_interval frames or when the propagation looks wrong.
+        # Propagated corners are only refined at full resolution if the frame becomes a sample.
+        self.flow_tracking = flow_tracking
+        self.redetect_interval = redetect_interval
+        # When lazy, live detection keeps the corners found in the downsampled image, scaled up, and
+        # only refines them in the full-resolution image for the frames that become samples. Compressed
+        # and raw Bayer images are always refined lazily, see _refine_live.
+        self.lazy_refinement = lazy_refinement
+        # With pyramid detection, chessboards in images of at least twice VGA resolution are searched
+        # in a pyramid of halved images, at the level where the board last appeared with a corner
+        # spacing of about _pyramid_min_spacing pixels, then refined level after level. Finer levels
+        # are searched when the board is lost, on every redetect_interval-th frame of a live stream.
+        self.pyramid_detection = pyramid_detection
+        # Corner spacing, in full-resolution pixels, of the last live pyramid detection, None if lost
+        self._board_spacing = None
+        # Number of live frames in a row where pyramid detection missed the chessboard
+        self._pyramid_misses = 0
+        # Live frames are not searched for the target if they look blurred, the variance of the
+        # Laplacian of their downsampled image being below min_sharpness, or moving, the mean
+        # absolute difference with the previous downsampled frame being above max_frame_difference
+        # gray levels (negative to disable)
+        self.min_sharpness = min_sharpness
+        self.max_frame_difference = max_frame_difference
+        self._last_scrib = None
+        # Number of pixels of the downsampled images, see set_detection_resolution
+        self.detection_pixels = 640 * 480
+        # Whether the corners of all the samples are those found offline in their saved images,
+        # see _offline_corners. do_save then also saves them, see _samples_corner_cache.
+        self._offline_samples = True
+        # (scrib, downsampled corners, board, frames since last full detection) of the last tracked
+        # detection, None if the target was lost
+        self._tracked = None
+        # Counters describing the work done by the detector (e.g. roi_hits, roi_misses)
+        self.detection_stats = collections.Counter()
+        # Re-solve the calibration in the background every live_interval new samples (0 to disable).
+        # live_estimate holds the last solution, computed from live_samples samples.
+        self.live_interval = live_interval
+        self.live_estimate = None
+        self.live_samples = 0
+        self._live_pool = None
+        self._live_job = None
+        self._live_lock = threading.Lock()
+        # score adds no samples while do_calibration solves from a snapshot of them
+        self._calibrating = False
+        self._samples_lock = threading.Lock()
+        # Rectification maps for the last map_cache_size (calibration, alpha, size), as CV_16SC2
+        # fixed-point maps if fixed_point_maps, which take less memory and remap faster
+        self.fixed_point_maps = fixed_point_maps
+        self._map_cache = _MapCache(map_cache_size)
+        # do_save writes a zipfile of uncompressed files if save_format is 'zip', else a tarfile,
+        # uncompressed or compressed with the tarfile codec save_compression ('gz', 'bz2' or 'xz')
+        # at save_compression_level if given
+        self.save_format = save_format
+        self.save_compression = save_compression
+        self.save_compression_level = save_compression_level
+
+    # (channels, conversion to gray) of the color encodings mkgray reads without cv_bridge
+    _color_encodings = {'bgr8': (3, cv2.COLOR_BGR2GRAY),
+                        'rgb8': (3, cv2.COLOR_RGB2GRAY),
+                        'bgra8': (4, cv2.COLOR_BGRA2GRAY),
+                        'rgba8': (4, cv2.COLOR_RGBA2GRAY)}
+
+    # Bayer pattern of the raw encodings mkbayer reads, see BayerMono
+    _bayer_encodings = {'bayer_rggb8': 'rggb',
+                        'bayer_bggr8': 'bggr',
+                        'bayer_gbrg8': 'gbrg',
+                        'bayer_grbg8': 'grbg'}
+
+    # Corner spacing, in pixels, of the chessboard at the level where pyramid detection searches it
+    _pyramid_min_spacing = 20.0
+
+    def mkbayer(self, msg):
+        """ Return a message in one of the _bayer_encodings as a BayerMono, without copying it """
+        return BayerMono(_msg_array(msg, numpy.uint8), self._bayer_encodings[msg.encoding])
 
     def mkgray(self, msg):
         """
         Convert a message into a 8-bit 1 channel monochrome OpenCV image
+
+        The common encodings are read in place from the message data (8-bit Bayer ones being
+        demosaiced), the others go through cv_bridge. mono8 and 8UC1 images are returned as a
+        read-only view of msg.data, copy them before writing. detection_stats counts the bytes
+        copied in mkgray_bytes_copied.
+        """
+        # Data given as a list is first copied into a buffer, see _msg_array
+        copied = len(msg.data) if isinstance(msg.data, (list, tuple)) else 0
+        if isinstance(msg, sensor_msgs.msg.CompressedImage):
+            mono8 = CompressedMono(msg).full()
+            copied += mono8.nbytes
+        elif msg.encoding in ['mono8', '8UC1']:
+            mono8 = _msg_array(msg, numpy.uint8)
+        elif msg.encoding in ['mono16', '16UC1']:
+            # The high byte of each pixel is mono16 / 256, without any temporary
+            high_byte = 0 if msg.is_bigendian else 1
+            mono8 = numpy.ascontiguousarray(_msg_array(msg, numpy.uint8, 2)[:, :, high_byte])
+            copied += mono8.nbytes
+        elif msg.encoding in self._bayer_encodings:
+            mono8 = self.mkbayer(msg).full()
+            copied += mono8.nbytes
+        elif msg.encoding in self._color_encodings:
+            (channels, code) = self._color_encodings[msg.encoding]
+            mono8 = cv2.cvtColor(_msg_array(msg, numpy.uint8, channels), code)
+            copied += mono8.nbytes
+        elif msg.encoding == '32FC1':
+            img = _msg_array(msg, numpy.float32)
+            if not img.dtype.isnative:
+                img = img.astype(numpy.float32)
+                copied += img.nbytes
+            _, max_val, _, _ = cv2.minMaxLoc(img)
+            if max_val > 0:
+                # Truncated like cv_bridge, negative values going to 0
+                scaled = img * (255.0 / max_val)
+                numpy.maximum(scaled, 0, out = scaled)
+                mono8 = scaled.astype(numpy.uint8)
+                copied += scaled.nbytes
+            else:
+                mono8 = numpy.zeros(img.shape, numpy.uint8)
+            copied += mono8.nbytes
+        else:
+            mono8 = self.mkgray_bridge(msg)
+            copied = len(msg.data) + mono8.nbytes
+            self.detection_stats['mkgray_bridge'] += 1
+        self.detection_stats['mkgray_frames'] += 1
+        self.detection_stats['mkgray_bytes_copied'] += copied
+        return mono8
+
+    def mkgray_bridge(self, msg):
+        """
+        Convert a message into a 8-bit 1 channel monochrome OpenCV image with cv_bridge
         """
         # as cv_bridge automatically scales, we need to remove that behavior
         # TODO: get a Python API in cv_bridge to check for the image depth.
@@ -313,11 +645,8 @@ class Calibrator(object):
         if not self.db:
             return True
 
-        def param_distance(p1, p2):
-            return sum([abs(a-b) for (a,b) in zip(p1, p2)])
-
-        db_params = [sample[0] for sample in self.db]
-        d = min([param_distance(params, p) for p in db_params])
+        # Smallest L1 distance to the samples in the database
+        d = self.db.nearest_distance(params)
         #print "d = %.3f" % d #DEBUG
         # TODO What's a good threshold here? Should it be configurable?
         if d <= 0.2:
@@ -336,13 +665,8 @@ class Calibrator(object):
         if not self.db:
             return None
 
-        # Find range of checkerboard poses covered by samples in database
-        all_params = [sample[0] for sample in self.db]
-        min_params = all_params[0]
-        max_params = all_params[0]
-        for params in all_params[1:]:
-            min_params = lmin(min_params, params)
-            max_params = lmax(max_params, params)
+        # Find range of checkerboard poses covered by samples in database, kept up to date by the database
+        (min_params, max_params) = self.db.param_range()
         # Don't reward small size or skew
         min_params = [min_params[0], min_params[1], 0., 0.]
 
@@ -359,15 +683,15 @@ class Calibrator(object):
         for i, b in enumerate(boards):
             num_pts = b.n_cols * b.n_rows
             opts_loc = numpy.zeros((num_pts, 1, 3), numpy.float32)
-            for j in range(num_pts):
-                opts_loc[j, 0, 0] = (j / b.n_cols)
-                if self.pattern == Patterns.ACircles:
-                    opts_loc[j, 0, 1] = 2*(j % b.n_cols) + (opts_loc[j, 0, 0] % 2)
-                else:
-                    opts_loc[j, 0, 1] = (j % b.n_cols)
-                opts_loc[j, 0, 2] = 0
-                if use_board_size:
-                    opts_loc[j, 0, :] = opts_loc[j, 0, :] * b.dim
+            j = numpy.arange(num_pts)
+            # Same division as the scalar j / n_cols: floored on python 2, true division on python 3
+            opts_loc[:, 0, 0] = j / b.n_cols
+            if self.pattern == Patterns.ACircles:
+                opts_loc[:, 0, 1] = 2*(j % b.n_cols) + (opts_loc[:, 0, 0] % 2)
+            else:
+                opts_loc[:, 0, 1] = j % b.n_cols
+            if use_board_size:
+                opts_loc *= b.dim
             opts.append(opts_loc)
         return opts
 
@@ -390,7 +714,235 @@ class Calibrator(object):
                 return (ok, corners, b)
         return (False, None, None)
 
-    def downsample_and_detect(self, img):
+    def detector_settings(self):
+        """
+        Return the keyword arguments of the constructor that change the result of corner
+        detection, so that an equivalent detector can be rebuilt elsewhere.
+        """
+        settings = {'pattern': self.pattern, 'checkerboard_flags': self.checkerboard_flags}
+        if self.pyramid_detection:
+            settings['pyramid_detection'] = True
+        return settings
+
+    def _parallel_detect(self, function, images):
+        """
+        Apply one of the _pool_* detection functions to every image on a pool of self.jobs
+        worker processes. Results are returned in the order of the images.
+        """
+        pool = multiprocessing.Pool(min(self.jobs, len(images)), _pool_init,
+                                    (self._boards, self.detector_settings()))
+        try:
+            results = pool.map(function, images, chunksize = 1)
+        finally:
+            pool.terminate()
+            pool.join()
+        return results
+
+    def corner_cache_settings(self, downsample):
+        """
+        Return the settings that the corners of a CornerCache depend on: the detector settings,
+        the boards, whether the corners come from downsample_and_detect or get_corners, and the
+        resolution downsample_and_detect detects at if not the default one.
+        """
+        settings = dict(self.detector_settings())
+        settings['boards'] = [[b.n_cols, b.n_rows, b.dim] for b in self._boards]
+        settings['detect'] = 'downsample_and_detect' if downsample else 'get_corners'
+        if downsample and self.detection_pixels != 640 * 480:
+            settings['detection_pixels'] = self.detection_pixels
+        return settings
+
+    def _archive_corners(self, filename, prefixes, downsample, cache = None):
+        """
+        Generate (prefix, corners, board, size) for the images of an archive whose name starts
+        with one of prefixes, in archive order, see _detect_file and _archive_files.
+
+        The archive is read once. Images are decoded and detected one at a time, or a few per
+        worker on a pool of self.jobs processes, and only their corners are kept, so that memory
+        use does not grow with the size of the archive.
+
+        Images found in cache, a CornerCache, are neither decoded nor detected, the others are
+        added to it. detection_stats counts them in corner_cache_hits and corner_cache_misses.
+        """
+        pool = None
+        if self.jobs > 1:
+            pool = multiprocessing.Pool(self.jobs, _pool_init, (self._boards, self.detector_settings()))
+        try:
+            pending = collections.deque()
+            for (prefix, name, data) in _archive_files(filename, prefixes):
+                digest = None
+                cached = None
+                if cache is not None:
+                    digest = CornerCache.digest(data)
+                    cached = cache.get(digest)
+                    self.detection_stats['corner_cache_misses' if cached is None else 'corner_cache_hits'] += 1
+                if cached is not None:
+                    (size, corners, b) = cached
+                    result = _Done((corners, b, size))
+                elif pool is None:
+                    (corners, board, size) = _detect_file(self, data, downsample)
+                    result = _Done((corners, None if board is None else self._boards.index(board), size))
+                else:
+                    result = pool.apply_async(_pool_detect_file, ((data, downsample),))
+                pending.append((prefix, name, digest, result))
+                # Bound the files waiting in memory, while keeping every worker busy
+                while len(pending) > 2 * self.jobs or (pending and pending[0][3].ready()):
+                    yield self._archive_result(pending.popleft(), cache)
+            while pending:
+                yield self._archive_result(pending.popleft(), cache)
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+    def _archive_result(self, pending, cache):
+        (prefix, name, digest, result) = pending
+        (corners, b, size) = result.get()
+        if cache is not None and cache.get(digest) is None:
+            cache.put(name, digest, size, corners, b)
+        return (prefix, corners, None if b is None else self._boards[b], size)
+
+    def _load_corner_cache(self, filename, settings):
+        """
+        Return the CornerCache of an archive for these settings, from its sidecar file (the
+        archive name followed by .corners.npz) if there is one and it is usable, else empty.
+        The archive itself is not opened, which would cost a full pass over a compressed one.
+        """
+        sidecar = filename + '.corners.npz'
+        try:
+            if os.path.exists(sidecar):
+                return CornerCache.load(sidecar, settings)
+        except Exception as e:
+            # e.g. a truncated or corrupt file
+            print("Ignoring the corner cache of %s: %s" % (filename, e))
+        return CornerCache(settings)
+
+    def _save_corner_cache(self, filename, cache):
+        """ Write the sidecar file of a tar archive if new corners were added to cache """
+        if not cache.modified:
+            return
+        try:
+            cache.save(filename + '.corners.npz')
+        except (IOError, OSError) as e:
+            print("Could not save the corner cache of %s: %s" % (filename, e))
+
+    def _board_index(self, board):
+        """ Return the index in self._boards of a board, which may come from a calibrator with the same boards """
+        return [(b.n_cols, b.n_rows, b.dim) for b in self._boards].index((board.n_cols, board.n_rows, board.dim))
+
+    def _samples_corner_cache(self):
+        """
+        Return an empty CornerCache, with the settings of do_tarfile_calibration, for the corners
+        of the samples, which were detected live. None if the corners are not those of the samples,
+        or not those that do_tarfile_calibration would find in the saved images, see
+        _offline_corners.
+        """
+        if len(self.good_corners) != len(self.db) or not self._offline_samples:
+            return None
+        return CornerCache(self.corner_cache_settings(not self.is_mono))
+
+    def _offline_corners(self, img, detection, downsample):
+        """
+        Return whether the corners of a live detection of img, by downsample_and_detect, are
+        those that detection in the saved image finds offline, with downsample_and_detect if
+        downsample else with get_corners. They are not if the frame was tracked, searched in the
+        pyramid, or downsampled at another resolution or from a reduced decoding (see LazyMono).
+        """
+        if self.roi_tracking or self.flow_tracking:
+            return False
+        if self.pattern != Patterns.Chessboard:
+            # Circle grids are always detected in the full image
+            return True
+        (height, width) = img.shape[:2]
+        scale = _downsample_scale(width, height)
+        if scale <= 1.0:
+            # Searched in the full image, as get_corners does
+            return detection[0].shape[:2] == (height, width)
+        if not downsample or isinstance(img, LazyMono) or (self.pyramid_detection and scale >= 2.0):
+            return False
+        return detection[0].shape[:2] == (int(height / scale), int(width / scale))
+
+    def get_detection_stats(self):
+        """ Return a copy of the detection counters """
+        return collections.Counter(self.detection_stats)
+
+    def _propagate_corners(self, scrib):
+        """
+        Move the corners of the last tracked detection to the new downsampled image with pyramidal
+        Lucas-Kanade. Returns None if the result does not look like the same chessboard.
+        """
+        (prev_scrib, prev_corners, board, _) = self._tracked
+        if prev_scrib.shape != scrib.shape:
+            return None
+        (prev_horizontal, prev_vertical) = _get_grid_edges(prev_corners, board)
+        spacing = _get_spacing(prev_corners, board)
+        radius = int(math.ceil(spacing * 0.5))
+        (corners, status, _) = cv2.calcOpticalFlowPyrLK(prev_scrib, scrib, prev_corners, None,
+                                                        winSize = (2 * radius + 1, 2 * radius + 1), maxLevel = 3,
+                                                        criteria = ( cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.01 ))
+        if corners is None or not numpy.all(status):
+            return None
+
+        # Same tests as a fresh detection: stay away from the image border...
+        (height, width) = scrib.shape[:2]
+        if not _within_border(corners, width, height):
+            return None
+        # ...and keep the grid geometry: the edges between neighbouring corners deform only slightly
+        # between frames, and no cell flips over.
+        (horizontal, vertical) = _get_grid_edges(corners, board)
+        for (edges, prev_edges) in [(horizontal, prev_horizontal), (vertical, prev_vertical)]:
+            change = numpy.linalg.norm(edges - prev_edges, axis = 2)
+            if numpy.any(change > 0.2 * numpy.linalg.norm(prev_edges, axis = 2) + 1.0):
+                return None
+        orientation = numpy.sign(_get_cell_orientation(horizontal, vertical))
+        prev_orientation = numpy.sign(_get_cell_orientation(prev_horizontal, prev_vertical))
+        if numpy.any(orientation != prev_orientation):
+            return None
+
+        # Snap back to the corners so that the flow error does not accumulate
+        cv2.cornerSubPix(scrib, corners, (radius, radius), (-1,-1),
+                         ( cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.1 ))
+        return corners
+
+    def _get_corners_tracked(self, scrib):
+        """
+        Detect the chessboard in the downsampled image, using the last tracked detection if any.
+        The corners are either propagated with optical flow, or searched only in a padded bounding
+        box around the last detection, falling back to the whole image on a miss.
+
+        Returns (ok, corners, board, propagated).
+        """
+        if self.flow_tracking and self._tracked is not None:
+            if self._tracked[3] >= self.redetect_interval:
+                # Scheduled full detection, not a tracking failure
+                self.detection_stats['flow_redetects'] += 1
+            else:
+                corners = self._propagate_corners(scrib)
+                if corners is not None:
+                    self.detection_stats['flow_hits'] += 1
+                    return (True, corners, self._tracked[2], True)
+                self.detection_stats['flow_misses'] += 1
+
+        if self.roi_tracking and self._tracked is not None and self._tracked[0].shape == scrib.shape:
+            (height, width) = scrib.shape[:2]
+            (x, y, w, h) = cv2.boundingRect(self._tracked[1])
+            # The board may move and grow between frames: pad by half its extent
+            pad = max(w, h) // 2 + 16
+            x0 = max(0, x - pad)
+            y0 = max(0, y - pad)
+            x1 = min(width, x + w + pad)
+            y1 = min(height, y + h + pad)
+            # Not worth it if the region covers most of the image anyway
+            if (x1 - x0) * (y1 - y0) < 0.7 * width * height:
+                (ok, corners, board) = self.get_corners(scrib[y0:y1, x0:x1], refine = True)
+                if ok:
+                    self.detection_stats['roi_hits'] += 1
+                    corners[:, :, 0] += x0
+                    corners[:, :, 1] += y0
+                    return (ok, corners, board, False)
+                self.detection_stats['roi_misses'] += 1
+        return self.get_corners(scrib, refine = True) + (False,)
+
+    def downsample_and_detect(self, img, track = False, refine = True):
         """
         Downsample the input image to approximately VGA resolution and detect the
         calibration target corners in the full-size image.
@@ -399,46 +951,75 @@ class Calibrator(object):
         detection is too expensive on large images, so it's better to do detection on
         the smaller display image and scale the corners back up to the correct size.
 
-        Returns (scrib, corners, downsampled_corners, board, (x_scale, y_scale)).
+        If track is True, the image is considered the next frame of a live stream, and the
+        detection may use and update the state kept from the previous frames.
+
+        img may be a LazyMono, in which case the full-resolution image is only decoded if the
+        target is found, for sub-pixel refinement. If refine is False, the chessboard corners
+        are only scaled up, and neither decoded nor refined until refine_corners is called. So
+        are the corners propagated by flow tracking, already refined in the downsampled image.
+
+        With pyramid_detection, chessboards in large images are detected by _detect_pyramid
+        instead, the downsampled image only being used for display.
+
+        Returns (scrib, corners, downsampled_corners, board, (x_scale, y_scale), refine_radius),
+        refine_radius being the radius of the full-resolution refinement left to refine_corners,
+        None if the corners need none.
         """
         # Scale the input image down to ~VGA size
         height = img.shape[0]
         width = img.shape[1]
-        scale = math.sqrt( (width*height) / (640.*480.) )
+        scale = _downsample_scale(width, height, self.detection_pixels)
         if scale > 1.0:
-            scrib = cv2.resize(img, (int(width / scale), int(height / scale)))
+            if isinstance(img, LazyMono):
+                scrib = img.resized((int(width / scale), int(height / scale)))
+            else:
+                scrib = cv2.resize(img, (int(width / scale), int(height / scale)))
         else:
+            img = full_image(img)
             scrib = img
         # Due to rounding, actual horizontal/vertical scaling may differ slightly
         x_scale = float(width) / scrib.shape[1]
         y_scale = float(height) / scrib.shape[0]
 
-        if self.pattern == Patterns.Chessboard:
+        if track and not self._worth_detecting(scrib):
+            return (scrib, None, None, None, (x_scale, y_scale), None)
+
+        refine_radius = None
+        if self.pattern == Patterns.Chessboard and self.pyramid_detection and scale >= 2.0:
+            (corners, downsampled_corners, board, refine_radius) = self._detect_pyramid(img, scrib, track, refine)
+        elif self.pattern == Patterns.Chessboard:
             # Detect checkerboard
-            (ok, downsampled_corners, board) = self.get_corners(scrib, refine = True)
+            if track:
+                (ok, downsampled_corners, board, propagated) = self._get_corners_tracked(scrib)
+                if not ok:
+                    self._tracked = None
+                elif propagated:
+                    self._tracked = (scrib, downsampled_corners, board, self._tracked[3] + 1)
+                else:
+                    self._tracked = (scrib, downsampled_corners, board, 0)
+            else:
+                (ok, downsampled_corners, board) = self.get_corners(scrib, refine = True)
+                propagated = False
 
             # Scale corners back to full size image
             corners = None
             if ok:
                 if scale > 1.0:
-                    # Refine up-scaled corners in the original full-res image
-                    # TODO Does this really make a difference in practice?
-                    corners_unrefined = downsampled_corners.copy()
-                    corners_unrefined[:, :, 0] *= x_scale
-                    corners_unrefined[:, :, 1] *= y_scale
-                    radius = int(math.ceil(scale))
-                    if len(img.shape) == 3 and img.shape[2] == 3:
-                        mono = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+                    corners = downsampled_corners.copy()
+                    corners[:, :, 0] *= x_scale
+                    corners[:, :, 1] *= y_scale
+                    refine_radius = int(math.ceil(scale))
+                    if refine and not propagated:
+                        self._refine_full_size(img, corners, refine_radius)
+                        refine_radius = None
                     else:
-                        mono = img
-                    cv2.cornerSubPix(mono, corners_unrefined, (radius,radius), (-1,-1),
-                                                  ( cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.1 ))
-                    corners = corners_unrefined
+                        self.detection_stats['deferred_refinements'] += 1
                 else:
                     corners = downsampled_corners
         else:
             # Circle grid detection is fast even on large images
-            (ok, corners, board) = self.get_corners(img)
+            (ok, corners, board) = self.get_corners(full_image(img))
             # Scale corners to downsampled image for display
             downsampled_corners = None
             if ok:
@@ -449,7 +1030,166 @@ class Calibrator(object):
                 else:
                     downsampled_corners = corners
 
-        return (scrib, corners, downsampled_corners, board, (x_scale, y_scale))
+        return (scrib, corners, downsampled_corners, board, (x_scale, y_scale), refine_radius)
+
+    def set_detection_resolution(self, fraction):
+        """
+        Downsample images for detection and display to fraction times the VGA resolution, in
+        pixels, e.g. to keep up with the camera under load
+        """
+        self.detection_pixels = int(640 * 480 * fraction)
+
+    def _worth_detecting(self, scrib):
+        """
+        Return whether a live frame, given by its downsampled image, is sharp and still enough to
+        be searched for the target, see min_sharpness and max_frame_difference. The others are
+        counted in detection_stats as blurred_frames and moving_frames.
+        """
+        last_scrib = self._last_scrib
+        self._last_scrib = scrib
+        if self.min_sharpness > 0:
+            (_, deviation) = cv2.meanStdDev(cv2.Laplacian(scrib, cv2.CV_16S))
+            if deviation[0, 0] ** 2 < self.min_sharpness:
+                self.detection_stats['blurred_frames'] += 1
+                return False
+        if self.max_frame_difference >= 0 and last_scrib is not None and last_scrib.shape == scrib.shape:
+            if cv2.norm(scrib, last_scrib, cv2.NORM_L1) / scrib.size > self.max_frame_difference:
+                self.detection_stats['moving_frames'] += 1
+                return False
+        return True
+
+    def _pyramid_levels(self, width, height, track):
+        """
+        Return the pyramid levels where _detect_pyramid searches the chessboard in an image of the
+        given size, in order. Level n is the image halved n times.
+        """
+        # The base level is the smallest at least as large as VGA, the coarsest one below it is
+        # for close boards and the finest, two levels above the base, for far ones
+        base = int(math.floor(math.log(_downsample_scale(width, height, self.detection_pixels), 2)))
+        finest = max(1, base - 2)
+        coarsest = base + 1
+        first = base
+        if track and self._board_spacing is not None:
+            spacing = max(self._board_spacing / self._pyramid_min_spacing, 1.0)
+            first = min(coarsest, max(finest, int(math.floor(math.log(spacing, 2)))))
+        levels = [first] + [level for level in range(coarsest, finest - 1, -1) if level != first]
+        if track and self.redetect_interval > 0 and self._pyramid_misses % self.redetect_interval:
+            # Searching the finer levels of every frame without a chessboard would be too slow
+            levels = [level for level in levels if level >= min(first, base)]
+        return levels
+
+    def _pyramid_image(self, img, level, levels):
+        """
+        Return img at pyramid level level, at least 1. levels holds the images of the levels
+        already built for img: a new level is reduced from the closest finer one, else read from
+        the reduced decoding of a LazyMono, else halved level after level from the full image,
+        which is much faster than reducing it at once.
+        """
+        if level not in levels:
+            size = (img.shape[1] >> level, img.shape[0] >> level)
+            finer = [built for built in levels if built < level]
+            if finer:
+                source = levels[max(finer)]
+            elif isinstance(img, LazyMono):
+                source = img.resized(size)
+            elif level > 1:
+                source = self._pyramid_image(img, level - 1, levels)
+            else:
+                source = img
+            if (source.shape[1], source.shape[0]) != size:
+                source = cv2.resize(source, size, interpolation = cv2.INTER_AREA)
+            levels[level] = source
+        return levels[level]
+
+    def _detect_pyramid(self, img, scrib, track, refine):
+        """
+        Detect the chessboard in the levels of the pyramid of img given by _pyramid_levels, until
+        found, then refine the corners in each finer level. The first level is searched with the
+        tracking of _get_corners_tracked if track is True, which only ever uses the level images.
+
+        Returns (corners, downsampled_corners, board, refine_radius), see downsample_and_detect.
+        """
+        (height, width) = img.shape[:2]
+        levels = {}
+        ok = False
+        for (i, level) in enumerate(self._pyramid_levels(width, height, track)):
+            level_img = self._pyramid_image(img, level, levels)
+            if track and i == 0:
+                (ok, level_corners, board, propagated) = self._get_corners_tracked(level_img)
+            else:
+                (ok, level_corners, board) = self.get_corners(level_img, refine = True)
+                propagated = False
+            if ok:
+                break
+
+        if track:
+            if not ok:
+                self._tracked = None
+                self._board_spacing = None
+                self._pyramid_misses += 1
+            else:
+                age = self._tracked[3] + 1 if propagated else 0
+                self._tracked = (level_img, level_corners, board, age)
+                self._board_spacing = _get_spacing(level_corners, board) * width / level_img.shape[1]
+                self._pyramid_misses = 0
+        if not ok:
+            return (None, None, None, None)
+        self.detection_stats['pyramid_level_%d' % level] += 1
+
+        # Coarse to fine, each level being refined from the one above
+        if level > 1:
+            # Level 1 first, for the levels in between to be reduced from it
+            self._pyramid_image(img, 1, levels)
+            for finer in range(level - 1, 0, -1):
+                finer_img = self._pyramid_image(img, finer, levels)
+                level_corners = _scale_corners(level_corners, level_img.shape, finer_img.shape)
+                # Same search window as _get_corners, relative to the board
+                radius = int(math.ceil(_get_spacing(level_corners, board) * 0.5))
+                cv2.cornerSubPix(finer_img, level_corners, (radius, radius), (-1,-1),
+                                 ( cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.1 ))
+                level_img = finer_img
+        corners = _scale_corners(level_corners, level_img.shape, img.shape)
+        refine_radius = int(math.ceil(_get_spacing(corners, board) * 0.5))
+        if refine and not propagated:
+            self._refine_full_size(img, corners, refine_radius)
+            refine_radius = None
+        else:
+            self.detection_stats['deferred_refinements'] += 1
+        return (corners, _scale_corners(level_corners, level_img.shape, scrib.shape), board, refine_radius)
+
+    def _refine_full_size(self, img, corners, radius):
+        """ Refine in place up-scaled corners in the original full-res image """
+        # TODO Does this really make a difference in practice?
+        img = full_image(img)
+        if len(img.shape) == 3 and img.shape[2] == 3:
+            mono = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        else:
+            mono = img
+        cv2.cornerSubPix(mono, corners, (radius,radius), (-1,-1),
+                                      ( cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.1 ))
+
+    def _refine_live(self, img):
+        """
+        Return whether the live detection of img refines its corners at full resolution, rather
+        than leaving it to refine_corners for the frames kept as samples: not with
+        lazy_refinement, nor for images only decoded or demosaiced when needed (LazyMono), unless
+        calibrated, when the corners are shown rectified.
+        """
+        return self.calibrated or not (self.lazy_refinement or isinstance(img, LazyMono))
+
+    def refine_corners(self, img, detection):
+        """
+        Return the corners of a detection of img by downsample_and_detect, with the
+        full-resolution refinement it left to do, if any, done with the radius it chose at the
+        time. Refined detections are returned as they are.
+        """
+        (_, corners, _, _, _, refine_radius) = detection
+        if refine_radius is None:
+            return corners
+        corners = corners.copy()
+        self._refine_full_size(img, corners, refine_radius)
+        self.detection_stats['lazy_refinements'] += 1
+        return corners
 
 
     def lrmsg(self, d, k, r, p):
@@ -533,23 +1273,232 @@ class Calibrator(object):
         + "")
         return calmessage
 
-    def do_save(self):
-        filename = '/tmp/calibrationdata.tar.gz'
-        tf = tarfile.open(filename, 'w:gz')
-        self.do_tarfile_save(tf) # Must be overridden in subclasses
+    def rectification_maps(self, P, size = None):
+        """
+        Return the (map1, map2) pair rectifying images to the projection P, for cv2.remap. If size
+        is given, the rectified image is scaled to that (width, height), as cv2.resize would. The
+        maps are cached, and must not be modified.
+        """
+        if size is None:
+            size = self.size
+        def compute():
+            newP = P
+            if tuple(size) != tuple(self.size):
+                # Pixel centers stay aligned: x' = (x + 0.5) / scale - 0.5
+                newP = numpy.array(P, dtype=numpy.float64)
+                for (i, scale) in enumerate([float(self.size[0]) / size[0], float(self.size[1]) / size[1]]):
+                    newP[i] = P[i] / scale + (0.5 / scale - 0.5) * P[2]
+            maps = cv2.initUndistortRectifyMap(self.intrinsics, self.distortion, self.R, newP, tuple(size), cv2.CV_32FC1)
+            if self.fixed_point_maps:
+                # cv2.remap rounds float maps the same way on the fly, so the output does not change
+                maps = cv2.convertMaps(maps[0], maps[1], cv2.CV_16SC2)
+            return maps
+        key = (self.intrinsics.tobytes(), self.distortion.tobytes(), self.R.tobytes(), P.tobytes(),
+               tuple(self.size), tuple(size), self.fixed_point_maps)
+        return self._map_cache.get(key, compute)
+
+    def update_live_estimate(self):
+        """
+        Start solving the calibration in the background if live_interval samples were added since
+        the last solution. The solver starts from the last solution, and its result goes to
+        live_estimate once done.
+        """
+        if not self.live_interval or self.calibrated:
+            return
+        with self._live_lock:
+            if self._live_job is not None and not self._live_job.ready():
+                return
+            good = list(self.good_corners)
+            if len(good) - self.live_samples < self.live_interval:
+                return
+            if self._live_pool is None:
+                self._live_pool = multiprocessing.pool.ThreadPool(1)
+            (size, previous) = (self.db.image_size, self.live_estimate)
+            def solve():
+                try:
+                    estimate = self.live_calibration(good, size, previous)
+                except Exception as e:
+                    # The pool would drop the error: report it, the next samples solve again
+                    print("Live calibration failed: %s" % e)
+                    return
+                self.live_estimate = estimate
+                self.live_samples = len(good)
+            self._live_job = self._live_pool.apply_async(solve)
+
+    def finish_live_estimate(self, good = None):
+        """
+        Wait for the background solver and bring its solution up to date with the good corners,
+        all the samples by default. Returns the final estimate, None if the background solver
+        never ran.
+        """
+        if good is None:
+            good = list(self.good_corners)
+        with self._live_lock:
+            job = self._live_job
+            if job is not None:
+                job.wait()
+            if self.live_estimate is not None and self.live_samples < len(good):
+                try:
+                    self.live_estimate = self.live_calibration(good, self.db.image_size, self.live_estimate)
+                    self.live_samples = len(good)
+                except Exception as e:
+                    # Calibrate from scratch instead
+                    print("Live calibration failed: %s" % e)
+                    return None
+            return self.live_estimate
+
+    def _begin_calibration(self):
+        """
+        Stop score from adding samples, see _end_calibration, and return a snapshot of the good
+        corners to calibrate from
+        """
+        with self._samples_lock:
+            self._calibrating = True
+            return list(self.good_corners)
+
+    def _end_calibration(self):
+        with self._samples_lock:
+            self._calibrating = False
+
+    def lrlive(self, name, estimate):
+        """ Return the live estimate of one camera as text, with the standard deviations """
+        values = ([("fx", estimate.intrinsics[0,0]), ("fy", estimate.intrinsics[1,1]),
+                   ("cx", estimate.intrinsics[0,2]), ("cy", estimate.intrinsics[1,2])] +
+                  list(zip(["k1", "k2", "p1", "p2", "k3", "k4", "k5", "k6"], estimate.distortion.flat)))
+        lines = ["%s: %d samples, rms %.4f" % (name, estimate.samples, estimate.rms)]
+        for (i, (label, value)) in enumerate(values):
+            if estimate.std_deviations is None:
+                lines.append("%s %.6f" % (label, value))
+            else:
+                lines.append("%s %.6f +- %.6f" % (label, value, estimate.std_deviations[i]))
+        return "\n".join(lines) + "\n"
+
+    def do_save(self, progress = _no_progress):
+        """
+        Write the samples and the calibration to /tmp/calibrationdata.zip or
+        /tmp/calibrationdata.tar, with the extension of save_compression if any (e.g.
+        /tmp/calibrationdata.tar.gz), see save_format. progress is called with the fraction of the
+        work done, and may raise to abort, in which case the file is removed.
+        """
+        if self.save_format == 'zip':
+            filename = '/tmp/calibrationdata.zip'
+            tf = zipfile.ZipFile(filename, 'w', zipfile.ZIP_STORED, allowZip64 = True)
+        else:
+            filename = '/tmp/calibrationdata.tar'
+            mode = 'w'
+            kwargs = {}
+            if self.save_compression:
+                filename += '.' + self.save_compression
+                mode += ':' + self.save_compression
+                if self.save_compression_level is not None:
+                    level = 'preset' if self.save_compression == 'xz' else 'compresslevel'
+                    kwargs[level] = self.save_compression_level
+            tf = tarfile.open(filename, mode, **kwargs)
+        try:
+            cache = self.do_tarfile_save(tf, progress) # Must be overridden in subclasses
+        except BaseException:
+            tf.close()
+            os.remove(filename)
+            raise
         tf.close()
         print(("Wrote calibration data to", filename))
+        # The corners of a previous save do not match these images
+        if os.path.exists(filename + '.corners.npz'):
+            os.remove(filename + '.corners.npz')
+        if cache is not None:
+            self._save_corner_cache(filename, cache)
+
+    def _tarfile_save(self, tf, sides, files, progress):
+        """
+        Write the images of the samples to a tarfile or zipfile object as <side>-<index>.png,
+        encoding them on a pool of threads, followed by the (name, data) files. Images discarded
+        by the sample store are missing from the archive.
+
+        Returns the CornerCache of the corners of the written images, to be saved as the sidecar
+        file of the archive, or None, see _samples_corner_cache.
+        """
+        cache = self._samples_corner_cache()
+        def written(name, i, j, data):
+            if cache is not None:
+                (corners, board) = (self.good_corners[i][j], self.good_corners[i][-1])
+                cache.put(name, CornerCache.digest(data), self.db.image_size, corners, self._board_index(board))
+
+        archive = ArchiveWriter(tf)
+        try:
+            for (j, side) in enumerate(sides):
+                for i in range(len(self.db)):
+                    progress((j + float(i) / len(self.db)) / len(sides))
+                    name = "%s-%04d.png" % (side, i)
+                    archive.add(name, functools.partial(self._sample_png, i, j), functools.partial(written, name, i, j))
+            for (name, data) in files:
+                archive.add(name, data)
+        except BaseException:
+            archive.abort()
+            raise
+        archive.close()
+        return cache
+
+    def _sample_png(self, i, j):
+        png = self.db.png(i, j)
+        if png is None:
+            return None
+        return png.tobytes()
 
 def image_from_archive(archive, name):
     """
     Load image PGM file from tar archive. 
 
-    Used for tarfile loading and unit test.
+    Used for tarfile loading and unit test. name may also be the TarInfo of the file, which
+    saves looking it up in the archive. archive may also be a zipfile or an ArchiveReader.
     """
-    member = archive.getmember(name)
-    imagefiledata = numpy.fromstring(archive.extractfile(member).read(), numpy.uint8)
-    imagefiledata.resize((1, imagefiledata.size))
-    return cv2.imdecode(imagefiledata, cv2.IMREAD_COLOR)
+    if isinstance(archive, tarfile.TarFile):
+        return _decode_image(archive.extractfile(name).read())
+    return _decode_image(archive.read(name))
+
+def _decode_image(data):
+    """ Decode the bytes of an image file, as image_from_archive does """
+    return cv2.imdecode(numpy.frombuffer(data, numpy.uint8), cv2.IMREAD_COLOR)
+
+def _archive_files(filename, prefixes):
+    """
+    Generate (prefix, name, data) for the PGM and PNG files of an archive whose name starts with
+    one of prefixes, in archive order. Tar archives are read once, as a stream, zip archives through
+    an ArchiveReader, and nothing read is kept.
+    """
+    def image_prefix(name):
+        if name.endswith('pgm') or name.endswith('png'):
+            for prefix in prefixes:
+                if name.startswith(prefix):
+                    return prefix
+        return None
+
+    if is_zip_archive(filename):
+        with ArchiveReader(filename) as archive:
+            for name in archive.names():
+                prefix = image_prefix(name)
+                if prefix is not None:
+                    yield (prefix, name, archive.read(name))
+        return
+    with tarfile.open(filename, 'r|*') as archive:
+        for member in archive:
+            prefix = image_prefix(member.name)
+            if member.isfile() and prefix is not None:
+                yield (prefix, member.name, archive.extractfile(member).read())
+
+def _detect_file(calibrator, data, downsample):
+    """
+    Decode an image file and detect the target in it, at full resolution with get_corners or
+    with downsample_and_detect. Returns (corners, board, (width, height)), corners being None if
+    the target was not found.
+    """
+    img = _decode_image(data)
+    if downsample:
+        (_, corners, _, board, _, _) = calibrator.downsample_and_detect(img)
+    else:
+        (ok, corners, board) = calibrator.get_corners(img)
+        if not ok:
+            corners = None
+    return (corners, board, (img.shape[1], img.shape[0]))
 
 class ImageDrawable(object):
     """
@@ -610,38 +1559,48 @@ class MonoCalibrator(Calibrator):
         Return [ (corners, ChessboardInfo) ]
         """
         self.size = (images[0].shape[1], images[0].shape[0])
-        corners = [self.get_corners(i) for i in images]
+        if self.jobs > 1 and len(images) > 1:
+            corners = [(ok, co, None if b is None else self._boards[b])
+                       for (ok, co, b) in self._parallel_detect(_pool_get_corners, images)]
+        else:
+            corners = [self.get_corners(i) for i in images]
 
         goodcorners = [(co, b) for (ok, co, b) in corners if ok]
         if not goodcorners:
             raise CalibrationException("No corners found in images!")
         return goodcorners
 
-    def cal_fromcorners(self, good):
+    def cal_fromcorners(self, good, estimate = None):
         """
         :param good: Good corner positions and boards 
         :type good: [(corners, ChessboardInfo)]
+        :param estimate: solution of the intrinsics for these corners, if already known
+        :type estimate: LiveEstimate
 
         
         """
-        boards = [ b for (_, b) in good ]
+        if estimate is not None:
+            self.intrinsics = estimate.intrinsics.copy()
+            self.distortion = estimate.distortion.copy()
+        else:
+            boards = [ b for (_, b) in good ]
 
-        ipts = [ points for (points, _) in good ]
-        opts = self.mk_object_points(boards)
+            ipts = [ points for (points, _) in good ]
+            opts = self.mk_object_points(boards)
 
-        self.intrinsics = numpy.zeros((3, 3), numpy.float64)
-        if self.calib_flags & cv2.CALIB_RATIONAL_MODEL:
-            self.distortion = numpy.zeros((8, 1), numpy.float64) # rational polynomial
-        else:
-            self.distortion = numpy.zeros((5, 1), numpy.float64) # plumb bob
-        # If FIX_ASPECT_RATIO flag set, enforce focal lengths have 1/1 ratio
-        self.intrinsics[0,0] = 1.0
-        self.intrinsics[1,1] = 1.0
-        cv2.calibrateCamera(
-                   opts, ipts,
-                   self.size, self.intrinsics,
-                   self.distortion,
-                   flags = self.calib_flags)
+            self.intrinsics = numpy.zeros((3, 3), numpy.float64)
+            if self.calib_flags & cv2.CALIB_RATIONAL_MODEL:
+                self.distortion = numpy.zeros((8, 1), numpy.float64) # rational polynomial
+            else:
+                self.distortion = numpy.zeros((5, 1), numpy.float64) # plumb bob
+            # If FIX_ASPECT_RATIO flag set, enforce focal lengths have 1/1 ratio
+            self.intrinsics[0,0] = 1.0
+            self.intrinsics[1,1] = 1.0
+            cv2.calibrateCamera(
+                       opts, ipts,
+                       self.size, self.intrinsics,
+                       self.distortion,
+                       flags = self.calib_flags)
 
         # R is identity matrix for monocular calibration
         self.R = numpy.eye(3, dtype=numpy.float64)
@@ -649,6 +1608,21 @@ class MonoCalibrator(Calibrator):
 
         self.set_alpha(0.0)
 
+    def live_calibration(self, good, size, previous):
+        """
+        Solve the intrinsics from the good corners, starting from the previous LiveEstimate if
+        any. Returns a LiveEstimate.
+        """
+        boards = [ b for (_, b) in good ]
+        ipts = [ points for (points, _) in good ]
+        return _estimate_intrinsics(self.mk_object_points(boards), ipts, size, self.calib_flags, previous)
+
+    def live_report(self):
+        """ Return the live estimate as text, None if there is none yet """
+        if self.live_estimate is None:
+            return None
+        return self.lrlive(self.name, self.live_estimate)
+
     def set_alpha(self, a):
         """
         Set the alpha value for the calibrated camera solution.  The alpha
@@ -664,16 +1638,26 @@ class MonoCalibrator(Calibrator):
         for j in range(3):
             for i in range(3):
                 self.P[j,i] = ncm[j, i]
-        self.mapx, self.mapy = cv2.initUndistortRectifyMap(self.intrinsics, self.distortion, self.R, ncm, self.size, cv2.CV_32FC1)
 
-    def remap(self, src):
+    # The rectification maps are computed on first use, see rectification_maps
+    @property
+    def mapx(self):
+        return self.rectification_maps(self.P)[0]
+
+    @property
+    def mapy(self):
+        return self.rectification_maps(self.P)[1]
+
+    def remap(self, src, size = None):
         """
         :param src: source image
         :type src: :class:`cvMat`
+        :param size: (width, height) of the result, the size of src if None
 
         Apply the post-calibration undistortion to the source image
         """
-        return cv2.remap(src, self.mapx, self.mapy, cv2.INTER_LINEAR)
+        (map1, map2) = self.rectification_maps(self.P, size)
+        return cv2.remap(src, map1, map2, cv2.INTER_LINEAR)
 
     def undistort_points(self, src):
         """
@@ -714,7 +1698,7 @@ class MonoCalibrator(Calibrator):
         Detect the checkerboard and compute the linear error.
         Mainly for use in tests.
         """
-        _, corners, _, board, _ = self.downsample_and_detect(image)
+        _, corners, _, board, _, _ = self.downsample_and_detect(image)
         if corners is None:
             return None
 
@@ -731,23 +1715,30 @@ class MonoCalibrator(Calibrator):
         if corners is None:
             return None
 
-        def pt2line(x0, y0, x1, y1, x2, y2):
-            """ point is (x0, y0), line is (x1, y1, x2, y2) """
-            return abs((x2 - x1) * (y1 - y0) - (x1 - x0) * (y2 - y1)) / math.sqrt((x2 - x1) ** 2 + (y2 - y1) ** 2)
-
         cc = b.n_cols
         cr = b.n_rows
-        errors = []
-        for r in range(cr):
-            (x1, y1) = corners[(cc * r) + 0, 0]
-            (x2, y2) = corners[(cc * r) + cc - 1, 0]
-            for i in range(1, cc - 1):
-                (x0, y0) = corners[(cc * r) + i, 0]
-                errors.append(pt2line(x0, y0, x1, y1, x2, y2))
-        if errors:
-            return math.sqrt(sum([e**2 for e in errors]) / len(errors))
-        else:
+        if cc < 3:
             return None
+        # Distance of the inner corners of each row to the line through its first and last corners
+        grid = corners.reshape(cr, cc, 2)
+        (x1, y1) = (grid[:, :1, 0], grid[:, :1, 1])
+        (x2, y2) = (grid[:, -1:, 0], grid[:, -1:, 1])
+        (x0, y0) = (grid[:, 1:-1, 0], grid[:, 1:-1, 1])
+        errors = (numpy.abs((x2 - x1) * (y1 - y0) - (x1 - x0) * (y2 - y1)).astype(numpy.float64) /
+                  numpy.sqrt(((x2 - x1) ** 2 + (y2 - y1) ** 2).astype(numpy.float64)))
+        return math.sqrt(numpy.mean(errors ** 2))
+
+    def reprojection_errors(self, good):
+        """
+        Return the RMS reprojection error, in pixels, of each view of good, a list of (corners,
+        ChessboardInfo), with the board in the pose that best fits the calibration.
+        """
+        errors = []
+        for (opts, (corners, _)) in zip(self.mk_object_points([b for (_, b) in good]), good):
+            (_, rvec, tvec) = cv2.solvePnP(opts, corners, self.intrinsics, self.distortion)
+            (projected, _) = cv2.projectPoints(opts, rvec, tvec, self.intrinsics, self.distortion)
+            errors.append(math.sqrt(numpy.square(projected - corners).sum() / len(corners)))
+        return errors
 
 
     def handle_msg(self, msg):
@@ -757,19 +1748,63 @@ class MonoCalibrator(Calibrator):
 
         Returns a MonoDrawable message with the display image and progress info.
         """
-        gray = self.mkgray(msg)
-        linear_error = -1
+        gray = self.convert(msg)
+        detection = self.detect(gray)
+        return self.render(gray, detection, self.score(gray, detection))
 
-        # Get display-image-to-be (scrib) and detection of the calibration target
-        scrib_mono, corners, downsampled_corners, board, (x_scale, y_scale) = self.downsample_and_detect(gray)
+    def convert(self, msg):
+        """
+        First stage of handle_msg: the message as a monochrome image. Compressed and Bayer images
+        become a LazyMono, only decoded or demosaiced as much as the next stages need.
+        """
+        if isinstance(msg, sensor_msgs.msg.CompressedImage):
+            return CompressedMono(msg)
+        if msg.encoding in self._bayer_encodings:
+            return self.mkbayer(msg)
+        return self.mkgray(msg)
+
+    def detect(self, gray):
+        """
+        Second stage of handle_msg: get display-image-to-be (scrib) and detection of the
+        calibration target, as returned by downsample_and_detect. The corners are refined at full
+        resolution right away only if _refine_live, else by score if the frame becomes a sample.
+        """
+        return self.downsample_and_detect(gray, track=True, refine=self._refine_live(gray))
+
+    def score(self, gray, detection):
+        """
+        Third stage of handle_msg: add the detection to the sample database if it provides
+        enough new information. Must be called in the order of the frames.
+
+        Returns the progress info, see compute_goodenough.
+        """
+        _, corners, _, board, _, _ = detection
+        with self._samples_lock:
+            if not self.calibrated and not self._calibrating and corners is not None:
+                # Add sample to database only if it's sufficiently different from any previous sample.
+                params = self.get_parameters(corners, board, (gray.shape[1], gray.shape[0]))
+                if self.is_good_sample(params, corners, self.last_frame_corners):
+                    self.db.append((params, full_image(gray)))
+                    self._offline_samples = self._offline_samples and self._offline_corners(gray, detection, False)
+                    self.good_corners.append((self.refine_corners(gray, detection), board))
+                    print(("*** Added sample %d, p_x = %.3f, p_y = %.3f, p_size = %.3f, skew = %.3f" % tuple([len(self.db)] + params)))
+                    self.update_live_estimate()
+
+        self.last_frame_corners = corners
+        return self.compute_goodenough()
+
+    def render(self, gray, detection, params):
+        """
+        Last stage of handle_msg: returns a MonoDrawable message with the display image and
+        progress info.
+        """
+        scrib_mono, corners, downsampled_corners, board, (x_scale, y_scale), _ = detection
+        linear_error = -1
 
         if self.calibrated:
             # Show rectified image
-            # TODO Pull out downsampling code into function
-            gray_remap = self.remap(gray)
-            gray_rect = gray_remap
-            if x_scale != 1.0 or y_scale != 1.0:
-                gray_rect = cv2.resize(gray_remap, (scrib_mono.shape[1], scrib_mono.shape[0]))
+            # Rectified straight at display size
+            gray_rect = self.remap(full_image(gray), (scrib_mono.shape[1], scrib_mono.shape[0]))
 
             scrib = cv2.cvtColor(gray_rect, cv2.COLOR_GRAY2BGR)
 
@@ -790,62 +1825,70 @@ class MonoCalibrator(Calibrator):
                 # Draw (potentially downsampled) corners onto display image
                 cv2.drawChessboardCorners(scrib, (board.n_cols, board.n_rows), downsampled_corners, True)
 
-                # Add sample to database only if it's sufficiently different from any previous sample.
-                params = self.get_parameters(corners, board, (gray.shape[1], gray.shape[0]))
-                if self.is_good_sample(params, corners, self.last_frame_corners):
-                    self.db.append((params, gray))
-                    self.good_corners.append((corners, board))
-                    print(("*** Added sample %d, p_x = %.3f, p_y = %.3f, p_size = %.3f, skew = %.3f" % tuple([len(self.db)] + params)))
-        
-        self.last_frame_corners = corners
         rv = MonoDrawable()
         rv.scrib = scrib
-        rv.params = self.compute_goodenough()
+        rv.params = params
         rv.linear_error = linear_error
         return rv
 
-    def do_calibration(self, dump = False):
-        if not self.good_corners:
-            print("**** Collecting corners for all images! ****") #DEBUG
-            images = [i for (p, i) in self.db]
-            self.good_corners = self.collect_corners(images)
-        # Dump should only occur if user wants it
-        if dump:
-            pickle.dump((self.is_mono, self.size, self.good_corners),
-                        open("/tmp/camera_calibration_%08x.pickle" % random.getrandbits(32), "w"))
-        self.size = (self.db[0][1].shape[1], self.db[0][1].shape[0]) # TODO Needs to be set externally
-        self.cal_fromcorners(self.good_corners)
-        self.calibrated = True
+    def do_calibration(self, dump = False, progress = _no_progress):
+        """
+        Calibrate from the samples taken so far, score adding no more samples meanwhile. progress
+        is called with the fraction of the work done, and may raise to abort before the solution
+        is computed, leaving the calibrator as it was.
+        """
+        progress(0.0)
+        good = self._begin_calibration()
+        try:
+            if not good:
+                print("**** Collecting corners for all images! ****") #DEBUG
+                images = [i for (p, i) in self.db if i is not None]
+                if not images:
+                    raise CalibrationException("No corners nor images to calibrate from!")
+                good = self.good_corners = self.collect_corners(images)
+            # Dump should only occur if user wants it
+            if dump:
+                pickle.dump((self.is_mono, self.size, good),
+                            open("/tmp/camera_calibration_%08x.pickle" % random.getrandbits(32), "w"))
+            self.size = self.db.image_size # TODO Needs to be set externally
+            progress(0.5)
+            self.cal_fromcorners(good, self.finish_live_estimate(good))
+            self.calibrated = True
+        finally:
+            self._end_calibration()
         # DEBUG
         print((self.report()))
         print((self.ost()))
 
-    def do_tarfile_save(self, tf):
-        """ Write images and calibration solution to a tarfile object """
-
-        def taradd(name, buf):
-            if isinstance(buf, basestring):
-                s = StringIO(buf)
-            else:
-                s = BytesIO(buf)
-            ti = tarfile.TarInfo(name)
-            ti.size = len(s.getvalue())
-            ti.uname = 'calibrator'
-            ti.mtime = int(time.time())
-            tf.addfile(tarinfo=ti, fileobj=s)
-
-        ims = [("left-%04d.png" % i, im) for i,(_, im) in enumerate(self.db)]
-        for (name, im) in ims:
-            taradd(name, cv2.imencode(".png", im)[1].tostring())
-        taradd('ost.yaml', self.yaml())
-        taradd('ost.txt', self.ost())
-
-    def do_tarfile_calibration(self, filename):
-        archive = tarfile.open(filename, 'r')
-
-        limages = [ image_from_archive(archive, f) for f in archive.getnames() if (f.startswith('left') and (f.endswith('.pgm') or f.endswith('png'))) ]
+    def do_tarfile_save(self, tf, progress = _no_progress):
+        """
+        Write images and calibration solution to a tarfile or zipfile object. Returns the
+        corners of the images or None, see _tarfile_save.
+        """
+        return self._tarfile_save(tf, ["left"], [('ost.yaml', self.yaml()), ('ost.txt', self.ost())], progress)
 
-        self.cal(limages)
+    def do_tarfile_calibration(self, filename, corner_cache = True):
+        """
+        Calibrate from the left images of a tarfile or zipfile, streamed through detection. If
+        corner_cache, the corners already detected in the archive are reused and the new ones
+        saved, see _load_corner_cache.
+        """
+        cache = None
+        if corner_cache:
+            cache = self._load_corner_cache(filename, self.corner_cache_settings(False))
+        goodcorners = []
+        for (i, (_, corners, board, size)) in enumerate(self._archive_corners(filename, ['left'], False, cache)):
+            if i == 0:
+                self.size = size
+            if corners is not None:
+                goodcorners.append((corners, board))
+        if cache is not None:
+            self._save_corner_cache(filename, cache)
+        if not goodcorners:
+            raise CalibrationException("No corners found in images!")
+        self.good_corners = goodcorners
+        self.cal_fromcorners(goodcorners)
+        self.calibrated = True
 
 # TODO Replicate MonoCalibrator improvements in stereo
 class StereoCalibrator(Calibrator):
@@ -893,8 +1936,19 @@ class StereoCalibrator(Calibrator):
         left and right have a chessboard, and return  their corners as a list of pairs.
         """
         # Pick out (corners, board) tuples
-        lcorners = [ self.downsample_and_detect(i)[1:4:2] for i in limages]
-        rcorners = [ self.downsample_and_detect(i)[1:4:2] for i in rimages]
+        if self.jobs > 1 and len(limages) + len(rimages) > 1:
+            corners = [(co, None if b is None else self._boards[b])
+                       for (co, b) in self._parallel_detect(_pool_downsample_and_detect, limages + rimages)]
+            lcorners = corners[:len(limages)]
+            rcorners = corners[len(limages):]
+        else:
+            # Each side on its own monocular calibrator, never one calibrator from two threads
+            (lcorners, rcorners) = _map_pair(lambda side: [ side[0].downsample_and_detect(i)[1:4:2] for i in side[1]],
+                                             (self.l, limages), (self.r, rimages))
+        return self._good_pairs(lcorners, rcorners)
+
+    def _good_pairs(self, lcorners, rcorners):
+        """ Return the (lcorners, rcorners, board) of the pairs of detections where both found the target """
         good = [(lco, rco, b) for ((lco, b), (rco, br)) in zip( lcorners, rcorners)
                 if (lco is not None and rco is not None)]
 
@@ -902,12 +1956,13 @@ class StereoCalibrator(Calibrator):
             raise CalibrationException("No corners found in images!")
         return good
 
-    def cal_fromcorners(self, good):
-        # Perform monocular calibrations
+    def cal_fromcorners(self, good, estimate = None):
+        # Perform monocular calibrations, unless their solutions are given as (left, right) LiveEstimates
         lcorners = [(l, b) for (l, r, b) in good]
         rcorners = [(r, b) for (l, r, b) in good]
-        self.l.cal_fromcorners(lcorners)
-        self.r.cal_fromcorners(rcorners)
+        (lestimate, restimate) = estimate or (None, None)
+        self.l.cal_fromcorners(lcorners, lestimate)
+        self.r.cal_fromcorners(rcorners, restimate)
 
         lipts = [ l for (l, _, _) in good ]
         ripts = [ r for (_, r, _) in good ]
@@ -939,6 +1994,24 @@ class StereoCalibrator(Calibrator):
 
         self.set_alpha(0.0)
 
+    def live_calibration(self, good, size, previous):
+        """
+        Solve the intrinsics of both cameras from the good corners, starting from the previous
+        (left, right) LiveEstimates if any. Returns the new (left, right) LiveEstimates.
+        """
+        (lprevious, rprevious) = previous or (None, None)
+        lcorners = [(l, b) for (l, r, b) in good]
+        rcorners = [(r, b) for (l, r, b) in good]
+        return tuple(_map_pair(lambda args: args[0].live_calibration(args[1], size, args[2]),
+                               (self.l, lcorners, lprevious), (self.r, rcorners, rprevious)))
+
+    def live_report(self):
+        """ Return the live estimates as text, None if there are none yet """
+        if self.live_estimate is None:
+            return None
+        (lestimate, restimate) = self.live_estimate
+        return self.lrlive(self.name + "/left", lestimate) + self.lrlive(self.name + "/right", restimate)
+
     def set_alpha(self, a):
         """
         Set the alpha value for the calibrated camera solution. The
@@ -956,11 +2029,16 @@ class StereoCalibrator(Calibrator):
                          self.T,
                          self.l.R, self.r.R, self.l.P, self.r.P,
                          alpha = a)
-        
-        cv2.initUndistortRectifyMap(self.l.intrinsics, self.l.distortion, self.l.R, self.l.P, self.size, cv2.CV_32FC1,
-                                   self.l.mapx, self.l.mapy)
-        cv2.initUndistortRectifyMap(self.r.intrinsics, self.r.distortion, self.r.R, self.r.P, self.size, cv2.CV_32FC1,
-                                   self.r.mapx, self.r.mapy)
+
+    def set_detection_resolution(self, fraction):
+        """ Set the detection resolution of both cameras, see Calibrator.set_detection_resolution """
+        super(StereoCalibrator, self).set_detection_resolution(fraction)
+        self.l.set_detection_resolution(fraction)
+        self.r.set_detection_resolution(fraction)
+
+    def get_detection_stats(self):
+        """ Return the detection counters summed over both cameras """
+        return self.detection_stats + self.l.detection_stats + self.r.detection_stats
 
     def as_message(self):
         """
@@ -1005,8 +2083,8 @@ class StereoCalibrator(Calibrator):
         Detect the checkerboard in both images and compute the epipolar error.
         Mainly for use in tests.
         """
-        lcorners = self.downsample_and_detect(limage)[1]
-        rcorners = self.downsample_and_detect(rimage)[1]
+        (lcorners, rcorners) = _map_pair(lambda side: side[0].downsample_and_detect(side[1])[1],
+                                         (self.l, limage), (self.r, rimage))
         if lcorners is None or rcorners is None:
             return None
 
@@ -1015,6 +2093,14 @@ class StereoCalibrator(Calibrator):
 
         return self.epipolar_error(lundistorted, rundistorted)
 
+    def reprojection_errors(self, good):
+        """
+        Return the reprojection errors of the left and right views of good, a list of (lcorners,
+        rcorners, ChessboardInfo), see MonoCalibrator.reprojection_errors.
+        """
+        return (self.l.reprojection_errors([(l, b) for (l, r, b) in good]),
+                self.r.reprojection_errors([(r, b) for (l, r, b) in good]))
+
     def epipolar_error(self, lcorners, rcorners):
         """
         Compute the epipolar error from two sets of matching undistorted points
@@ -1023,8 +2109,8 @@ class StereoCalibrator(Calibrator):
         return numpy.sqrt(numpy.square(d).sum() / d.size)
 
     def chessboard_size_from_images(self, limage, rimage):
-        _, lcorners, _, board, _ = self.downsample_and_detect(limage)
-        _, rcorners, _, board, _ = self.downsample_and_detect(rimage)
+        ((lcorners, _), (rcorners, board)) = _map_pair(lambda side: side[0].downsample_and_detect(side[1])[1:4:2],
+                                                       (self.l, limage), (self.r, rimage))
         if lcorners is None or rcorners is None:
             return None
 
@@ -1046,37 +2132,83 @@ class StereoCalibrator(Calibrator):
         cam.fromCameraInfo(*msg)
         disparities = lcorners[:,:,0] - rcorners[:,:,0]
         pt3d = [cam.projectPixelTo3d((lcorners[i,0,0], lcorners[i,0,1]), disparities[i,0]) for i in range(lcorners.shape[0]) ]
-        def l2(p0, p1):
-            return math.sqrt(sum([(c0 - c1) ** 2 for (c0, c1) in zip(p0, p1)]))
 
         # Compute the length from each horizontal and vertical line, and return the mean
         cc = board.n_cols
         cr = board.n_rows
-        lengths = (
-            [l2(pt3d[cc * r + 0], pt3d[cc * r + (cc - 1)]) / (cc - 1) for r in range(cr)] +
-            [l2(pt3d[c + 0], pt3d[c + (cc * (cr - 1))]) / (cr - 1) for c in range(cc)])
-        return sum(lengths) / len(lengths)
+        grid = numpy.array(pt3d, numpy.float64).reshape(cr, cc, 3)
+        lengths = numpy.concatenate((
+            numpy.sqrt(numpy.sum((grid[:, 0] - grid[:, -1]) ** 2, axis = 1)) / (cc - 1),
+            numpy.sqrt(numpy.sum((grid[0] - grid[-1]) ** 2, axis = 1)) / (cr - 1)))
+        return numpy.mean(lengths)
 
     def handle_msg(self, msg):
         # TODO Various asserts that images have same dimension, same board detected...
+        grays = self.convert(msg)
+        detections = self.detect(grays)
+        return self.render(grays, detections, self.score(grays, detections))
+
+    def convert(self, msg):
+        """
+        First stage of handle_msg: the (left, right) messages as a pair of monochrome images.
+        Each camera is converted by its own monocular calibrator, both at the same time.
+        """
         (lmsg, rmsg) = msg
-        lgray = self.mkgray(lmsg)
-        rgray = self.mkgray(rmsg)
-        epierror = -1
+        return tuple(_map_pair(lambda side_and_msg: side_and_msg[0].convert(side_and_msg[1]), (self.l, lmsg), (self.r, rmsg)))
 
-        # Get display-images-to-be and detections of the calibration target
-        lscrib_mono, lcorners, ldownsampled_corners, lboard, (x_scale, y_scale) = self.downsample_and_detect(lgray)
-        rscrib_mono, rcorners, rdownsampled_corners, rboard, _ = self.downsample_and_detect(rgray)
+    def detect(self, grays):
+        """
+        Second stage of handle_msg: get display-images-to-be and detections of the calibration
+        target, for both cameras at the same time. Each camera is tracked by its own monocular
+        calibrator, which shares our detection settings.
+        """
+        (lgray, rgray) = grays
+        def detect(side_and_gray):
+            (side, gray) = side_and_gray
+            return side.downsample_and_detect(gray, track=True, refine=self._refine_live(gray))
+        return tuple(_map_pair(detect, (self.l, lgray), (self.r, rgray)))
+
+    def score(self, grays, detections):
+        """
+        Third stage of handle_msg: add the detections to the sample database if they provide
+        enough new information. Must be called in the order of the frames.
+
+        Returns the progress info, see compute_goodenough.
+        """
+        (lgray, rgray) = grays
+        (ldetection, rdetection) = detections
+        ((_, lcorners, _, lboard, _, _), (_, rcorners, _, _, _, _)) = detections
+        # Add sample to database only if it's sufficiently different from any previous sample
+        with self._samples_lock:
+            if (not self.calibrated and not self._calibrating and lcorners is not None and rcorners is not None and
+                len(lcorners) == len(rcorners)):
+                params = self.get_parameters(lcorners, lboard, (lgray.shape[1], lgray.shape[0]))
+                if self.is_good_sample(params, lcorners, self.last_frame_corners):
+                    self.db.append( (params, full_image(lgray), full_image(rgray)) )
+                    self._offline_samples = (self._offline_samples and self.l._offline_corners(lgray, ldetection, True) and
+                                             self.r._offline_corners(rgray, rdetection, True))
+                    self.good_corners.append( (self.l.refine_corners(lgray, ldetection),
+                                               self.r.refine_corners(rgray, rdetection), lboard) )
+                    print(("*** Added sample %d, p_x = %.3f, p_y = %.3f, p_size = %.3f, skew = %.3f" % tuple([len(self.db)] + params)))
+                    self.update_live_estimate()
+
+        self.last_frame_corners = lcorners
+        return self.compute_goodenough()
+
+    def render(self, grays, detections, params):
+        """
+        Last stage of handle_msg: returns a StereoDrawable message with the display images and
+        progress info.
+        """
+        (lgray, rgray) = grays
+        ((lscrib_mono, lcorners, ldownsampled_corners, lboard, (x_scale, y_scale), _),
+         (rscrib_mono, rcorners, rdownsampled_corners, rboard, _, _)) = detections
+        epierror = -1
 
         if self.calibrated:
-            # Show rectified images
-            lremap = self.l.remap(lgray)
-            rremap = self.r.remap(rgray)
-            lrect = lremap
-            rrect = rremap
-            if x_scale != 1.0 or y_scale != 1.0:
-                lrect = cv2.resize(lremap, (lscrib_mono.shape[1], lscrib_mono.shape[0]))
-                rrect = cv2.resize(rremap, (rscrib_mono.shape[1], rscrib_mono.shape[0]))
+            # Show rectified images, rectified straight at display size
+            (lrect, rrect) = _map_pair(lambda args: args[0].remap(full_image(args[1]), (args[2].shape[1], args[2].shape[0])),
+                                       (self.l, lgray, lscrib_mono), (self.r, rgray, rscrib_mono))
 
             lscrib = cv2.cvtColor(lrect, cv2.COLOR_GRAY2BGR)
             rscrib = cv2.cvtColor(rrect, cv2.COLOR_GRAY2BGR)
@@ -1111,67 +2243,72 @@ class StereoCalibrator(Calibrator):
                 cv2.drawChessboardCorners(rscrib, (rboard.n_cols, rboard.n_rows),
                                          rdownsampled_corners, True)
 
-            # Add sample to database only if it's sufficiently different from any previous sample
-            if lcorners is not None and rcorners is not None and len(lcorners) == len(rcorners):
-                params = self.get_parameters(lcorners, lboard, (lgray.shape[1], lgray.shape[0]))
-                if self.is_good_sample(params, lcorners, self.last_frame_corners):
-                    self.db.append( (params, lgray, rgray) )
-                    self.good_corners.append( (lcorners, rcorners, lboard) )
-                    print(("*** Added sample %d, p_x = %.3f, p_y = %.3f, p_size = %.3f, skew = %.3f" % tuple([len(self.db)] + params)))
-        
-        self.last_frame_corners = lcorners
         rv = StereoDrawable()
         rv.lscrib = lscrib
         rv.rscrib = rscrib
-        rv.params = self.compute_goodenough()
+        rv.params = params
         rv.epierror = epierror
         return rv
 
-    def do_calibration(self, dump = False):
-        # TODO MonoCalibrator collects corners if needed here
-        # Dump should only occur if user wants it
-        if dump:
-            pickle.dump((self.is_mono, self.size, self.good_corners),
-                        open("/tmp/camera_calibration_%08x.pickle" % random.getrandbits(32), "w"))
-        self.size = (self.db[0][1].shape[1], self.db[0][1].shape[0]) # TODO Needs to be set externally
-        self.l.size = self.size
-        self.r.size = self.size
-        self.cal_fromcorners(self.good_corners)
-        self.calibrated = True
+    def do_calibration(self, dump = False, progress = _no_progress):
+        """ See MonoCalibrator.do_calibration """
+        progress(0.0)
+        good = self._begin_calibration()
+        try:
+            # TODO MonoCalibrator collects corners if needed here
+            # Dump should only occur if user wants it
+            if dump:
+                pickle.dump((self.is_mono, self.size, good),
+                            open("/tmp/camera_calibration_%08x.pickle" % random.getrandbits(32), "w"))
+            self.size = self.db.image_size # TODO Needs to be set externally
+            self.l.size = self.size
+            self.r.size = self.size
+            progress(0.5)
+            self.cal_fromcorners(good, self.finish_live_estimate(good))
+            self.calibrated = True
+        finally:
+            self._end_calibration()
         # DEBUG
         print((self.report()))
         print((self.ost()))
 
-    def do_tarfile_save(self, tf):
-        """ Write images and calibration solution to a tarfile object """
-        ims = ([("left-%04d.png"  % i, im) for i,(_, im, _) in enumerate(self.db)] +
-               [("right-%04d.png" % i, im) for i,(_, _, im) in enumerate(self.db)])
+    def do_tarfile_save(self, tf, progress = _no_progress):
+        """
+        Write images and calibration solution to a tarfile or zipfile object. Returns the
+        corners of the images or None, see _tarfile_save.
+        """
+        files = [('left.yaml', self.yaml("/left", self.l)),
+                 ('right.yaml', self.yaml("/right", self.r)),
+                 ('ost.txt', self.ost())]
+        return self._tarfile_save(tf, ["left", "right"], files, progress)
 
-        def taradd(name, buf):
-            if isinstance(buf, basestring):
-                s = StringIO(buf)
-            else:
-                s = BytesIO(buf)
-            ti = tarfile.TarInfo(name)
-            ti.size = len(s.getvalue())
-            ti.uname = 'calibrator'
-            ti.mtime = int(time.time())
-            tf.addfile(tarinfo=ti, fileobj=s)
-
-        for (name, im) in ims:
-            taradd(name, cv2.imencode(".png", im)[1].tostring())
-        taradd('left.yaml', self.yaml("/left", self.l))
-        taradd('right.yaml', self.yaml("/right", self.r))
-        taradd('ost.txt', self.ost())
-
-    def do_tarfile_calibration(self, filename):
-        archive = tarfile.open(filename, 'r')
-        limages = [ image_from_archive(archive, f) for f in archive.getnames() if (f.startswith('left') and (f.endswith('pgm') or f.endswith('png'))) ]
-        rimages = [ image_from_archive(archive, f) for f in archive.getnames() if (f.startswith('right') and (f.endswith('pgm') or f.endswith('png'))) ]
-
-        if not len(limages) == len(rimages):
-            raise CalibrationException("Left, right images don't match. %d left images, %d right" % (len(limages), len(rimages)))
+    def do_tarfile_calibration(self, filename, corner_cache = True):
+        """
+        Calibrate from the left and right images of a tarfile or zipfile, streamed through
+        detection. The n-th left image is paired with the n-th right image. If corner_cache, the
+        corners already detected in the archive are reused and the new ones saved, see
+        _load_corner_cache.
+        """
+        cache = None
+        if corner_cache:
+            cache = self._load_corner_cache(filename, self.corner_cache_settings(True))
+        corners = {'left': [], 'right': []}
+        for (side, co, b, size) in self._archive_corners(filename, ['left', 'right'], True, cache):
+            if side == 'left' and not corners['left']:
+                self.size = size
+            corners[side].append((co, b))
+        if cache is not None:
+            self._save_corner_cache(filename, cache)
+        (lcorners, rcorners) = (corners['left'], corners['right'])
+
+        if not len(lcorners) == len(rcorners):
+            raise CalibrationException("Left, right images don't match. %d left images, %d right" % (len(lcorners), len(rcorners)))
         
         ##\todo Check that the filenames match and stuff
 
-        self.cal(limages, rimages)
+        goodcorners = self._good_pairs(lcorners, rcorners)
+        self.good_corners = goodcorners
+        self.l.size = self.size
+        self.r.size = self.size
+        self.cal_fromcorners(goodcorners)
+        self.calibrated = True
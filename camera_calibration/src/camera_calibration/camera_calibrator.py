@@ -33,6 +33,7 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 import cv2
+import math
 import message_filters
 import numpy
 import os
@@ -41,13 +42,327 @@ import sensor_msgs.msg
 import sensor_msgs.srv
 import threading
 import time
+import traceback
 from camera_calibration.calibrator import MonoCalibrator, StereoCalibrator, ChessboardInfo, Patterns
+from camera_calibration.sample_store import ImageStorage
 from collections import deque
 from message_filters import ApproximateTimeSynchronizer
 from std_msgs.msg import String
 from std_srvs.srv import Empty
 
 
+class DropPolicy:
+    """
+    What a full FrameQueue does with a new frame. Latest drops the oldest queued frame, so that
+    consumers always get the most recent ones. Fifo makes the producer wait for room, so that no
+    frame is ever dropped.
+    """
+    Latest, Fifo = list(range(2))
+
+class FrameQueue(object):
+    """
+    Bounded queue handing frames over from one thread to another.
+
+    Every frame put gets a sequence number, and each frame is given to at most one call of get.
+    Consumers sleep on a condition variable until a frame arrives. What happens when the queue is
+    full depends on the DropPolicy.
+    """
+    def __init__(self, maxlen = 1, policy = DropPolicy.Latest):
+        self.maxlen = maxlen
+        self.policy = policy
+        self._cond = threading.Condition()
+        self._frames = deque()
+        self._closed = False
+        # Sequence number of the last frame put
+        self.seq = 0
+        self.received = 0
+        self.dropped = 0
+        self.processed = 0
+
+    def put(self, frame, seq = None):
+        """
+        Queue a frame, and return its sequence number. The frames of a pipeline keep the number
+        they got when entering it.
+        """
+        with self._cond:
+            if self.policy == DropPolicy.Fifo:
+                while len(self._frames) >= self.maxlen and not self._closed:
+                    self._cond.wait()
+            elif len(self._frames) >= self.maxlen:
+                self._frames.popleft()
+                self.dropped += 1
+            self.seq = self.seq + 1 if seq is None else seq
+            self.received += 1
+            self._frames.append((self.seq, frame))
+            self._cond.notify_all()
+            return self.seq
+
+    def get(self, timeout = None):
+        """
+        Wait for the next frame and return (seq, frame). Returns None if no frame arrived within
+        timeout seconds (None waits forever), or if the queue was closed.
+        """
+        with self._cond:
+            if timeout is not None:
+                deadline = time.time() + timeout
+            while not self._frames and not self._closed:
+                if timeout is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return None
+                    self._cond.wait(remaining)
+            if not self._frames:
+                return None
+            self.processed += 1
+            item = self._frames.popleft()
+            self._cond.notify_all()
+            return item
+
+    def close(self):
+        """ Wake up all consumers, get returns None from now on once the queue is empty """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def stats(self):
+        """ Return the number of frames received, dropped, processed and still queued """
+        with self._cond:
+            return {'received': self.received, 'dropped': self.dropped, 'processed': self.processed,
+                    'queued': len(self._frames)}
+
+
+class RateController(object):
+    """
+    Decides which live frames are worth processing, and at which resolution, so that the display
+    keeps up with the camera.
+
+    Frames older than max_age seconds (None for no limit) when their detection starts are dropped
+    as stale. The latency of the frames, from their capture to the end of their detection, is
+    smoothed over the last frames. While it exceeds budget seconds (None for no budget), the load
+    is lowered one step every few frames: first by letting only one in interval frames into the
+    pipeline, then by detecting at a lower resolution, down to min_resolution times the default
+    (in pixels). Once the latency is under half the budget, the steps are undone in reverse order.
+
+    Frames skipped are the ones the queues would have dropped anyway, but only after converting
+    them, and skipping stops helping once the detector keeps up with the admitted frames: interval
+    never grows past the number of frames received during one detection.
+    """
+    def __init__(self, max_age = None, budget = None, min_resolution = 0.25, max_interval = 30,
+                 smoothing = 0.2, hold = 5):
+        self.max_age = max_age
+        self.budget = budget
+        self.min_resolution = min_resolution
+        self.max_interval = max_interval
+        self.smoothing = smoothing
+        # Number of detections between two changes, for the smoothed latency to follow
+        self.hold = hold
+        self.interval = 1
+        # Fraction of the default detection resolution, see Calibrator.set_detection_resolution
+        self.resolution = 1.0
+        # Smoothed detection time, latency and time between received frames, in seconds
+        self.detection_time = None
+        self.latency = None
+        self.period = None
+        self.skipped = 0
+        self.stale = 0
+        self._count = 0
+        self._last_received = None
+        self._since_change = 0
+        self._lock = threading.Lock()
+
+    def _smooth(self, average, value):
+        if average is None:
+            return value
+        return average + self.smoothing * (value - average)
+
+    def admit(self):
+        """ Return whether the frame just received should enter the pipeline """
+        with self._lock:
+            now = time.time()
+            if self._last_received is not None:
+                self.period = self._smooth(self.period, now - self._last_received)
+            self._last_received = now
+            self._count += 1
+            if self._count % self.interval:
+                self.skipped += 1
+                return False
+            return True
+
+    def is_stale(self, age):
+        """ Return whether a frame age seconds old should be dropped instead of detected """
+        if self.max_age is None or age <= self.max_age:
+            return False
+        with self._lock:
+            self.stale += 1
+        return True
+
+    def detected(self, detection_time, latency):
+        """ Record the detection time of a frame and its latency, in seconds, and adapt the load """
+        with self._lock:
+            self.detection_time = self._smooth(self.detection_time, detection_time)
+            self.latency = self._smooth(self.latency, latency)
+            if self.budget is None:
+                return
+            useful = self.max_interval
+            if self.period:
+                useful = min(useful, max(1, int(math.ceil(self.detection_time / self.period))))
+            self.interval = min(self.interval, useful)
+            self._since_change += 1
+            if self._since_change < self.hold:
+                return
+            if self.latency > self.budget:
+                if self.interval < useful:
+                    self.interval += 1
+                elif self.resolution > self.min_resolution:
+                    self.resolution = max(self.min_resolution, self.resolution * 0.75)
+                else:
+                    return
+            elif self.latency < 0.5 * self.budget:
+                if self.resolution < 1.0:
+                    self.resolution = min(1.0, self.resolution / 0.75)
+                elif self.interval > 1:
+                    self.interval -= 1
+                else:
+                    return
+            else:
+                return
+            self._since_change = 0
+
+    def stats(self):
+        """ Return the numbers of frames skipped and stale, and the current state of the controller """
+        with self._lock:
+            return {'skipped': self.skipped, 'stale': self.stale, 'interval': self.interval,
+                    'resolution': self.resolution, 'detection_time': self.detection_time,
+                    'latency': self.latency}
+
+
+class Stage(object):
+    """
+    Step of a Pipeline: function applied to every frame by a number of worker threads. Whatever
+    the number of workers, results leave the stage in the order the frames entered it. Frames for
+    which the function returns None are dropped.
+    """
+    def __init__(self, name, function, workers = 1):
+        self.name = name
+        self.function = function
+        self.workers = max(1, workers)
+        self._input_lock = threading.Lock()
+        self._output_cond = threading.Condition()
+        # Tickets give the order in which frames were taken from the input queue
+        self._next_ticket = 0
+        self._next_output = 0
+
+    def serve(self, source, sink):
+        """
+        Worker loop: apply the function to the frames of the source queue, and pass the results
+        to sink(result, seq) until the source is closed.
+        """
+        while True:
+            # wait for the next frame, each one is handled only once
+            with self._input_lock:
+                item = source.get()
+                ticket = self._next_ticket
+                self._next_ticket += 1
+            if item is None:
+                break
+            (seq, frame) = item
+            try:
+                result = self.function(frame)
+                failed = False
+            except Exception:
+                # Keep serving the next frames
+                traceback.print_exc()
+                failed = True
+            # Hand the results over in order
+            with self._output_cond:
+                while self._next_output != ticket:
+                    self._output_cond.wait()
+                try:
+                    if not failed and result is not None:
+                        sink(result, seq)
+                finally:
+                    self._next_output += 1
+                    self._output_cond.notify_all()
+
+class Pipeline(object):
+    """
+    Chain of stages connected by bounded frame queues. Each stage is served by its own worker
+    threads and passes its results on to the next one; the results of the last stage are given
+    to the output function.
+    """
+    def __init__(self, stages, output, queue_size = 1, policy = DropPolicy.Latest):
+        self.stages = stages
+        self.queues = [FrameQueue(queue_size, policy) for stage in stages]
+        self.threads = []
+        for (i, stage) in enumerate(stages):
+            if i + 1 < len(stages):
+                sink = self.queues[i + 1].put
+            else:
+                sink = lambda result, seq: output(result)
+            for j in range(stage.workers):
+                th = threading.Thread(target = stage.serve, args = (self.queues[i], sink))
+                th.setDaemon(True)
+                th.start()
+                self.threads.append(th)
+
+    @property
+    def input(self):
+        return self.queues[0]
+
+    def put(self, frame):
+        return self.input.put(frame)
+
+    def close(self):
+        for queue in self.queues:
+            queue.close()
+
+    def named_queues(self, prefix):
+        """ Return the queues in front of each stage, by name """
+        return dict(("%s/%s" % (prefix, stage.name), queue) for (stage, queue) in zip(self.stages, self.queues))
+
+
+class JobCancelled(Exception):
+    pass
+
+class Job(threading.Thread):
+    """
+    Action run in the background, e.g. calibrating or saving. The action is given the progress
+    method of the job, to report the fraction of the work done. Once the job is cancelled, the next
+    progress report raises JobCancelled, aborting the action. After the job, cancelled tells
+    whether it was aborted that way, and error holds the exception the action failed with if any.
+    """
+    def __init__(self, name, action):
+        threading.Thread.__init__(self, name = name)
+        self.daemon = True
+        self.action = action
+        self.fraction = 0.0
+        self.result = None
+        self.cancelled = False
+        self.error = None
+        self._cancelled = threading.Event()
+
+    def run(self):
+        try:
+            self.result = self.action(self.progress)
+        except JobCancelled:
+            self.cancelled = True
+            print("%s cancelled" % self.name)
+        except Exception as e:
+            self.error = e
+            traceback.print_exc()
+            print("%s failed: %s" % (self.name, e))
+
+    def progress(self, fraction):
+        if self._cancelled.is_set():
+            raise JobCancelled()
+        self.fraction = fraction
+
+    def cancel(self):
+        self._cancelled.set()
+
+
 class DisplayThread(threading.Thread):
     """
     Thread that displays the current images
@@ -64,35 +379,32 @@ class DisplayThread(threading.Thread):
         cv2.namedWindow("display", cv2.WINDOW_NORMAL)
         cv2.setMouseCallback("display", self.opencv_calibration_node.on_mouse)
         cv2.createTrackbar("scale", "display", 0, 100, self.opencv_calibration_node.on_scale)
+        im = None
         while True:
-            # wait for an image (could happen at the very beginning when the queue is still empty)
-            while len(self.queue) == 0:
-                time.sleep(0.1)
-            im = self.queue[0]
-            cv2.imshow("display", im)
+            # Block until the first image, then keep the GUI responsive and only redraw on new images
+            item = self.queue.get(timeout = None if im is None else 0)
+            if item is not None:
+                im = item[1]
+                cv2.imshow("display", im)
+            elif im is None:
+                # queue closed
+                break
             k = cv2.waitKey(6) & 0xFF
             if k in [27, ord('q')]:
                 rospy.signal_shutdown('Quit')
             elif k == ord('s'):
                 self.opencv_calibration_node.screendump(im)
 
-class ConsumerThread(threading.Thread):
-    def __init__(self, queue, function):
-        threading.Thread.__init__(self)
-        self.queue = queue
-        self.function = function
-
-    def run(self):
-        while True:
-            # wait for an image (could happen at the very beginning when the queue is still empty)
-            while len(self.queue) == 0:
-                time.sleep(0.1)
-            self.function(self.queue[0])
-
-
 class CalibrationNode:
     def __init__(self, boards, service_check = True, synchronizer = message_filters.TimeSynchronizer, flags = 0,
-                 pattern=Patterns.Chessboard, camera_name='', checkerboard_flags = 0, max_chessboard_speed = -1):
+                 pattern=Patterns.Chessboard, camera_name='', checkerboard_flags = 0, max_chessboard_speed = -1,
+                 roi_tracking = False, flow_tracking = False, redetect_interval = 10,
+                 queue_size = 1, drop_policy = DropPolicy.Latest, stage_workers = None,
+                 image_storage = ImageStorage.Memory, memory_budget = None, live_interval = 0,
+                 fixed_point_maps = False, compressed = False, save_format = 'tar', save_compression = '',
+                 save_compression_level = None, lazy_refinement = False,
+                 pyramid_detection = False, min_sharpness = 0.0, max_frame_difference = -1.0,
+                 max_frame_age = None, latency_budget = None):
         if service_check:
             # assume any non-default service names have been set.  Wait for the service to become ready
             for svcname in ["camera", "left_camera", "right_camera"]:
@@ -113,12 +425,35 @@ class CalibrationNode:
         self._pattern = pattern
         self._camera_name = camera_name
         self._max_chessboard_speed = max_chessboard_speed
-        lsub = message_filters.Subscriber('left', sensor_msgs.msg.Image)
-        rsub = message_filters.Subscriber('right', sensor_msgs.msg.Image)
+        self._roi_tracking = roi_tracking
+        self._flow_tracking = flow_tracking
+        self._redetect_interval = redetect_interval
+        self._image_storage = image_storage
+        self._memory_budget = memory_budget
+        self._live_interval = live_interval
+        self._fixed_point_maps = fixed_point_maps
+        self._save_format = save_format
+        self._save_compression = save_compression
+        self._save_compression_level = save_compression_level
+        self._lazy_refinement = lazy_refinement
+        self._pyramid_detection = pyramid_detection
+        self._min_sharpness = min_sharpness
+        self._max_frame_difference = max_frame_difference
+        if compressed:
+            # Compressed images are published next to the raw ones, as image_transport does
+            def topic(name):
+                return rospy.resolve_name(name) + '/compressed'
+            msg_type = sensor_msgs.msg.CompressedImage
+        else:
+            def topic(name):
+                return name
+            msg_type = sensor_msgs.msg.Image
+        lsub = message_filters.Subscriber(topic('left'), msg_type)
+        rsub = message_filters.Subscriber(topic('right'), msg_type)
         ts = synchronizer([lsub, rsub], 4)
         ts.registerCallback(self.queue_stereo)
 
-        msub = message_filters.Subscriber('image', sensor_msgs.msg.Image)
+        msub = message_filters.Subscriber(topic('image'), msg_type)
         msub.registerCallback(self.queue_monocular)
 
         self.set_camera_info_service = rospy.ServiceProxy("%s/set_camera_info" % rospy.remap_name("camera"),
@@ -128,18 +463,29 @@ class CalibrationNode:
         self.set_right_camera_info_service = rospy.ServiceProxy("%s/set_camera_info" % rospy.remap_name("right_camera"),
                                                                 sensor_msgs.srv.SetCameraInfo)
 
-        self.q_mono = deque([], 1)
-        self.q_stereo = deque([], 1)
-
         self.c = None
-
-        mth = ConsumerThread(self.q_mono, self.handle_monocular)
-        mth.setDaemon(True)
-        mth.start()
-
-        sth = ConsumerThread(self.q_stereo, self.handle_stereo)
-        sth.setDaemon(True)
-        sth.start()
+        self._calibrator_lock = threading.Lock()
+
+        # Interim solutions of the background calibration, see Calibrator.update_live_estimate
+        self.live_pub = rospy.Publisher('live_calibration', String, queue_size = 1)
+        self._live_published = 0
+
+        # Number of worker threads of each stage of the pipelines, see make_pipeline
+        self._stage_workers = dict(stage_workers or {})
+        if self._stage_workers.get('detect', 1) > 1 and self.sequential_detection(latency_budget):
+            print("Detecting on a single thread, as the detection of each frame depends on the previous ones")
+            self._stage_workers['detect'] = 1
+        # Frames skipped or dropped as stale before detection, see RateController
+        self.mono_rate = RateController(max_frame_age, latency_budget)
+        self.stereo_rate = RateController(max_frame_age, latency_budget)
+        self.mono_pipeline = self.make_pipeline(MonoCalibrator, self.show_monocular, queue_size, drop_policy,
+                                                self.mono_rate)
+        self.stereo_pipeline = self.make_pipeline(StereoCalibrator, self.show_stereo, queue_size, drop_policy,
+                                                  self.stereo_rate)
+        self.q_mono = self.mono_pipeline.input
+        self.q_stereo = self.stereo_pipeline.input
+
+        rospy.on_shutdown(self.report_queues)
 
     def redraw_stereo(self, *args):
         pass
@@ -147,42 +493,140 @@ class CalibrationNode:
         pass
 
     def queue_monocular(self, msg):
-        self.q_mono.append(msg)
+        if self.mono_rate.admit():
+            self.q_mono.put((self.capture_time(msg), msg))
 
     def queue_stereo(self, lmsg, rmsg):
-        self.q_stereo.append((lmsg, rmsg))
-
-    def handle_monocular(self, msg):
-        if self.c == None:
-            if self._camera_name:
-                self.c = MonoCalibrator(self._boards, self._calib_flags, self._pattern, name=self._camera_name,
-                                        checkerboard_flags=self._checkerboard_flags,
-                                        max_chessboard_speed = self._max_chessboard_speed)
-            else:
-                self.c = MonoCalibrator(self._boards, self._calib_flags, self._pattern,
-                                        checkerboard_flags=self.checkerboard_flags,
-                                        max_chessboard_speed = self._max_chessboard_speed)
-
-        # This should just call the MonoCalibrator
-        drawable = self.c.handle_msg(msg)
+        if self.stereo_rate.admit():
+            self.q_stereo.put((self.capture_time(lmsg), (lmsg, rmsg)))
+
+    def capture_time(self, msg):
+        """ Return the time of the header stamp of msg in seconds, or the current time if it has none """
+        stamp = msg.header.stamp.to_sec()
+        if stamp == 0:
+            return rospy.get_time()
+        return stamp
+
+    def queues(self):
+        """ Return the frame queues of the node by name """
+        queues = self.mono_pipeline.named_queues('mono')
+        queues.update(self.stereo_pipeline.named_queues('stereo'))
+        return queues
+
+    def report_queues(self):
+        for (name, queue) in sorted(self.queues().items()):
+            stats = queue.stats()
+            if stats['received']:
+                print("Queue %s: %d frames received, %d processed, %d dropped" %
+                      (name, stats['received'], stats['processed'], stats['dropped']))
+        for (name, rate) in [('mono', self.mono_rate), ('stereo', self.stereo_rate)]:
+            stats = rate.stats()
+            if stats['latency'] is not None:
+                print("Rate %s: %d frames skipped, %d stale, detection %.1f ms, latency %.1f ms, "
+                      "1 frame in %d at %d%% resolution" %
+                      (name, stats['skipped'], stats['stale'], stats['detection_time'] * 1000,
+                       stats['latency'] * 1000, stats['interval'], stats['resolution'] * 100))
+
+    def sequential_detection(self, latency_budget):
+        """
+        Return whether the detection of a frame depends on the previous frames, through tracking,
+        pyramid detection, the frame gate, the chessboard speed or the resolution set for the
+        latency budget. The calibrator keeps that state, which must then be detected on by a single
+        worker, in the order of the frames.
+        """
+        return (self._roi_tracking or self._flow_tracking or self._pyramid_detection or self._min_sharpness > 0 or
+                self._max_frame_difference >= 0 or self._max_chessboard_speed > 0 or latency_budget is not None)
+
+    def make_pipeline(self, calibrator_class, show, queue_size, drop_policy, rate):
+        """
+        Build the chain of stages handling the (capture time, message) frames of one camera
+        mode: conversion to monochrome, detection of the calibration target, scoring and insertion
+        into the sample database (on a single thread, as it depends on the previous frame), and
+        rendering of the display. Frames gone stale by the time of their detection are dropped,
+        and the detections are timed, see RateController.
+        """
+        def convert(frame):
+            (stamp, msg) = frame
+            c = self.get_calibrator(calibrator_class)
+            return (c, stamp, c.convert(msg))
+        def detect(frame):
+            (c, stamp, img) = frame
+            if rate.is_stale(rospy.get_time() - stamp):
+                return None
+            if c.detection_pixels != int(640 * 480 * rate.resolution):
+                c.set_detection_resolution(rate.resolution)
+            start = time.time()
+            detection = c.detect(img)
+            rate.detected(time.time() - start, rospy.get_time() - stamp)
+            return (c, img, detection)
+        def score(frame):
+            (c, img, detection) = frame
+            params = c.score(img, detection)
+            self.publish_live_estimate(c)
+            return (c, img, detection, params)
+        def render(frame):
+            (c, img, detection, params) = frame
+            return c.render(img, detection, params)
+
+        workers = self._stage_workers
+        stages = [Stage('convert', convert, workers.get('convert', 1)),
+                  Stage('detect', detect, workers.get('detect', 1)),
+                  Stage('score', score),
+                  Stage('render', render, workers.get('render', 1))]
+        return Pipeline(stages, show, queue_size, drop_policy)
+
+    def calibrator_kwargs(self):
+        """ Keyword arguments used to build the calibrator once the first image arrives """
+        kwargs = {'checkerboard_flags': self._checkerboard_flags,
+                  'max_chessboard_speed': self._max_chessboard_speed,
+                  'roi_tracking': self._roi_tracking,
+                  'flow_tracking': self._flow_tracking,
+                  'redetect_interval': self._redetect_interval,
+                  'image_storage': self._image_storage,
+                  'memory_budget': self._memory_budget,
+                  'live_interval': self._live_interval,
+                  'fixed_point_maps': self._fixed_point_maps,
+                  'save_format': self._save_format,
+                  'save_compression': self._save_compression,
+                  'save_compression_level': self._save_compression_level,
+                  'lazy_refinement': self._lazy_refinement,
+                  'pyramid_detection': self._pyramid_detection,
+                  'min_sharpness': self._min_sharpness,
+                  'max_frame_difference': self._max_frame_difference}
+        if self._camera_name:
+            kwargs['name'] = self._camera_name
+        return kwargs
+
+    def get_calibrator(self, calibrator_class):
+        """ Return the calibrator, built on first use """
+        with self._calibrator_lock:
+            if self.c == None:
+                self.c = calibrator_class(self._boards, self._calib_flags, self._pattern, **self.calibrator_kwargs())
+            return self.c
+
+    def publish_live_estimate(self, c):
+        """ Publish the interim calibration of c if the background solver produced a new one """
+        if c.live_samples != self._live_published:
+            self._live_published = c.live_samples
+            report = c.live_report()
+            print(report)
+            self.live_pub.publish(String(report))
+
+    def show_monocular(self, drawable):
         self.displaywidth = drawable.scrib.shape[1]
         self.redraw_monocular(drawable)
 
-    def handle_stereo(self, msg):
-        if self.c == None:
-            if self._camera_name:
-                self.c = StereoCalibrator(self._boards, self._calib_flags, self._pattern, name=self._camera_name,
-                                          checkerboard_flags=self._checkerboard_flags,
-                                          max_chessboard_speed = self._max_chessboard_speed)
-            else:
-                self.c = StereoCalibrator(self._boards, self._calib_flags, self._pattern,
-                                          checkerboard_flags=self._checkerboard_flags,
-                                          max_chessboard_speed = self._max_chessboard_speed)
-
-        drawable = self.c.handle_msg(msg)
+    def show_stereo(self, drawable):
         self.displaywidth = drawable.lscrib.shape[1] + drawable.rscrib.shape[1]
         self.redraw_stereo(drawable)
 
+    def handle_monocular(self, msg):
+        # This should just call the MonoCalibrator
+        self.show_monocular(self.get_calibrator(MonoCalibrator).handle_msg(msg))
+
+    def handle_stereo(self, msg):
+        self.show_stereo(self.get_calibrator(StereoCalibrator).handle_msg(msg))
+
 
     def check_set_camera_info(self, response):
         if response.success:
@@ -199,16 +643,18 @@ class CalibrationNode:
         rospy.logerr('Unable to set camera info for calibration. Failure message: %s' % response.status_message)
         return False
 
-    def do_upload(self):
+    def do_upload(self, progress = lambda fraction: None):
         self.c.report()
         print(self.c.ost())
         info = self.c.as_message()
 
         rv = True
+        progress(0.0)
         if self.c.is_mono:
             response = self.set_camera_info_service(info)
             rv = self.check_set_camera_info(response)
         else:
+            # Not cancelled between the cameras, which would upload only one of them
             response = self.set_left_camera_info_service(info[0])
             rv = rv and self.check_set_camera_info(response)
             response = self.set_right_camera_info_service(info[1])
@@ -226,11 +672,19 @@ class OpenCVCalibrationNode(CalibrationNode):
 
         CalibrationNode.__init__(self, *args, **kwargs)
 
-        self.queue_display = deque([], 1)
+        # Background job started by the buttons, see on_mouse
+        self.job = None
+
+        self.queue_display = FrameQueue(1)
         self.display_thread = DisplayThread(self.queue_display, self)
         self.display_thread.setDaemon(True)
         self.display_thread.start()
 
+    def queues(self):
+        queues = CalibrationNode.queues(self)
+        queues['display'] = self.queue_display
+        return queues
+
     @classmethod
     def putText(cls, img, text, org, color = (0,0,0)):
         cv2.putText(img, text, org, cls.FONT_FACE, cls.FONT_SCALE, color, thickness = cls.FONT_THICKNESS)
@@ -241,16 +695,45 @@ class OpenCVCalibrationNode(CalibrationNode):
 
     def on_mouse(self, event, x, y, flags, param):
         if event == cv2.EVENT_LBUTTONDOWN and self.displaywidth < x:
+            if self.job_running():
+                # The button of the running job cancels it, the others wait for it
+                if self.job.name == self.button_at(y):
+                    self.job.cancel()
+                return
             if self.c.goodenough:
                 if 180 <= y < 280:
-                    self.c.do_calibration()
+                    self.start_job("CALIBRATE", self.c.do_calibration)
             if self.c.calibrated:
                 if 280 <= y < 380:
-                    self.c.do_save()
+                    self.start_job("SAVE", self.c.do_save)
                 elif 380 <= y < 480:
-                    # Only shut down if we set camera info correctly, #3993
-                    if self.do_upload():
-                        rospy.signal_shutdown('Quit')
+                    self.start_job("COMMIT", self.commit)
+
+    def commit(self, progress):
+        # Only shut down if we set camera info correctly, #3993
+        if self.do_upload(progress):
+            rospy.signal_shutdown('Quit')
+
+    def start_job(self, name, action):
+        """
+        Run action in the background as the job of button name, see Job. Returns False, without
+        starting it, while another job runs.
+        """
+        if self.job_running():
+            return False
+        self.job = Job(name, lambda progress: action(progress = progress))
+        self.job.start()
+        return True
+
+    def job_running(self):
+        return self.job is not None and self.job.is_alive()
+
+    @staticmethod
+    def button_at(y):
+        for (label, top) in [("CALIBRATE", 180), ("SAVE", 280), ("COMMIT", 380)]:
+            if top <= y < top + 100:
+                return label
+        return None
 
     def on_scale(self, scalevalue):
         if self.c.calibrated:
@@ -269,9 +752,17 @@ class OpenCVCalibrationNode(CalibrationNode):
 
     def buttons(self, display):
         x = self.displaywidth
-        self.button(display[180:280,x:x+100], "CALIBRATE", self.c.goodenough)
-        self.button(display[280:380,x:x+100], "SAVE", self.c.calibrated)
-        self.button(display[380:480,x:x+100], "COMMIT", self.c.calibrated)
+        job = self.job if self.job_running() else None
+        for (label, top, enable) in [("CALIBRATE", 180, self.c.goodenough),
+                                     ("SAVE", 280, self.c.calibrated),
+                                     ("COMMIT", 380, self.c.calibrated)]:
+            if job is None:
+                self.button(display[top:top+100,x:x+100], label, enable)
+            elif job.name == label:
+                # Progress of the running job, a click cancels it
+                self.button(display[top:top+100,x:x+100], "%d%%" % (100 * job.fraction), True)
+            else:
+                self.button(display[top:top+100,x:x+100], label, False)
 
     def y(self, i):
         """Set up right-size images"""
@@ -316,7 +807,7 @@ class OpenCVCalibrationNode(CalibrationNode):
                 #print "linear", linerror
             self.putText(display, msg, (width, self.y(1)))
 
-        self.queue_display.append(display)
+        self.queue_display.put(display)
 
     def redraw_stereo(self, drawable):
         height = drawable.lscrib.shape[0]
@@ -354,4 +845,4 @@ class OpenCVCalibrationNode(CalibrationNode):
                 self.putText(display, "dim", (2 * width, self.y(2)))
                 self.putText(display, "%.3f" % drawable.dim, (2 * width, self.y(3)))
 
-        self.queue_display.append(display)
+        self.queue_display.put(display)
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+#
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2009, Willow Garage, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#  * Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+#  * Neither the name of the Willow Garage nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+import collections
+import hashlib
+import json
+import numpy
+import os
+import tempfile
+
+
+class CornerCache(object):
+    """
+    Corners detected in the image files of a calibration archive, keyed by the SHA-1 digest of the
+    file data, so that calibrating again from the same archive does not have to detect them again.
+
+    Corners are only valid for the detector settings they were found with (a JSON-serializable
+    dict, see Calibrator.corner_cache_settings): get and put use the settings of the cache, the
+    corners found with other settings are only kept to be saved again. Boards are given by their
+    index in the board list of the settings.
+
+    Caches are saved as .npz files holding the names, digests, image sizes, board indices (-1 when
+    the target was not found), corners and settings of the images.
+    """
+    def __init__(self, settings):
+        self.settings = settings
+        self._key = self._settings_key(settings)
+        # (settings key, digest) -> (name, (width, height), corners or None, board index or None)
+        self._entries = collections.OrderedDict()
+        # Set when entries are added after loading
+        self.modified = False
+
+    def __len__(self):
+        return len([key for (key, _) in self._entries if key == self._key])
+
+    @staticmethod
+    def digest(data):
+        return hashlib.sha1(data).hexdigest()
+
+    def get(self, digest):
+        """ Return (size, corners, board index) of the file with this digest, None if unknown """
+        entry = self._entries.get((self._key, digest))
+        if entry is None:
+            return None
+        return entry[1:]
+
+    def put(self, name, digest, size, corners, board):
+        self._entries[(self._key, digest)] = (name, tuple(size), corners, board)
+        self.modified = True
+
+    def save(self, f):
+        """
+        Write the cache to f, a file name or object. A file name is only replaced once the whole
+        cache is written, so that an interrupted save does not leave a truncated file.
+        """
+        if not hasattr(f, 'write'):
+            (fd, tmp) = tempfile.mkstemp(suffix = '.tmp', dir = os.path.dirname(os.path.abspath(f)))
+            try:
+                with os.fdopen(fd, 'wb') as tmp_file:
+                    self.save(tmp_file)
+                getattr(os, 'replace', os.rename)(tmp, f)
+            except BaseException:
+                os.remove(tmp)
+                raise
+            return
+        keys = list(collections.OrderedDict.fromkeys(key for (key, _) in self._entries))
+        entries = [(keys.index(key), digest) + entry for ((key, digest), entry) in self._entries.items()]
+        corners = [c.reshape(-1, 2) for (_, _, _, _, c, _) in entries if c is not None]
+        numpy.savez(f,
+                    settings = numpy.array(keys, dtype = numpy.str_),
+                    entry_settings = numpy.array([k for (k, _, _, _, _, _) in entries], numpy.int64),
+                    digests = numpy.array([digest for (_, digest, _, _, _, _) in entries], dtype = numpy.str_),
+                    names = numpy.array([name for (_, _, name, _, _, _) in entries], dtype = numpy.str_),
+                    sizes = numpy.array([size for (_, _, _, size, _, _) in entries], numpy.int64).reshape(-1, 2),
+                    boards = numpy.array([-1 if b is None else b for (_, _, _, _, _, b) in entries], numpy.int64),
+                    counts = numpy.array([0 if c is None else len(c) for (_, _, _, _, c, _) in entries], numpy.int64),
+                    corners = numpy.vstack(corners).astype(numpy.float32) if corners else numpy.zeros((0, 2), numpy.float32))
+        self.modified = False
+
+    @classmethod
+    def load(cls, f, settings):
+        """ Read a cache written by save from f, a file name or object, to be used with settings """
+        cache = cls(settings)
+        data = numpy.load(f, allow_pickle = False)
+        keys = [str(key) for key in data['settings']]
+        offsets = numpy.cumsum(numpy.concatenate(([0], data['counts'])))
+        corners = data['corners']
+        entries = zip(data['entry_settings'], data['digests'], data['names'], data['sizes'], data['boards'])
+        for (i, (k, digest, name, size, board)) in enumerate(entries):
+            size = tuple(int(s) for s in size)
+            if board < 0:
+                (points, board) = (None, None)
+            else:
+                (points, board) = (corners[offsets[i]:offsets[i + 1]].reshape(-1, 1, 2).copy(), int(board))
+            cache._entries[(keys[k], str(digest))] = (str(name), size, points, board)
+        return cache
+
+    @staticmethod
+    def _settings_key(settings):
+        return json.dumps(settings, sort_keys = True)
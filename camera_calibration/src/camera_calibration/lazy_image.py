@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+#
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2009, Willow Garage, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#  * Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+#  * Neither the name of the Willow Garage nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import abc
+import cv2
+import numpy
+import struct
+import threading
+
+
+# Base class with abstract methods on both python 2 and 3
+_ABC = abc.ABCMeta('_ABC', (object,), {})
+
+class LazyMono(_ABC):
+    """
+    8-bit monochrome image decoded on demand. shape is known up front, full() decodes the image
+    at full resolution (once), and resized() gives a smaller version without decoding the full
+    image when the source allows it. Subclasses implement _decode().
+    """
+    def __init__(self, shape):
+        self.shape = shape
+        self._full = None
+        self._lock = threading.Lock()
+
+    def full(self):
+        """ Return the full-resolution image """
+        with self._lock:
+            if self._full is None:
+                self._full = self._decode()
+            return self._full
+
+    def resized(self, size):
+        """ Return the image resized to size (width, height), as cv2.resize would """
+        return cv2.resize(self.full(), size)
+
+    @abc.abstractmethod
+    def _decode(self):
+        """ Return the full-resolution image """
+
+def full_image(img):
+    """ Return img as a numpy array, decoding it if it is a LazyMono """
+    if isinstance(img, LazyMono):
+        return img.full()
+    return img
+
+def _image_size(data):
+    """ Return the (width, height) of a PNG or JPEG image from its header, None if unknown """
+    if data[:8] == b'\x89PNG\r\n\x1a\n' and len(data) >= 24:
+        return struct.unpack('>II', data[16:24])
+    if data[:2] == b'\xff\xd8':
+        i = 2
+        while i + 9 <= len(data):
+            if data[i:i + 1] != b'\xff':
+                return None
+            marker = data[i + 1:i + 2]
+            if marker == b'\xff':
+                # Fill byte
+                i += 1
+                continue
+            (length,) = struct.unpack('>H', data[i + 2:i + 4])
+            # Start of frame markers hold the image size, except DHT, JPG and DAC
+            if b'\xc0' <= marker <= b'\xcf' and marker not in [b'\xc4', b'\xc8', b'\xcc']:
+                (height, width) = struct.unpack('>HH', data[i + 5:i + 9])
+                return (width, height)
+            i += 2 + length
+    return None
+
+class CompressedMono(LazyMono):
+    """
+    Monochrome version of a sensor_msgs/CompressedImage (PNG or JPEG). Smaller versions are
+    decoded straight at 1/2, 1/4 or 1/8 resolution, which is much faster for JPEG.
+    """
+    # Reduced decoding flags, by scale
+    _reductions = [(8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+                   (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+                   (2, cv2.IMREAD_REDUCED_GRAYSCALE_2)]
+
+    def __init__(self, msg):
+        data = msg.data
+        if isinstance(data, (list, tuple)):
+            data = bytearray(data)
+        self.data = numpy.frombuffer(data, numpy.uint8)
+        size = _image_size(data)
+        if size is None:
+            LazyMono.__init__(self, None)
+            self.shape = self.full().shape
+        else:
+            LazyMono.__init__(self, (size[1], size[0]))
+
+    def resized(self, size):
+        (width, height) = size
+        if self._full is None:
+            for (scale, flag) in self._reductions:
+                if width * scale <= self.shape[1] and height * scale <= self.shape[0]:
+                    reduced = cv2.imdecode(self.data, flag)
+                    if (reduced.shape[1], reduced.shape[0]) == size:
+                        return reduced
+                    return cv2.resize(reduced, size)
+        return LazyMono.resized(self, size)
+
+    def _decode(self):
+        img = cv2.imdecode(self.data, cv2.IMREAD_GRAYSCALE)
+        if img is None:
+            raise ValueError("Cannot decode compressed image")
+        return img
+
+class BayerMono(LazyMono):
+    """
+    Monochrome version of a raw 8-bit Bayer image, given as a (height, width) array of sites and
+    the ROS name of its pattern (e.g. 'rggb'). Versions at half resolution or less only use the
+    green sites, the full image is demosaiced on demand.
+    """
+    # OpenCV names the Bayer patterns after the second row: ROS rggb is OpenCV BayerBG
+    _conversions = {'rggb': cv2.COLOR_BayerBG2GRAY,
+                    'bggr': cv2.COLOR_BayerRG2GRAY,
+                    'gbrg': cv2.COLOR_BayerGR2GRAY,
+                    'grbg': cv2.COLOR_BayerGB2GRAY}
+
+    def __init__(self, raw, pattern):
+        LazyMono.__init__(self, raw.shape)
+        self.raw = raw
+        self.pattern = pattern
+
+    def resized(self, size):
+        (width, height) = size
+        if self._full is None and width * 2 <= self.shape[1] and height * 2 <= self.shape[0]:
+            # Each row of sites seen as (width / 2) pairs of channels, a copy-free 2-channel image
+            (rows, cols) = (self.shape[0] // 2 * 2, self.shape[1] // 2)
+            pairs = numpy.lib.stride_tricks.as_strided(self.raw, (rows, cols, 2), (self.raw.strides[0], 2, 1))
+            if self.pattern[0] == 'g':
+                (channel1, channel2) = (0, 1)
+            else:
+                (channel1, channel2) = (1, 0)
+            # OpenCV reduces by whole factors with a slow area average, skip it
+            interpolation = cv2.INTER_LINEAR
+            if cols % width == 0 and (rows // 2) % height == 0:
+                interpolation = getattr(cv2, 'INTER_LINEAR_EXACT', cv2.INTER_LINEAR)
+            # Both green planes are resized on their own, reading only the sites the resizing
+            # samples, then averaged
+            green1 = cv2.extractChannel(cv2.resize(pairs[0::2], size, interpolation = interpolation), channel1)
+            green2 = cv2.extractChannel(cv2.resize(pairs[1::2], size, interpolation = interpolation), channel2)
+            return cv2.addWeighted(green1, 0.5, green2, 0.5, 0)
+        return LazyMono.resized(self, size)
+
+    def _decode(self):
+        return cv2.cvtColor(self.raw, self._conversions[self.pattern])
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+#
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2009, Willow Garage, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#  * Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+#  * Neither the name of the Willow Garage nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import cv2
+import numpy
+import tempfile
+import threading
+
+
+# How the images of the samples are kept once the memory budget is exhausted
+class ImageStorage:
+    Memory, Png, Mmap, Discard = list(range(4))
+
+class _PngImage(object):
+    """ Image kept as a lossless PNG buffer """
+    def __init__(self, img):
+        self.png = cv2.imencode(".png", img)[1]
+        self.nbytes = self.png.nbytes
+
+    def load(self):
+        return cv2.imdecode(self.png, cv2.IMREAD_UNCHANGED)
+
+class _MappedImage(object):
+    """ Image spilled to a scratch file, read back through a memory map """
+    nbytes = 0
+
+    def __init__(self, scratch, offset, img):
+        self.scratch = scratch
+        self.offset = offset
+        self.shape = img.shape
+        self.dtype = img.dtype
+
+    def load(self):
+        return numpy.memmap(self.scratch, dtype = self.dtype, mode = 'r', offset = self.offset, shape = self.shape)
+
+class SampleStore(object):
+    """
+    Sequence of the calibration samples (params, image[, image]) of a Calibrator.
+
+    Images are kept as they are until they use more than memory_budget bytes (None for no
+    budget), after that new images are stored according to storage: as they are, PNG-compressed
+    in memory, spilled to a memory-mapped scratch file in scratch_dir, or discarded, keeping only
+    the parameters and image size. Images are decoded back when a sample is accessed, the parameters
+    alone are available in params without any decoding.
+
+    The parameters are also indexed column-wise in NumPy arrays, along with their running minimum
+    and maximum, so that novelty queries do not grow in Python with the number of samples.
+    """
+    def __init__(self, storage = ImageStorage.Memory, memory_budget = None, scratch_dir = None):
+        self.storage = storage
+        self.memory_budget = memory_budget
+        self.scratch_dir = scratch_dir
+        # Parameters of the samples, see Calibrator.get_parameters
+        self.params = []
+        # One row per parameter, one column per sample, grown by doubling
+        self._param_columns = None
+        self._param_min = None
+        self._param_max = None
+        # (width, height) of the images
+        self.image_size = None
+        # Bytes of memory used by the stored images
+        self.nbytes = 0
+        self._images = []
+        self._scratch = None
+        self._scratch_size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.params)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return tuple([self.params[i]] + [self._load(stored) for stored in self._images[i]])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def append(self, sample):
+        """ Add a (params, image[, image]) sample """
+        params = sample[0]
+        images = sample[1:]
+        with self._lock:
+            if self.image_size is None:
+                self.image_size = (images[0].shape[1], images[0].shape[0])
+            self._images.append([self._store(img) for img in images])
+            self._index(params)
+            self.params.append(params)
+
+    def nearest_distance(self, params):
+        """ Return the smallest L1 distance between params and the parameters of the samples """
+        n = len(self)
+        if not n:
+            return None
+        columns = self._param_columns[:, :n]
+        # Summed in the same order as sum() over the parameters, for identical thresholding
+        d = numpy.zeros(n)
+        for (column, p) in zip(columns, params):
+            d += numpy.abs(p - column)
+        return d.min()
+
+    def param_range(self):
+        """ Return the lists of the minimum and maximum of each parameter over the samples """
+        if not len(self):
+            return None
+        return (self._param_min, self._param_max)
+
+    def images(self, i):
+        """ Return the images of sample i, None for the discarded ones """
+        return [self._load(stored) for stored in self._images[i]]
+
+    def png(self, i, j):
+        """
+        Return image j of sample i encoded as PNG, without decoding it if it is already stored
+        that way. Returns None if the image was discarded.
+        """
+        stored = self._images[i][j]
+        if isinstance(stored, _PngImage):
+            return stored.png
+        img = self._load(stored)
+        if img is None:
+            return None
+        return cv2.imencode(".png", img)[1]
+
+    def _index(self, params):
+        n = len(self.params)
+        if self._param_columns is None:
+            self._param_columns = numpy.zeros((len(params), 64))
+            self._param_min = list(params)
+            self._param_max = list(params)
+        else:
+            self._param_min = [min(a, b) for (a, b) in zip(self._param_min, params)]
+            self._param_max = [max(a, b) for (a, b) in zip(self._param_max, params)]
+        if n == self._param_columns.shape[1]:
+            self._param_columns = numpy.hstack((self._param_columns, numpy.zeros_like(self._param_columns)))
+        self._param_columns[:, n] = params
+
+    def _store(self, img):
+        if (self.storage == ImageStorage.Memory or
+            (self.memory_budget is not None and self.nbytes + img.nbytes <= self.memory_budget)):
+            self.nbytes += img.nbytes
+            return img
+        if self.storage == ImageStorage.Png:
+            stored = _PngImage(img)
+            self.nbytes += stored.nbytes
+            return stored
+        if self.storage == ImageStorage.Mmap:
+            if self._scratch is None:
+                self._scratch = tempfile.TemporaryFile(prefix = 'calibration_samples', dir = self.scratch_dir)
+            data = numpy.ascontiguousarray(img)
+            stored = _MappedImage(self._scratch, self._scratch_size, data)
+            self._scratch.seek(self._scratch_size)
+            self._scratch.write(data.tobytes())
+            self._scratch.flush()
+            self._scratch_size += data.nbytes
+            return stored
+        return None
+
+    def _load(self, stored):
+        if stored is None or isinstance(stored, numpy.ndarray):
+            return stored
+        return stored.load()
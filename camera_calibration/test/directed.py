@@ -36,17 +36,32 @@ import roslib
 import rosunit
 import rospy
 import cv2
+import sensor_msgs.msg
 
 import collections
 import copy
+import io
+import json
 import numpy
 import os
+import random
+import shutil
 import sys
 import tarfile
+import tempfile
+import threading
+import time
 import unittest
+import zipfile
 
+from camera_calibration import batch_calibration
+from camera_calibration.archive_reader import ArchiveReader
+from camera_calibration.camera_calibrator import DropPolicy, FrameQueue, Job, OpenCVCalibrationNode, Pipeline, \
+    RateController, Stage
 from camera_calibration.calibrator import MonoCalibrator, StereoCalibrator, \
     Patterns, CalibrationException, ChessboardInfo, image_from_archive
+from camera_calibration.lazy_image import CompressedMono, full_image
+from camera_calibration.sample_store import ImageStorage, SampleStore
 
 board = ChessboardInfo()
 board.n_cols = 8
@@ -269,6 +284,646 @@ class TestArtificial(unittest.TestCase):
                          'intrinsics error is %f for resolution i = %d' % (err_intrinsics, i))
             print('intrinsics error is %f' % numpy.linalg.norm(mc.intrinsics - self.K, ord=numpy.inf))
 
+    def test_rectification_maps(self):
+        # Maps are reused when the alpha comes back, fixed-point maps remap the same
+        setup = self.setups[0]
+        board = ChessboardInfo(setup.cols, setup.rows, self.board_width_dim)
+        img = self.limages[0][0]
+        mc = MonoCalibrator([ board ], flags=cv2.CALIB_FIX_K3)
+        mc.cal(self.limages[0])
+        maps = (mc.mapx, mc.mapy)
+        mc.set_alpha(1.0)
+        self.assert_(mc.mapx is not maps[0])
+        mc.set_alpha(0.0)
+        self.assert_(mc.mapx is maps[0] and mc.mapy is maps[1])
+        fixed = MonoCalibrator([ board ], flags=cv2.CALIB_FIX_K3, fixed_point_maps=True)
+        fixed.cal(self.limages[0])
+        self.assertEqual(fixed.mapx.dtype, numpy.int16)
+        self.assert_(numpy.array_equal(mc.remap(img), fixed.remap(img)))
+
+        # Rectifying straight at display size matches rectifying at full size then resizing
+        (width, height) = mc.size
+        full_maps = mc.rectification_maps(mc.P)
+        smooth = cv2.GaussianBlur(img, (0, 0), 3)
+        for size in [(width // 2, height // 2), (width // 3, height // 3), (width * 3 // 4, height * 3 // 4)]:
+            # Pixel centers of the display image in the full-size one
+            xs = (numpy.arange(size[0]) + 0.5) * float(width) / size[0] - 0.5
+            ys = (numpy.arange(size[1]) + 0.5) * float(height) / size[1] - 0.5
+            (gx, gy) = numpy.meshgrid(xs.astype(numpy.float32), ys.astype(numpy.float32))
+            for (full_map, display_map) in zip(full_maps, mc.rectification_maps(mc.P, size)):
+                expected = cv2.remap(full_map, gx, gy, cv2.INTER_LINEAR)
+                self.assert_(numpy.abs(display_map - expected)[2:-2, 2:-2].max() < 0.2)
+            resized = cv2.resize(mc.remap(smooth), size).astype(numpy.float64)
+            self.assert_(numpy.abs(mc.remap(smooth, size) - resized)[2:-2, 2:-2].mean() < 0.5)
+
+    def test_parallel_detection(self):
+        # Detecting on a process pool must give exactly the same calibration as the serial path
+        for i, setup in enumerate(self.setups):
+            board = ChessboardInfo(setup.cols, setup.rows, self.board_width_dim)
+
+            serial = MonoCalibrator([ board ], flags=cv2.CALIB_FIX_K3, pattern=setup.pattern)
+            serial.cal(self.limages[i])
+            parallel = MonoCalibrator([ board ], flags=cv2.CALIB_FIX_K3, pattern=setup.pattern, jobs=2)
+            parallel.cal(self.limages[i])
+
+            self.assert_(numpy.array_equal(serial.intrinsics, parallel.intrinsics))
+            self.assert_(numpy.array_equal(serial.distortion, parallel.distortion))
+
+    def test_tarfile_calibration(self):
+        # Streaming the images of an archive through detection gives the same calibration as cal,
+        # and so do the corners cached by the first run
+        setup = self.setups[0]
+        board = ChessboardInfo(setup.cols, setup.rows, self.board_width_dim)
+        with tempfile.NamedTemporaryFile(suffix='.tar.gz') as f:
+            archive = tarfile.open(fileobj=f, mode='w:gz')
+            for (i, img) in enumerate(self.limages[0]):
+                for side in ['left', 'right']:
+                    png = cv2.imencode('.png', img)[1].tobytes()
+                    info = tarfile.TarInfo('%s-%04d.png' % (side, i))
+                    info.size = len(png)
+                    archive.addfile(info, io.BytesIO(png))
+            archive.close()
+            f.flush()
+            with ArchiveReader(f.name) as archive:
+                self.assert_(numpy.array_equal(image_from_archive(archive, 'left-0001.png')[:, :, 0], self.limages[0][1]))
+
+            mc = MonoCalibrator([ board ], flags=cv2.CALIB_FIX_K3)
+            mc.cal(self.limages[0])
+            sc = StereoCalibrator([ board ], flags=cv2.CALIB_FIX_K3)
+            sc.cal(self.limages[0], self.limages[0])
+            try:
+                for (jobs, corner_cache, hits) in [(1, False, 0), (2, True, 0), (1, True, len(self.limages[0]))]:
+                    mc2 = MonoCalibrator([ board ], flags=cv2.CALIB_FIX_K3, jobs=jobs)
+                    mc2.do_tarfile_calibration(f.name, corner_cache)
+                    self.assertEqual(mc2.size, mc.size)
+                    self.assert_(numpy.array_equal(mc2.intrinsics, mc.intrinsics))
+                    self.assertEqual(mc2.detection_stats['corner_cache_hits'], hits)
+                    sc2 = StereoCalibrator([ board ], flags=cv2.CALIB_FIX_K3, jobs=jobs)
+                    sc2.do_tarfile_calibration(f.name, corner_cache)
+                    self.assert_(numpy.array_equal(sc2.T, sc.T))
+                # Both sides see the same images, so have the same per-view errors
+                errors = mc2.reprojection_errors(mc2.good_corners)
+                self.assertEqual(len(errors), len(mc2.good_corners))
+                self.assertEqual(sc2.reprojection_errors(sc2.good_corners), (errors, errors))
+                # A damaged sidecar, e.g. from an interrupted save, is ignored and written again
+                sidecar = f.name + '.corners.npz'
+                with open(sidecar, 'rb') as cache:
+                    data = cache.read()
+                for damaged in [data[:len(data) // 2], b'garbage']:
+                    with open(sidecar, 'wb') as cache:
+                        cache.write(damaged)
+                    for hits in [0, len(self.limages[0])]:
+                        mc2 = MonoCalibrator([ board ], flags=cv2.CALIB_FIX_K3)
+                        mc2.do_tarfile_calibration(f.name)
+                        self.assertEqual(mc2.detection_stats['corner_cache_hits'], hits)
+                        self.assert_(numpy.array_equal(mc2.intrinsics, mc.intrinsics))
+            finally:
+                if os.path.exists(f.name + '.corners.npz'):
+                    os.remove(f.name + '.corners.npz')
+
+    def test_batch_calibration(self):
+        # The archives share the workers, the same archive given twice is calibrated twice, and a
+        # failing archive does not stop the others
+        setup = self.setups[0]
+        board = ChessboardInfo(setup.cols, setup.rows, self.board_width_dim)
+        tmp = tempfile.mkdtemp()
+        try:
+            good = os.path.join(tmp, 'robot.tar.gz')
+            archive = tarfile.open(good, mode='w:gz')
+            for (i, img) in enumerate(self.limages[0]):
+                png = cv2.imencode('.png', img)[1].tobytes()
+                info = tarfile.TarInfo('left-%04d.png' % i)
+                info.size = len(png)
+                archive.addfile(info, io.BytesIO(png))
+            archive.close()
+            corrupt = os.path.join(tmp, 'robot.tar')
+            with open(corrupt, 'wb') as f:
+                f.write(b'not an archive')
+            open(os.path.join(tmp, 'notes.txt'), 'w').close()
+            os.mkdir(os.path.join(tmp, 'other'))
+            killed = os.path.join(tmp, 'other', 'robot.tar.gz')
+            shutil.copy(good, killed)
+
+            archives = batch_calibration.find_archives([tmp, os.path.join(tmp, '*.tar'), killed])
+            self.assertEqual(archives, [corrupt, good, killed])
+            self.assertEqual(batch_calibration.result_name(good, set(['robot', 'robot-2'])), 'robot-3')
+
+            # The worker of the killed archive exits without reporting
+            calibrate_archive = batch_calibration.calibrate_archive
+            def kill(archive, *args):
+                if archive == killed:
+                    os._exit(3)
+                return calibrate_archive(archive, *args)
+            batch_calibration.calibrate_archive = kill
+            archives.append(good)
+            try:
+                output = os.path.join(tmp, 'output')
+                summary = batch_calibration.run_batch(archives, output, [ board ], mono=True,
+                                                      calib_flags=cv2.CALIB_FIX_K3, jobs=7)
+            finally:
+                batch_calibration.calibrate_archive = calibrate_archive
+
+            with open(os.path.join(output, 'summary.json')) as f:
+                self.assertEqual(json.load(f), json.loads(json.dumps(summary)))
+            self.assertEqual((summary['succeeded'], summary['failed'], summary['jobs']), (2, 2, 7))
+            results = summary['archives']
+            names = ['robot', 'robot-2', 'robot-3', 'robot-4']
+            self.assertEqual([r['archive'] for r in results], archives)
+            self.assertEqual([r['name'] for r in results], names)
+            self.assertEqual([r['output'] for r in results], [os.path.join(output, name) for name in names])
+            self.assertEqual([r['status'] for r in results], ['failed', 'ok', 'failed', 'ok'])
+            self.assertEqual(results[2]['error'], 'worker exited with code 3')
+            # Four archives at the same time, sharing all the workers
+            self.assertEqual([r['jobs'] for r in results], [2, 2, 2, 1])
+            self.assertEqual(results[3]['rms'], results[1]['rms'])
+            self.assertEqual(results[1]['views'], len(self.limages[0]))
+            self.assert_(results[1]['rms'] < 1.0)
+            with open(os.path.join(output, 'robot-2', 'result.json')) as f:
+                self.assertEqual(json.load(f)['rms'], results[1]['rms'])
+            for name in ['ost.yaml', 'ost.txt']:
+                self.assert_(os.path.exists(os.path.join(output, 'robot-2', name)))
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_tarfile_save(self):
+        # The saved samples can be read one by one, and calibrate again from their cached corners
+        # to the same solution
+        setup = self.setups[0]
+        board = ChessboardInfo(setup.cols, setup.rows, self.board_width_dim)
+        sc = StereoCalibrator([ board ], flags=cv2.CALIB_FIX_K3)
+        mc = MonoCalibrator([ board ], flags=cv2.CALIB_FIX_K3)
+        for img in self.limages[0]:
+            sc.score((img, img), sc.detect((img, img)))
+            mc.score(img, mc.detect(img))
+        sc.do_calibration()
+        mc.do_calibration()
+        for suffix in ['.tar', '.zip']:
+            with tempfile.NamedTemporaryFile(suffix=suffix) as f:
+                try:
+                    if suffix == '.zip':
+                        archive = zipfile.ZipFile(f, 'w')
+                    else:
+                        archive = tarfile.open(fileobj=f, mode='w')
+                    sc.do_tarfile_save(archive).save(f.name + '.corners.npz')
+                    archive.close()
+                    f.flush()
+
+                    with ArchiveReader(f.name) as archive:
+                        names = archive.names()
+                        self.assertEqual(names[-3:], ['left.yaml', 'right.yaml', 'ost.txt'])
+                        self.assertEqual(len(names), 2 * len(sc.db) + 3)
+                        for (i, (_, limg, rimg)) in enumerate(sc.db):
+                            self.assert_(numpy.array_equal(image_from_archive(archive, 'right-%04d.png' % i)[:, :, 0], rimg))
+
+                    sc2 = StereoCalibrator([ board ], flags=cv2.CALIB_FIX_K3)
+                    sc2.do_tarfile_calibration(f.name)
+                    self.assertEqual(sc2.detection_stats['corner_cache_hits'], 2 * len(sc.db))
+                    self.assert_(numpy.array_equal(sc2.T, sc.T))
+                finally:
+                    if os.path.exists(f.name + '.corners.npz'):
+                        os.remove(f.name + '.corners.npz')
+
+        # Monocular calibration detects at full resolution, as these images were
+        with tempfile.NamedTemporaryFile(suffix='.tar') as f:
+            try:
+                archive = tarfile.open(fileobj=f, mode='w')
+                mc.do_tarfile_save(archive).save(f.name + '.corners.npz')
+                archive.close()
+                f.flush()
+                mc2 = MonoCalibrator([ board ], flags=cv2.CALIB_FIX_K3)
+                mc2.do_tarfile_calibration(f.name)
+                self.assertEqual(mc2.detection_stats['corner_cache_hits'], len(mc.db))
+                self.assert_(numpy.array_equal(mc2.intrinsics, mc.intrinsics))
+            finally:
+                if os.path.exists(f.name + '.corners.npz'):
+                    os.remove(f.name + '.corners.npz')
+
+        # The corners of tracked frames are not those of a fresh detection
+        tracked = MonoCalibrator([ board ], roi_tracking=True)
+        for img in self.limages[0]:
+            tracked.score(img, tracked.detect(img))
+        self.assert_(tracked._samples_corner_cache() is None)
+
+    def test_roi_tracking(self):
+        # Feeding each view twice, the second detection is at least found around the first one
+        setup = self.setups[0]
+        board = ChessboardInfo(setup.cols, setup.rows, self.board_width_dim)
+        mc = MonoCalibrator([ board ], roi_tracking=True)
+        for img in self.limages[0]:
+            corners = mc.downsample_and_detect(img, track=True)[1]
+            tracked_corners = mc.downsample_and_detect(img, track=True)[1]
+            self.assert_(numpy.allclose(corners, tracked_corners, atol=0.05))
+        stats = mc.get_detection_stats()
+        self.assert_(stats['roi_hits'] >= len(self.limages[0]))
+
+    def test_flow_tracking(self):
+        # A still chessboard is followed by optical flow until the next full detection
+        setup = self.setups[0]
+        board = ChessboardInfo(setup.cols, setup.rows, self.board_width_dim)
+        mc = MonoCalibrator([ board ], flow_tracking=True, redetect_interval=3)
+        img = self.limages[0][0]
+        corners = mc.downsample_and_detect(img, track=True)[1]
+        for i in range(6):
+            tracked_corners = mc.downsample_and_detect(img, track=True)[1]
+            self.assert_(numpy.allclose(corners, tracked_corners, atol=0.05))
+        stats = mc.get_detection_stats()
+        self.assertEqual(stats['flow_hits'], 5)
+        self.assertEqual(stats['flow_redetects'], 1)
+        self.assertEqual(stats['flow_misses'], 0)
+        # Propagated corners are only refined at full resolution if the frame becomes a sample
+        big = cv2.resize(img, None, fx=2, fy=2)
+        mc = MonoCalibrator([ board ], flow_tracking=True)
+        self.assert_(mc.detect(big)[5] is None)
+        detection = mc.detect(big)
+        self.assert_(detection[5] is not None)
+        mc.score(big, detection)
+        self.assertEqual(len(mc.good_corners), 1)
+        self.assertEqual(mc.get_detection_stats()['lazy_refinements'], 1)
+
+    def test_lazy_refinement(self):
+        # The corners of the samples are refined as they are when every frame is refined
+        setup = self.setups[0]
+        board = ChessboardInfo(setup.cols, setup.rows, self.board_width_dim)
+        eager = MonoCalibrator([ board ])
+        lazy = MonoCalibrator([ board ], lazy_refinement=True)
+        # Large enough to be detected downsampled
+        images = [cv2.resize(img, None, fx=2, fy=2) for img in self.limages[0]]
+        refined = [eager.downsample_and_detect(img)[1] for img in images]
+        for img in images:
+            lazy.score(img, lazy.detect(img))
+        self.assert_(lazy.good_corners)
+        for (corners, _) in lazy.good_corners:
+            self.assert_(any(numpy.array_equal(corners, c) for c in refined if c is not None))
+        stats = lazy.get_detection_stats()
+        self.assertEqual(stats['deferred_refinements'], len([c for c in refined if c is not None]))
+        self.assertEqual(stats['lazy_refinements'], len(lazy.good_corners))
+        # The refinement is the one chosen at detection time, even if the resolution changed since
+        i = [c is not None for c in refined].index(True)
+        late = MonoCalibrator([ board ], lazy_refinement=True)
+        detection = late.detect(images[i])
+        late.set_detection_resolution(0.25)
+        self.assert_(numpy.array_equal(late.refine_corners(images[i], detection), refined[i]))
+
+    def test_pyramid_detection(self):
+        # A chessboard too small to be found at VGA resolution is found in the pyramid, close to
+        # where the full-resolution detection puts it
+        setup = self.setups[0]
+        board = ChessboardInfo(setup.cols, setup.rows, self.board_width_dim)
+        mc = MonoCalibrator([ board ])
+        pyramid = MonoCalibrator([ board ], pyramid_detection=True)
+        for img in self.limages[0]:
+            big = cv2.resize(img, None, fx=3, fy=3)
+            frame = numpy.zeros((2880, 3840), numpy.uint8)
+            frame[500:500 + big.shape[0], 800:800 + big.shape[1]] = big
+            self.assertEqual(mc.downsample_and_detect(frame)[1], None)
+            corners = pyramid.downsample_and_detect(frame)[1]
+            (ok, full_corners, _) = mc.get_corners(big)
+            self.assert_(ok)
+            self.assert_(numpy.mean(numpy.linalg.norm(corners - full_corners - (800, 500), axis=2)) < 0.5)
+        # Without a redetect interval, every frame searches all the levels
+        always = MonoCalibrator([ board ], pyramid_detection=True, redetect_interval=0)
+        for img in [ numpy.zeros_like(frame), frame ]:
+            always.downsample_and_detect(img, track=True)
+        self.assert_(always.downsample_and_detect(frame, track=True)[1] is not None)
+
+    def test_frame_gate(self):
+        # Blurred frames and frames unlike the previous one are not searched for the chessboard
+        setup = self.setups[0]
+        board = ChessboardInfo(setup.cols, setup.rows, self.board_width_dim)
+        mc = MonoCalibrator([ board ], min_sharpness=50, max_frame_difference=10)
+        (img, other) = self.limages[0][:2]
+        self.assert_(mc.downsample_and_detect(cv2.GaussianBlur(img, (0, 0), 2), track=True)[1] is None)
+        self.assert_(mc.downsample_and_detect(img, track=True)[1] is not None)
+        self.assert_(mc.downsample_and_detect(img, track=True)[1] is not None)
+        self.assert_(mc.downsample_and_detect(other, track=True)[1] is None)
+        stats = mc.get_detection_stats()
+        self.assertEqual(stats['blurred_frames'], 1)
+        self.assertEqual(stats['moving_frames'], 1)
+
+    def test_board_geometry(self):
+        # Straight rows have no linear error, object points follow the board columns on a flat board
+        board = ChessboardInfo(8, 6, 0.1)
+        (x, y) = numpy.meshgrid(numpy.arange(8) * 30.0 + 20, numpy.arange(6) * 20.0 + 20)
+        corners = numpy.dstack((x, y)).reshape(-1, 1, 2).astype(numpy.float32)
+        self.assertEqual(MonoCalibrator.linear_error(corners, board), 0.0)
+        opts = MonoCalibrator([ board ]).mk_object_points([ board ], use_board_size=True)[0]
+        self.assertEqual(opts.shape, (48, 1, 3))
+        self.assert_(numpy.allclose(opts[:, 0, 1], numpy.tile(numpy.arange(8) * 0.1, 6)))
+        self.assert_(numpy.all(opts[:, 0, 2] == 0))
+
+    def test_rate_controller(self):
+        # Frames are let in one in interval, dropped when stale, and the load steps down while the
+        # latency exceeds the budget, then back up
+        rate = RateController(max_age=0.5)
+        rate.interval = 3
+        self.assertEqual([rate.admit() for i in range(6)], [False, False, True, False, False, True])
+        self.assertEqual(rate.stats()['skipped'], 4)
+        self.assert_(not rate.is_stale(0.4))
+        self.assert_(rate.is_stale(0.6))
+        self.assertEqual(rate.stats()['stale'], 1)
+
+        rate = RateController(budget=0.1, smoothing=1.0, hold=1)
+        # Frames every 10 ms, detected in 30 ms: skipping more than 2 in 3 would not help
+        rate.period = 0.01
+        for i in range(2):
+            rate.detected(0.03, 0.2)
+        self.assertEqual((rate.interval, rate.resolution), (3, 1.0))
+        for i in range(10):
+            rate.detected(0.03, 0.2)
+        self.assertEqual((rate.interval, rate.resolution), (3, 0.25))
+        rate.detected(0.03, 0.08)
+        self.assertEqual((rate.interval, rate.resolution), (3, 0.25))
+        for i in range(10):
+            rate.detected(0.03, 0.01)
+        self.assertEqual((rate.interval, rate.resolution), (1, 1.0))
+
+    def test_frame_queue(self):
+        # A full queue drops its oldest frame, or makes the producer wait for room
+        queue = FrameQueue(2, DropPolicy.Latest)
+        self.assertEqual([queue.put(frame) for frame in 'abc'], [1, 2, 3])
+        self.assertEqual(queue.put('d', seq=7), 7)
+        self.assertEqual(queue.get(), (3, 'c'))
+        self.assertEqual(queue.get(timeout=0), (7, 'd'))
+        self.assertEqual(queue.get(timeout=0), None)
+        self.assertEqual(queue.stats(), {'received': 4, 'dropped': 2, 'processed': 2, 'queued': 0})
+
+        queue = FrameQueue(1, DropPolicy.Fifo)
+        queue.put('a')
+        producer = threading.Thread(target=queue.put, args=('b',))
+        producer.start()
+        producer.join(0.1)
+        self.assert_(producer.is_alive())
+        self.assertEqual(queue.get(), (1, 'a'))
+        producer.join(1.0)
+        self.assert_(not producer.is_alive())
+        self.assertEqual(queue.get(), (2, 'b'))
+        self.assertEqual(queue.stats(), {'received': 2, 'dropped': 0, 'processed': 2, 'queued': 0})
+
+        # Waiting consumers wake up on close, and get the queued frames before None
+        results = []
+        consumer = threading.Thread(target=lambda: results.append(queue.get()))
+        consumer.start()
+        start = time.time()
+        self.assertEqual(queue.get(timeout=0.05), None)
+        self.assert_(time.time() - start >= 0.04)
+        queue.close()
+        consumer.join(1.0)
+        self.assert_(not consumer.is_alive())
+        self.assertEqual(results, [None])
+        queue = FrameQueue(1)
+        queue.put('a')
+        queue.close()
+        self.assertEqual(queue.get(), (1, 'a'))
+        self.assertEqual(queue.get(), None)
+
+    def test_pipeline(self):
+        # Results leave a stage in the order of the frames whatever its number of workers, frames
+        # failing or giving None are dropped, and all the threads end on close
+        def work(frame):
+            time.sleep(random.random() * 0.01)
+            if frame % 40 == 13:
+                raise ValueError('frame %d' % frame)
+            if frame % 5 == 0:
+                return None
+            return frame
+        output = []
+        done = threading.Event()
+        def show(frame):
+            output.append(frame)
+            if frame == 99:
+                done.set()
+        pipeline = Pipeline([Stage('work', work, 4), Stage('next', lambda frame: frame), Stage('last', work, 3)],
+                            show, 100, DropPolicy.Fifo)
+        self.assertEqual(len(pipeline.threads), 8)
+        for frame in range(100):
+            pipeline.put(frame)
+        self.assert_(done.wait(10.0))
+        expected = [frame for frame in range(100) if frame % 40 != 13 and frame % 5]
+        self.assertEqual(output, expected)
+        self.assertEqual(pipeline.queues[2].stats()['processed'], len(expected))
+        pipeline.close()
+        for thread in pipeline.threads:
+            thread.join(1.0)
+            self.assert_(not thread.is_alive())
+
+    def test_job(self):
+        # A cancelled job stops at its next progress report, a failing one keeps its error, and a
+        # node runs one job at a time
+        started = threading.Event()
+        def action(progress):
+            started.set()
+            while True:
+                progress(0.5)
+                time.sleep(0.001)
+        node = OpenCVCalibrationNode.__new__(OpenCVCalibrationNode)
+        node.job = None
+        self.assert_(node.start_job('CALIBRATE', action))
+        self.assert_(started.wait(1.0))
+        self.assert_(not node.start_job('SAVE', lambda progress: None))
+        self.assertEqual(node.job.name, 'CALIBRATE')
+        self.assertEqual(node.job.fraction, 0.5)
+        node.job.cancel()
+        node.job.join(1.0)
+        self.assert_(not node.job_running())
+        self.assert_(node.job.cancelled and node.job.error is None)
+
+        def fail(progress):
+            progress(0.0)
+            raise CalibrationException('no samples')
+        job = Job('CALIBRATE', fail)
+        job.start()
+        job.join(1.0)
+        self.assert_(not job.cancelled and isinstance(job.error, CalibrationException))
+        job = Job('SAVE', lambda progress: 42)
+        job.start()
+        job.join(1.0)
+        self.assertEqual((job.result, job.cancelled, job.error), (42, False, None))
+
+    def test_live_calibration(self):
+        # The background solver keeps up with the samples, and the final calibration uses its solution
+        setup = self.setups[0]
+        board = ChessboardInfo(setup.cols, setup.rows, self.board_width_dim)
+        mc = MonoCalibrator([ board ], live_interval=2)
+        for img in self.limages[0]:
+            mc.score(img, mc.detect(img))
+        estimate = mc.finish_live_estimate()
+        self.assertEqual(estimate.samples, len(mc.good_corners))
+        self.assertEqual(mc.live_samples, len(mc.good_corners))
+        mc.do_calibration()
+        self.assert_(numpy.array_equal(mc.intrinsics, estimate.intrinsics))
+        # A failed background solve is reported, and does not stop the next ones
+        mc = MonoCalibrator([ board ], live_interval=1)
+        solve = mc.live_calibration
+        failed = []
+        def fail_once(*args):
+            if not failed:
+                failed.append(True)
+                raise cv2.error('no solution')
+            return solve(*args)
+        mc.live_calibration = fail_once
+        for img in self.limages[0]:
+            mc.score(img, mc.detect(img))
+        self.assert_(failed)
+        self.assertEqual(mc.finish_live_estimate().samples, len(mc.good_corners))
+        # A failing final solve falls back to a calibration from scratch
+        mc = MonoCalibrator([ board ], live_interval=4)
+        for img in self.limages[0]:
+            mc.score(img, mc.detect(img))
+        self.assert_(len(mc.good_corners) > 4)
+        def fail(*args):
+            raise ValueError('no solution')
+        mc.live_calibration = fail
+        mc.do_calibration()
+        scratch = MonoCalibrator([ board ])
+        scratch.size = mc.size
+        scratch.cal_fromcorners(mc.good_corners)
+        self.assert_(numpy.array_equal(mc.intrinsics, scratch.intrinsics))
+
+    def test_background_calibration(self):
+        # The samples scored while calibrating are not added, and a cancelled calibration changes nothing
+        setup = self.setups[0]
+        board = ChessboardInfo(setup.cols, setup.rows, self.board_width_dim)
+        mc = MonoCalibrator([ board ])
+        images = self.limages[0]
+        for img in images[:-1]:
+            mc.score(img, mc.detect(img))
+        samples = len(mc.good_corners)
+        class Cancelled(Exception):
+            pass
+        def cancel(fraction):
+            if fraction == 0.5:
+                raise Cancelled()
+        self.assertRaises(Cancelled, mc.do_calibration, progress = cancel)
+        self.assert_(not mc.calibrated and not hasattr(mc, 'intrinsics'))
+        def score_last(fraction):
+            if fraction == 0.5:
+                mc.last_frame_corners = None
+                mc.score(images[-1], mc.detect(images[-1]))
+        mc.do_calibration(progress = score_last)
+        self.assert_(mc.calibrated)
+        self.assertEqual((len(mc.good_corners), len(mc.db)), (samples, samples))
+
+    def test_mkgray(self):
+        # Messages read in place give the same images as the conversions of cv_bridge
+        def image_msg(img, encoding, padding = 0, bigendian = False):
+            msg = sensor_msgs.msg.Image()
+            (msg.height, msg.width) = img.shape[:2]
+            msg.encoding = encoding
+            msg.is_bigendian = bigendian
+            rows = img.astype(img.dtype.newbyteorder('>' if bigendian else '<')).reshape(msg.height, -1).view(numpy.uint8)
+            rows = numpy.hstack([rows, numpy.zeros((msg.height, padding), numpy.uint8)])
+            msg.step = rows.shape[1]
+            msg.data = rows.tobytes()
+            return msg
+
+        mc = MonoCalibrator([ board ])
+        mono8 = self.limages[0][0]
+        mono16 = mono8.astype(numpy.uint16) * 257
+        bgr8 = cv2.cvtColor(mono8, cv2.COLOR_GRAY2BGR)
+        self.assert_(numpy.array_equal(mc.mkgray(image_msg(mono8, 'mono8', 4)), mono8))
+        for bigendian in [False, True]:
+            self.assert_(numpy.array_equal(mc.mkgray(image_msg(mono16, 'mono16', 4, bigendian)), mono8))
+        self.assert_(numpy.array_equal(mc.mkgray(image_msg(bgr8, 'bgr8')), mono8))
+        self.assertEqual(mc.detection_stats['mkgray_frames'], 4)
+        self.assertEqual(mc.detection_stats['mkgray_bytes_copied'], 3 * mono8.nbytes)
+        self.assert_(not mc.mkgray(image_msg(mono8, 'mono8')).flags.writeable)
+        # Data given as a list is copied
+        msg = image_msg(mono8, 'mono8')
+        msg.data = list(bytearray(msg.data))
+        copied = mc.detection_stats['mkgray_bytes_copied']
+        self.assert_(numpy.array_equal(mc.mkgray(msg), mono8))
+        self.assertEqual(mc.detection_stats['mkgray_bytes_copied'] - copied, mono8.nbytes)
+        # Depth images are scaled to their maximum and truncated, the negative values being 0
+        depth = numpy.array([[-2.0, 0.0, 0.999], [1.5, 1.999, 2.0]], numpy.float32)
+        self.assert_(numpy.array_equal(mc.mkgray(image_msg(depth, '32FC1')), [[0, 0, 127], [191, 254, 255]]))
+
+    def test_compressed(self):
+        # Compressed images are sized from their header and detected like the raw ones
+        setup = self.setups[0]
+        board = ChessboardInfo(setup.cols, setup.rows, self.board_width_dim)
+        mc = MonoCalibrator([ board ])
+        for img in self.limages[0][:2]:
+            msg = sensor_msgs.msg.CompressedImage()
+            msg.format = 'mono8; png compressed'
+            msg.data = cv2.imencode('.png', img)[1].tobytes()
+            lazy = mc.convert(msg)
+            self.assertEqual(lazy.shape, img.shape)
+            self.assert_(numpy.array_equal(mc.mkgray(msg), img))
+            self.assert_(numpy.array_equal(mc.downsample_and_detect(lazy)[1], mc.downsample_and_detect(img)[1]))
+            reduced = CompressedMono(msg).resized((img.shape[1] // 2, img.shape[0] // 2))
+            self.assertEqual(reduced.shape, (img.shape[0] // 2, img.shape[1] // 2))
+
+        # Larger images are detected on a reduced decode, and only decoded in full for refinement
+        img = self.limages[0][0]
+        big = cv2.resize(img, (2 * img.shape[1], 2 * img.shape[0]))
+        msg.data = cv2.imencode('.png', big)[1].tobytes()
+        lazy = mc.convert(msg)
+        detection = mc.downsample_and_detect(lazy, refine=False)
+        self.assert_(lazy._full is None)
+        self.assertEqual(detection[4], (2.0, 2.0))
+        expected = mc.downsample_and_detect(big, refine=False)
+        self.assert_(numpy.abs(detection[1] - expected[1]).max() < 0.5)
+        corners = mc.refine_corners(lazy, detection)
+        self.assert_(numpy.array_equal(full_image(lazy), big))
+        self.assert_(numpy.abs(corners - mc.refine_corners(big, expected)).max() < 0.1)
+
+    def test_bayer(self):
+        # Raw Bayer images are detected on their green sites and demosaiced like cv_bridge does
+        setup = self.setups[0]
+        board = ChessboardInfo(setup.cols, setup.rows, self.board_width_dim)
+        mc = MonoCalibrator([ board ])
+        img = self.limages[0][0]
+        (h, w) = img.shape
+        for pattern in ['rggb', 'bggr', 'gbrg', 'grbg']:
+            msg = sensor_msgs.msg.Image()
+            (msg.height, msg.width, msg.step) = (h, w, w)
+            msg.encoding = 'bayer_%s8' % pattern
+            msg.data = img.tobytes()
+            lazy = mc.convert(msg)
+            self.assertEqual(lazy.shape, img.shape)
+            code = {'rggb': cv2.COLOR_BayerBG2GRAY, 'bggr': cv2.COLOR_BayerRG2GRAY,
+                    'gbrg': cv2.COLOR_BayerGR2GRAY, 'grbg': cv2.COLOR_BayerGB2GRAY}[pattern]
+            self.assert_(numpy.array_equal(mc.mkgray(msg), cv2.cvtColor(img, code)))
+            green = lazy.resized((w // 2, h // 2))
+            self.assertEqual(green.shape, (h // 2, w // 2))
+            self.assert_(lazy._full is None)
+
+        # Live frames are only demosaiced once kept as samples, to refine their corners
+        big = cv2.resize(img, (2 * w, 2 * h))
+        msg = sensor_msgs.msg.Image()
+        (msg.height, msg.width, msg.step) = (2 * h, 2 * w, 2 * w)
+        msg.encoding = 'bayer_rggb8'
+        msg.data = big.tobytes()
+        for lazy_refinement in [False, True]:
+            mc = MonoCalibrator([ board ], lazy_refinement=lazy_refinement)
+            (frame, sample) = (mc.convert(msg), mc.convert(msg))
+            detection = mc.detect(frame)
+            self.assert_(detection[1] is not None and detection[5] is not None)
+            self.assert_(frame._full is None)
+            mc.score(sample, mc.detect(sample))
+            self.assertEqual(len(mc.good_corners), 1)
+            self.assert_(sample._full is not None)
+            self.assertEqual(mc.detection_stats['lazy_refinements'], 1)
+
+    def test_sample_store(self):
+        # Images past the memory budget are restored exactly, or dropped when discarded
+        images = self.limages[0]
+        for storage in [ImageStorage.Memory, ImageStorage.Png, ImageStorage.Mmap, ImageStorage.Discard]:
+            db = SampleStore(storage, memory_budget=images[0].nbytes)
+            for (i, img) in enumerate(images):
+                db.append(([i], img))
+            self.assertEqual(len(db), len(images))
+            self.assertEqual(db.image_size, (images[0].shape[1], images[0].shape[0]))
+            self.assertEqual(db.param_range(), ([0], [len(images) - 1]))
+            self.assertEqual(db.nearest_distance([1.25]), 0.25)
+            for (i, (params, img)) in enumerate(db):
+                self.assertEqual(params, [i])
+                if storage == ImageStorage.Discard and i > 0:
+                    self.assert_(img is None)
+                    self.assert_(db.png(i, 0) is None)
+                else:
+                    self.assert_(numpy.array_equal(img, images[i]))
+
 if __name__ == '__main__':
     #rosunit.unitrun('camera_calibration', 'directed', TestDirected)
     rosunit.unitrun('camera_calibration', 'artificial', TestArtificial)